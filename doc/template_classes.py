@@ -8,7 +8,7 @@ class TemplateBridge:
         assert False
 
     def get_prefix(self):
-        # returns (ip, mask)
+        # returns (ip, mask), prefix length is variable, don't assume /24
         assert False
 
     def get_bridge_id(self):
@@ -128,7 +128,8 @@ class TemplateNetworkTrafficFacilityGateway:
 
     @property
     def target(self):
-        """(next-hop,interface), invalid if both is None"""
+        """(next-hop,interface), invalid if both is None
+           or [(next-hop,interface,weight),...] for multipath, weight is 1-256"""
         assert False
 
     @property
@@ -142,6 +143,32 @@ class TemplateNetworkTrafficFacilityGateway:
         assert False
 
 
+# template for json object
+class TemplateNetworkTrafficFacilityDomainGateway:
+
+    """traffic to the addresses which domain-list resolves to"""
+
+    @property
+    def name(self):
+        assert False
+
+    @property
+    def ntfac_type(self):
+        return "domain-gateway"
+
+    @property
+    def target(self):
+        """(next-hop,interface), invalid if both is None
+           or [(next-hop,interface,weight),...] for multipath, weight is 1-256"""
+        assert False
+
+    @property
+    def domain_list(self):
+        """["example.com","*.example.org"], a domain covers all its sub-domains
+           case, leading "*." and leading or trailing dots are ignored, "*.Example.COM." is the same as "example.com" """
+        assert False
+
+
 # template for json object
 class TemplateNetworkTrafficFacilityDefaultGateway:
 
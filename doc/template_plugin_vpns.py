@@ -7,6 +7,9 @@
 class TemplatePluginVpnServer:
 
     def init2(self, instanceName, cfg, tmpDir, varDir, bridgePrefix, l2DnsPort, clientAddCallback, clientChangeCallback, clientRemoveCallback):
+        # bridgePrefix is (ip, mask), its length is set by "prefix-length" in cfg, 24 by default
+        # the prefix length is variable, plugin must not assume /24 when it calculates addresses and DHCP pool
+        # DHCP pool is run by plugin, its size is configured in cfg as well and must fit in the prefix
         assert False
 
     def start(self):
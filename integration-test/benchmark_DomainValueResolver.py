@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "lib"))
+from wrt_manager_traffic import _NamePriorityKeyValueDict
+from wrt_manager_traffic import _DomainValueResolver
+
+
+# 100k domains set by 10 groups, each domain is set by 2 groups, 1/10 of them are sub-domains of 100 parent domains
+# each group blacklists some domains
+keyCount = 100000
+groupCount = 10
+keyPerGroup = keyCount * 2 // groupCount
+parentCount = 100
+
+
+def domainName(i):
+    if i % 10 == 0:
+        return "sub%d.parent%d.com" % (i, i // 10 % parentCount)
+    return "domain%d.com" % (i)
+
+
+obj = _NamePriorityKeyValueDict()
+resolver = _DomainValueResolver(obj, "blacklisted")
+
+t = time.time()
+for g in range(0, groupCount):
+    for i in range(0, keyPerGroup):
+        k = (g * keyPerGroup // 2 + i) % keyCount
+        obj.set_key_value("group%d" % (g), g, domainName(k), "blacklisted" if k % 50 == g else ["8.8.8.%d" % (g)])
+    for i in range(0, parentCount):
+        obj.set_key_value("group%d" % (g), g, "parent%d.com" % (i), ["8.8.4.%d" % (g)])
+print("set_key_value:           %.3fs for %d entries" % (time.time() - t, groupCount * (keyPerGroup + parentCount)))
+
+t = time.time()
+changes = resolver.update(obj.pop_changed_keys())
+print("update all:              %.3fs for %d domains, %d changes" % (time.time() - t, len(obj.keyDict), len(changes)))
+
+t = time.time()
+obj.set_key_value("group0", 0, "domain12345.com", ["1.1.1.1"])
+changes = resolver.update(obj.pop_changed_keys())
+print("change one domain:       %.6fs, %d changes" % (time.time() - t, len(changes)))
+
+t = time.time()
+obj.set_key_value("group0", 0, "parent7.com", ["1.1.1.1"])
+changes = resolver.update(obj.pop_changed_keys())
+print("change one parent:       %.6fs, %d changes" % (time.time() - t, len(changes)))
+
+t = time.time()
+obj.set_key_value("group9", 9, "new.domain12345.com", "blacklisted")
+changes = resolver.update(obj.pop_changed_keys())
+print("add one blacklist:       %.6fs, %d changes" % (time.time() - t, len(changes)))
+
+t = time.time()
+obj.set_key_value("group9", 9, "newdomain.com", ["1.1.1.1"])
+changes = resolver.update(obj.pop_changed_keys())
+print("add one domain:          %.6fs, %d changes" % (time.time() - t, len(changes)))
+
+t = time.time()
+obj.remove_by_name("group9")
+changes = resolver.update(obj.pop_changed_keys())
+print("remove_by_name:          %.3fs for %d domains, %d changes" % (time.time() - t, keyPerGroup + parentCount + 2, len(changes)))
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+# Compare queries per second and latency of the in-process forwarder and dnsmasq as level 2 nameserver.
+# Both forward "test" domain to a local stub nameserver, so that no network access is needed.
+# Usage: benchmark_L2Nameserver.py [query-count] [name-count] [concurrency]
+
+import os
+import sys
+import time
+import struct
+import socket
+import asyncio
+import tempfile
+import threading
+import subprocess
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "lib"))
+from wrt_dns_forwarder import WrtDnsForwarder
+
+
+def getFreePort():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def buildQuery(qid, name):
+    buf = struct.pack("!HHHHHH", qid, 0x0100, 1, 0, 0, 0)
+    for label in name.split("."):
+        buf += bytes([len(label)]) + label.encode("ascii")
+    return buf + b"\x00" + struct.pack("!HH", 1, 1)
+
+
+class StubNameserver(asyncio.DatagramProtocol):
+
+    """answers every A query with 1.2.3.4, TTL 300"""
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        offset = 12
+        while data[offset] != 0:
+            offset += 1 + data[offset]
+        offset += 5
+        resp = data[:2] + struct.pack("!HHHHH", 0x8180, 1, 1, 0, 0) + data[12:offset]
+        resp += b"\xc0\x0c" + struct.pack("!HHIH", 1, 1, 300, 4) + socket.inet_aton("1.2.3.4")
+        self.transport.sendto(resp, addr)
+
+
+class Client(asyncio.DatagramProtocol):
+
+    def __init__(self):
+        self.pendingDict = dict()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        future = self.pendingDict.pop(struct.unpack("!H", data[:2])[0], None)
+        if future is not None and not future.done():
+            future.set_result(data)
+
+
+async def runLoad(port, queryCount, nameCount, concurrency):
+    loop = asyncio.get_running_loop()
+    transport, client = await loop.create_datagram_endpoint(Client, remote_addr=("127.0.0.1", port))
+    latencyList = []
+    failCount = 0
+    counter = iter(range(0, queryCount))
+
+    async def worker():
+        nonlocal failCount
+        for i in counter:
+            qid = i % 65536
+            future = loop.create_future()
+            client.pendingDict[qid] = future
+            t = time.monotonic()
+            transport.sendto(buildQuery(qid, "host%d.test" % (i % nameCount)))
+            try:
+                await asyncio.wait_for(future, 2.0)
+                latencyList.append(time.monotonic() - t)
+            except asyncio.TimeoutError:
+                client.pendingDict.pop(qid, None)
+                failCount += 1
+
+    t = time.monotonic()
+    await asyncio.gather(*[worker() for i in range(0, concurrency)])
+    elapsed = time.monotonic() - t
+    transport.close()
+
+    latencyList.sort()
+    p99 = latencyList[min(len(latencyList) * 99 // 100, len(latencyList) - 1)] if len(latencyList) > 0 else 0
+    return (queryCount / elapsed, p99 * 1000, failCount)
+
+
+def main():
+    queryCount = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    nameCount = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    concurrency = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+
+    # stub nameserver
+    stubPort = getFreePort()
+    stubLoop = asyncio.new_event_loop()
+    stubLoop.run_until_complete(stubLoop.create_datagram_endpoint(StubNameserver, local_addr=("127.0.0.1", stubPort)))
+    threading.Thread(target=stubLoop.run_forever, daemon=True).start()
+
+    tmpDir = tempfile.mkdtemp()
+    resolvConf = os.path.join(tmpDir, "resolv.conf")
+    with open(resolvConf, "w") as f:
+        f.write("")
+
+    resultList = []
+
+    # in-process forwarder
+    port = getFreePort()
+    forwarder = WrtDnsForwarder(port, resolvConf)
+    try:
+        forwarder.set_domain_dict({"test": ["127.0.0.1:%d" % (stubPort)]})
+        resultList.append(("forwarder", asyncio.run(runLoad(port, queryCount, nameCount, concurrency))))
+    finally:
+        forwarder.dispose()
+
+    # dnsmasq, configured like the level 2 dnsmasq
+    port = getFreePort()
+    cfgFile = os.path.join(tmpDir, "dnsmasq.conf")
+    with open(cfgFile, "w") as f:
+        f.write("bind-interfaces\n")
+        f.write("interface=lo\n")
+        f.write("no-hosts\n")
+        f.write("resolv-file=%s\n" % (resolvConf))
+        f.write("server=/test/127.0.0.1#%d\n" % (stubPort))
+    proc = subprocess.Popen(["/usr/sbin/dnsmasq", "--keep-in-foreground", "--port=%d" % (port), "--conf-file=%s" % (cfgFile)])
+    try:
+        time.sleep(1)
+        resultList.append(("dnsmasq", asyncio.run(runLoad(port, queryCount, nameCount, concurrency))))
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    print("%-12s %12s %12s %8s" % ("", "qps", "p99 (ms)", "failed"))
+    for name, (qps, p99, failCount) in resultList:
+        print("%-12s %12.0f %12.3f %8d" % (name, qps, p99, failCount))
+
+
+if __name__ == "__main__":
+    main()
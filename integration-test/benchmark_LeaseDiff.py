@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+# Compare the old list based lease scan with the dict based one.
+# One scan is: read and parse the leases file, then diff it against the previous scan.
+# Usage: benchmark_LeaseDiff.py [lease-count]
+
+import os
+import re
+import sys
+import time
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "lib"))
+from wrt_util import WrtUtil
+from wrt_manager_lan import _Helper
+
+
+def writeLeaseFile(filename, leaseCount, renewIndex, removeCount):
+    with open(filename, "w") as f:
+        for i in range(removeCount, leaseCount):
+            expiryTime = 1600000000 + i + (360 if i == renewIndex else 0)
+            mac = "02:00:00:%02x:%02x:%02x" % ((i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+            ip = "10.%d.%d.%d" % ((i >> 16) & 0xff, (i >> 8) & 0xff, i & 0xff)
+            hostname = "host%d" % (i) if i % 3 != 0 else "*"
+            f.write("%d %s %s %s 01:%s\n" % (expiryTime, mac, ip, hostname, mac))
+
+
+def oldScan(filename, lastScanRecord):
+    # per-line regex and quadratic find, as _DefaultBridge did before
+    pattern = "([0-9]+) +([0-9a-f:]+) +([0-9\\.]+) +(\\S+) +(\\S+)"
+    newLeaseList = []
+    with open(filename, "r") as f:
+        for line in f.read().split("\n"):
+            m = re.match(pattern, line)
+            if m is None:
+                continue
+            newLeaseList.append((m.group(1), m.group(2), m.group(3), "" if m.group(4) == "*" else m.group(4), "" if m.group(5) == "*" else m.group(5)))
+
+    def find(item, leaseList):
+        for item2 in leaseList:
+            if item2[2] == item[2]:
+                return item2
+        return None
+
+    addList = []
+    changeList = []
+    removeList = []
+    for item in newLeaseList:
+        item2 = find(item, lastScanRecord)
+        if item2 is not None:
+            if item[1] != item2[1] or item[3] != item2[3]:
+                changeList.append(item)
+        else:
+            addList.append(item)
+    for item in lastScanRecord:
+        if find(item, newLeaseList) is None:
+            removeList.append(item)
+    return newLeaseList, (len(addList), len(changeList), len(removeList))
+
+
+def newScan(filename, leaseDict):
+    newLeaseDict = WrtUtil.readDnsmasqLeaseFileToDict(filename)
+    addList, changeList, removeList = _Helper.diffLeaseDict(leaseDict, newLeaseDict)
+    return newLeaseDict, (len(addList), len(changeList), len(removeList))
+
+
+def main():
+    leaseCount = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    filename = os.path.join(tempfile.mkdtemp(), "dnsmasq.leases")
+
+    # (description, renew-index, remove-count)
+    caseList = [
+        ("initial scan", -1, 0),
+        ("one renewal", leaseCount // 2, 0),
+        ("100 expired", -1, 100),
+    ]
+
+    print("%d leases" % (leaseCount))
+    print("%-16s %12s %12s %20s" % ("", "old (ms)", "new (ms)", "add/change/remove"))
+    oldState = []
+    newState = dict()
+    for desc, renewIndex, removeCount in caseList:
+        writeLeaseFile(filename, leaseCount, renewIndex, removeCount)
+
+        t = time.monotonic()
+        oldState, oldResult = oldScan(filename, oldState)
+        oldTime = time.monotonic() - t
+
+        t = time.monotonic()
+        newState, newResult = newScan(filename, newState)
+        newTime = time.monotonic() - t
+
+        assert oldResult == newResult
+        print("%-16s %12.1f %12.1f %20s" % (desc, oldTime * 1000, newTime * 1000, "%d/%d/%d" % newResult))
+
+    os.unlink(filename)
+
+
+if __name__ == "__main__":
+    main()
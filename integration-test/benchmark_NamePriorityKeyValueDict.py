@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "lib"))
+from wrt_manager_traffic import _NamePriorityKeyValueDict
+
+
+# 100k keys set by 40 groups, each key is set by 2 groups
+keyCount = 100000
+groupCount = 40
+keyPerGroup = keyCount * 2 // groupCount
+
+obj = _NamePriorityKeyValueDict()
+
+t = time.time()
+for g in range(0, groupCount):
+    for i in range(0, keyPerGroup):
+        obj.set_key_value("group%d" % (g), g % 7, "domain%d.com" % ((g * keyPerGroup // 2 + i) % keyCount), ["8.8.8.%d" % (g)])
+print("set_key_value:           %.3fs for %d entries" % (time.time() - t, groupCount * keyPerGroup))
+
+t = time.time()
+changes = obj.pop_changes()
+print("pop_changes:             %.3fs for %d changes" % (time.time() - t, len(changes)))
+
+t = time.time()
+obj.get_dict()
+print("get_dict:                %.3fs" % (time.time() - t))
+
+t = time.time()
+for g in range(0, groupCount):
+    obj.change_priority_by_name("group%d" % (g), groupCount - g)
+changes = obj.pop_changes()
+print("change_priority_by_name: %.3fs for %d groups, %d changes" % (time.time() - t, groupCount, len(changes)))
+
+t = time.time()
+for g in range(0, groupCount // 2):
+    obj.remove_by_name("group%d" % (g))
+changes = obj.pop_changes()
+print("remove_by_name:          %.3fs for %d groups, %d changes" % (time.time() - t, groupCount // 2, len(changes)))
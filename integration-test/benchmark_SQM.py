@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+# Compare latency under load of a dumb FIFO shaper, htb+fq_codel and cake.
+# Two network namespaces are connected by a veth pair, egress of the sender side is shaped,
+# bulk TCP flows are sent through it while ping measures the round trip time.
+# Needs root, iproute2, ping and a kernel with sch_cake.
+# Usage: benchmark_SQM.py [rate] [duration] [flow-count]
+
+import os
+import re
+import sys
+import time
+import pyroute2
+import subprocess
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "lib"))
+from wrt_manager_sqm import _SqmHelper
+
+
+nsA = "wrtd-sqm-bench-a"
+nsB = "wrtd-sqm-bench-b"
+ipA = "10.254.254.1"
+ipB = "10.254.254.2"
+port = 5201
+
+receiverScript = """
+import socket, threading
+s = socket.socket()
+s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+s.bind(("%s", %d))
+s.listen(64)
+def drain(c):
+    while c.recv(65536):
+        pass
+while True:
+    threading.Thread(target=drain, args=(s.accept()[0],), daemon=True).start()
+""" % (ipB, port)
+
+senderScript = """
+import time, socket
+s = socket.create_connection(("%s", %d))
+buf = bytes(65536)
+t = time.monotonic() + %f
+while time.monotonic() < t:
+    s.sendall(buf)
+"""
+
+
+def setup():
+    subprocess.run(["/sbin/ip", "netns", "add", nsA], check=True)
+    subprocess.run(["/sbin/ip", "netns", "add", nsB], check=True)
+    subprocess.run(["/sbin/ip", "link", "add", "veth-a", "netns", nsA, "type", "veth", "peer", "name", "veth-b", "netns", nsB], check=True)
+    subprocess.run(["/sbin/ip", "-n", nsA, "addr", "add", ipA + "/24", "dev", "veth-a"], check=True)
+    subprocess.run(["/sbin/ip", "-n", nsB, "addr", "add", ipB + "/24", "dev", "veth-b"], check=True)
+    subprocess.run(["/sbin/ip", "-n", nsA, "link", "set", "veth-a", "up"], check=True)
+    subprocess.run(["/sbin/ip", "-n", nsB, "link", "set", "veth-b", "up"], check=True)
+
+
+def cleanup():
+    subprocess.run(["/sbin/ip", "netns", "del", nsA])
+    subprocess.run(["/sbin/ip", "netns", "del", nsB])
+
+
+def applyFifo(ipp, ifindex, rate):
+    # what a router without SQM does: a rate limiter with a large FIFO queue
+    _SqmHelper.removeQdisc(ipp, ifindex)
+    ipp.tc("add", "htb", ifindex, 0x10000, default=0x10)
+    ipp.tc("add-class", "htb", ifindex, 0x10010, parent=0x10000, rate=rate, ceil=rate)
+    ipp.tc("add", "pfifo", ifindex, 0x100000, parent=0x10010, limit=1000)
+
+
+def measure(duration, flowCount):
+    procList = []
+    try:
+        procList.append(subprocess.Popen(["/sbin/ip", "netns", "exec", nsB, sys.executable, "-c", receiverScript]))
+        time.sleep(1)
+        for i in range(0, flowCount):
+            procList.append(subprocess.Popen(["/sbin/ip", "netns", "exec", nsA, sys.executable, "-c", senderScript % (ipB, port, duration + 2)]))
+        time.sleep(2)           # let the queue build up
+
+        out = subprocess.run(["/sbin/ip", "netns", "exec", nsA, "ping", "-n", "-i", "0.2", "-w", str(duration), ipB],
+                             stdout=subprocess.PIPE, universal_newlines=True).stdout
+        rttList = sorted([float(x) for x in re.findall("time=([0-9.]+) ms", out)])
+    finally:
+        for proc in procList:
+            proc.terminate()
+            proc.wait()
+
+    if len(rttList) == 0:
+        return (0, 0, 0)
+    return (rttList[len(rttList) // 2], rttList[min(len(rttList) * 99 // 100, len(rttList) - 1)], len(rttList))
+
+
+def main():
+    rate = sys.argv[1] if len(sys.argv) > 1 else "20mbit"
+    duration = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    flowCount = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+
+    cleanup()
+    setup()
+    try:
+        resultList = []
+        with pyroute2.NetNS(nsA) as ipp:
+            ifindex = ipp.link_lookup(ifname="veth-a")[0]
+
+            resultList.append(("idle", measure(duration, 0)))
+
+            applyFifo(ipp, ifindex, rate)
+            resultList.append(("fifo", measure(duration, flowCount)))
+
+            _SqmHelper.applyQdisc(ipp, ifindex, _SqmHelper.checkClassCfg({"qdisc": "htb", "rate": rate}))
+            resultList.append(("htb+fq_codel", measure(duration, flowCount)))
+
+            _SqmHelper.applyQdisc(ipp, ifindex, _SqmHelper.checkClassCfg({"qdisc": "cake", "rate": rate}))
+            resultList.append(("cake", measure(duration, flowCount)))
+    finally:
+        cleanup()
+
+    print("rate %s, %d flows, %d seconds" % (rate, flowCount, duration))
+    print("%-14s %12s %12s %8s" % ("", "p50 (ms)", "p99 (ms)", "samples"))
+    for name, (p50, p99, count) in resultList:
+        print("%-14s %12.3f %12.3f %8d" % (name, p50, p99, count))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import dbus
+import json
+import time
+
+
+def tfacGroup(i):
+    return [
+        {
+            "facility-name": "test-gateway",
+            "facility-type": "gateway",
+            "target": [None, "eth0"],
+            "network-list": ["%d.0.0.0/255.0.0.0" % (18 + i)],
+        },
+        {
+            "facility-name": "test-nameserver",
+            "facility-type": "nameserver",
+            "target": ["8.8.8.8"],
+            "domain-list": ["test%d.com" % (i)],
+        },
+    ]
+
+
+opList = []
+for i in range(0, 10):
+    opList.append({"operation": "add", "name": "test%d" % (i), "priority": i, "tfac-group": tfacGroup(i)})
+
+dbusObj = dbus.SystemBus().get_object('org.fpemud.WRT', '/org/fpemud/WRT')
+dbusObj.BatchTrafficFacilityGroup(json.dumps(opList))
+
+# the last operation is invalid, none of the operations in this batch should be applied
+opList = []
+for i in range(0, 5):
+    opList.append({"operation": "remove", "name": "test%d" % (i)})
+opList.append({"operation": "change-priority", "name": "test9", "priority": 100000})
+try:
+    dbusObj.BatchTrafficFacilityGroup(json.dumps(opList))
+    assert False
+except dbus.exceptions.DBusException:
+    pass
+
+# so you can check the route and dnsmasq configuration
+time.sleep(100)
@@ -81,6 +81,7 @@ class ManagerCaller:
         self.callRecord["traffic"] = dict()
         self.callRecord["wan"] = dict()
         self.callRecord["lan"] = dict()
+        self.callRecord["sqm"] = dict()
 
         self.managerDict = OrderedDict()
 
@@ -92,6 +93,7 @@ class ManagerCaller:
         self._callFunc("traffic", self.param.trafficManager, funcName, *args)
         self._callFunc("wan", self.param.wanManager, funcName, *args)
         self._callFunc("lan", self.param.lanManager, funcName, *args)
+        self._callFunc("sqm", self.param.sqmManager, funcName, *args)
         for name, manager in self.managerDict.items():
             self._callFunc(name, manager, funcName, *args)
 
@@ -146,9 +148,9 @@ class PrefixPool:
             if i not in idxList:
                 refList.append(self.prefixList[i])
 
-        # create new prefix for conflict items
+        # create new prefix for conflict items, with the same length
         for i in idxList:
-            pip, pmask = self._createNewPrefix(refList + prefixList)
+            pip, pmask = self._createNewPrefix(refList + prefixList, WrtUtil.ipMaskToLen(self.prefixList[i][1]))
             self.prefixList[i] = (pip, pmask, False)
 
         self.excludePrefixDict[key] = prefixList
@@ -159,21 +161,21 @@ class PrefixPool:
         if key in self.excludePrefixDict:
             del self.excludePrefixDict[key]
 
-    def usePrefix(self):
+    def usePrefix(self, prefixLen=24):
         # use a prefix in pool
         for i in range(0, len(self.prefixList)):
             ip, mask, used = self.prefixList[i]
-            if not used:
+            if not used and WrtUtil.ipMaskToLen(mask) == prefixLen:
                 self.prefixList[i] = (ip, mask, True)
                 return (ip, mask)
 
         # get exluded prefix list
-        tl = self.prefixList
+        tl = list(self.prefixList)
         for l in self.excludePrefixDict.values():
             tl += l
 
         # create a new prefix
-        pip, pmask = self._createNewPrefix(tl)
+        pip, pmask = self._createNewPrefix(tl, prefixLen)
         self.prefixList.append((pip, pmask, True))
         self._save()
         return (pip, pmask)
@@ -211,14 +213,17 @@ class PrefixPool:
         with open(self.dataFile, "w") as f:
             f.write(json.dumps(cfgObj))
 
-    def _createNewPrefix(self, excludeList):
-        item = None
-        while True:
-            item = ("192.168.%d.0" % (random.randint(0, 255)), "255.255.255.0")
+    def _createNewPrefix(self, excludeList, prefixLen):
+        # prefixes are allocated in 192.168.0.0/16, candidates are tried in random order
+        if not (17 <= prefixLen <= 30):
+            raise Exception("invalid prefix length %d" % (prefixLen))
+        candidateList = list(ipaddress.IPv4Network("192.168.0.0/16").subnets(new_prefix=prefixLen))
+        random.shuffle(candidateList)
+        for netobj in candidateList:
+            item = (str(netobj.network_address), str(netobj.netmask))
             if WrtUtil.prefixConflictWithPrefixList(item, self.defaultExcludePrefixList):
                 continue
             if WrtUtil.prefixConflictWithPrefixList(item, excludeList):
                 continue
-            break
-        assert item is not None
-        return item
+            return item
+        raise Exception("no free prefix with length %d" % (prefixLen))
@@ -16,9 +16,12 @@ from wrt_common import WrtCommon
 from wrt_common import PluginHub
 from wrt_common import PrefixPool
 from wrt_common import ManagerCaller
+from wrt_firewall import WrtFirewallNftables
+from wrt_firewall import WrtFirewallIptables
 from wrt_manager_traffic import WrtTrafficManager
 from wrt_manager_wan import WrtWanManager
 from wrt_manager_lan import WrtLanManager
+from wrt_manager_sqm import WrtSqmManager
 from wrt_dbus import DbusMainObject
 from wrt_dbus import DbusIpForwardObject
 
@@ -35,6 +38,8 @@ class WrtDaemon:
         self.interfaceScanTimeout = 10          # 10 seconds
         self.interfaceTimer = None
 
+        self.flowOffloadIfSet = set()           # interfaces set to the firewall flowtable
+
     def run(self):
         WrtUtil.ensureDir(self.param.varDir)
         WrtUtil.mkDirAndClear(self.param.tmpDir)
@@ -44,16 +49,28 @@ class WrtDaemon:
             logging.getLogger().setLevel(WrtUtil.getLoggingLevel(self.param.logLevel))
             logging.info("Program begins.")
 
-            # manipulate iptables
-            if not self.param.abortOnError:
-                WrtUtil.iptablesSetEmpty()
-            else:
-                if not WrtUtil.iptablesIsEmpty():
-                    raise Exception("iptables is not empty, wrtd use iptables exclusively")
-
             # load configuration
             self._loadCfg()
 
+            # create firewall
+            if self.param.firewallBackend == "nftables":
+                self.param.firewall = WrtFirewallNftables(self.param)
+                errmsg = "nftables table \"wrtd\" already exists"
+            elif self.param.firewallBackend == "iptables":
+                self.param.firewall = WrtFirewallIptables(self.param)
+                errmsg = "iptables is not empty, wrtd use iptables exclusively"
+            else:
+                raise Exception("invalid firewall backend \"%s\"" % (self.param.firewallBackend))
+            if self.param.flowOffload and not self.param.firewall.support_flow_offload():
+                raise Exception("flow offload is not supported by firewall backend \"%s\"" % (self.param.firewallBackend))
+            if not self.param.abortOnError:
+                self.param.firewall.set_empty()
+            else:
+                if not self.param.firewall.is_empty():
+                    raise Exception(errmsg)
+            self.param.firewall.commit()
+            logging.info("Firewall initialized, backend: %s." % (self.param.firewallBackend))
+
             # load UUID
             if WrtCommon.loadUuid(self.param):
                 logging.info("UUID generated: \"%s\"." % (self.param.uuid))
@@ -88,6 +105,7 @@ class WrtDaemon:
             self.param.trafficManager = WrtTrafficManager(self.param)
             self.param.wanManager = WrtWanManager(self.param)
             self.param.lanManager = WrtLanManager(self.param)
+            self.param.sqmManager = WrtSqmManager(self.param)
             self._loadManagerPlugins()
             self.interfaceTimer = GObject.timeout_add_seconds(0, self._interfaceTimerCallback)
 
@@ -120,6 +138,9 @@ class WrtDaemon:
                     p.dispose()
                     logging.info("Manager plugin \"%s\" deactivated." % (p.full_name))
                 self.managerPluginDict = dict()
+            if self.param.sqmManager is not None:
+                self.param.sqmManager.dispose()
+                self.param.sqmManager = None
             if self.param.lanManager is not None:
                 self.param.lanManager.dispose()
                 self.param.lanManager = None
@@ -129,11 +150,30 @@ class WrtDaemon:
             if self.param.trafficManager is not None:
                 self.param.trafficManager.dispose()
                 self.param.trafficManager = None
+            if self.param.firewall is not None:
+                self.param.firewall.dispose()
+                self.param.firewall = None
             logging.shutdown()
             shutil.rmtree(self.param.tmpDir)
             if self.bRestart:
                 WrtUtil.restartProgram()
 
+    def update_flow_offload_interfaces(self):
+        # bridges and wan interfaces which exist currently
+        if not self.param.flowOffload:
+            return
+        intfSet = set()
+        if self.param.wanManager is not None:
+            intfSet |= set(self.param.wanManager.ifconfigDict.keys())
+        if self.param.lanManager is not None:
+            intfSet.add(self.param.lanManager.defaultBridge.get_name())
+            intfSet |= set([x.get_bridge().get_name() for x in self.param.lanManager.vpnsPluginList])
+        intfSet &= set(netifaces.interfaces())
+        if intfSet != self.flowOffloadIfSet:
+            if self.param.firewall.set_flow_offload_interfaces(intfSet):
+                self.flowOffloadIfSet = intfSet
+                logging.info("Flow offload interfaces: %s." % (", ".join(sorted(intfSet)) if len(intfSet) > 0 else "none"))
+
     def _sigHandlerINT(self, signum):
         logging.info("SIGINT received.")
         self.param.mainloop.quit()
@@ -151,7 +191,21 @@ class WrtDaemon:
         return True
 
     def _loadCfg(self):
-        pass
+        if not os.path.exists(self.cfgFile) or os.path.getsize(self.cfgFile) == 0:
+            return
+        cfgObj = WrtUtil.loadJsonEtcCfg(self.cfgFile)
+        if "firewall-backend" in cfgObj:
+            self.param.firewallBackend = cfgObj["firewall-backend"]
+        if "l2-nameserver" in cfgObj:
+            self.param.l2NameserverBackend = cfgObj["l2-nameserver"]
+        if "flow-offload" in cfgObj:
+            self.param.flowOffload = cfgObj["flow-offload"]
+        if "default-bridge-prefix-length" in cfgObj:
+            self.param.defaultBridgePrefixLen = cfgObj["default-bridge-prefix-length"]
+        if "default-bridge-dhcp-pool-size" in cfgObj:
+            self.param.defaultBridgeDhcpPoolSize = cfgObj["default-bridge-dhcp-pool-size"]
+        if "multipath-hash-policy" in cfgObj:
+            self.param.multipathHashPolicy = cfgObj["multipath-hash-policy"]
 
     def _loadManagerPlugins(self):
         # load manager plugin
@@ -174,6 +228,7 @@ class WrtDaemon:
             "traffic": self.param.trafficManager,
             "wan": self.param.wanManager,
             "lan": self.param.lanManager,
+            "sqm": self.param.sqmManager,
         }
         data.managers.update(self.managerPluginDict)
 
@@ -229,6 +284,9 @@ class WrtDaemon:
 
                     # unmanaged interface
                     self.interfaceDict[intf] = None
+
+            # interfaces re-created with the same name are added back to the flowtable
+            self.update_flow_offload_interfaces()
         except BaseException:
             logging.error("Error occured in interface timer callback", exc_info=True)
         finally:
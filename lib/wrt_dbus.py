@@ -27,7 +27,20 @@ from wrt_common import WrtCommon
 #   void                                                     RemoveWanService(name:str)
 #   void                                                     AddTrafficFacilityGroup(name:str, priority:int, tfac_group:json)
 #   void                                                     ChangeTrafficFacilityGroup(name:str, tfac_group:json)
+#   void                                                     ChangeTrafficFacilityGroupPriority(name:str, priority:int)
 #   void                                                     RemoveTrafficFacilityGroup(name:str)
+#   void                                                     BatchTrafficFacilityGroup(operations:json)
+#   counters:json                                            GetTrafficCounters()
+#
+# BatchTrafficFacilityGroup() applies a list of operations as one transaction, operation is one of:
+#   {"operation": "add", "name": name, "priority": priority, "tfac-group": tfac_group}
+#   {"operation": "change", "name": name, "tfac-group": tfac_group}
+#   {"operation": "change-priority", "name": name, "priority": priority}
+#   {"operation": "remove", "name": name}
+#
+# GetTrafficCounters() returns {"interval": seconds, "samples": [sample]}, sample is:
+#   {"time": timestamp, "group": {name: {"packets": n, "bytes": n, "facility": {facility-name: {"packets": n, "bytes": n}}}}}
+# counters are cumulative, traffic is counted by the target of gateway facilities, facilities with the same target share the same counter
 
 class DbusMainObject(dbus.service.Object):
 
@@ -91,6 +104,13 @@ class DbusMainObject(dbus.service.Object):
             else:
                 ret["wconn-plugin"]["is-connected"] = False
 
+        ret["l2-nameserver"] = self.param.trafficManager.get_l2_nameserver_stat()
+        ret["sqm"] = self.param.sqmManager.get_sqm_info()
+
+        if self.param.flowOffload:
+            ret["flow-offload"] = self.param.firewall.get_flow_offload_stat()
+            ret["flow-offload"]["interfaces"] = sorted(self.param.daemon.flowOffloadIfSet)
+
         ret["default-bridge"] = dict()
         if True:
             ret["default-bridge"] = dict()
@@ -124,6 +144,13 @@ class DbusMainObject(dbus.service.Object):
 
         return json.dumps(ret)
 
+    @dbus.service.method('org.fpemud.WRT', in_signature='', out_signature='s')
+    def GetTrafficCounters(self):
+        ret = dict()
+        ret["interval"] = self.param.trafficManager.counterSampleInterval
+        ret["samples"] = self.param.trafficManager.get_traffic_counters()
+        return json.dumps(ret)
+
     @dbus.service.method('org.fpemud.WRT', sender_keyword='sender', in_signature='ss')
     def AddWanService(self, name, service, sender=None):
         if self.param.trafficManager.has_wan_service(name):
@@ -143,6 +170,7 @@ class DbusMainObject(dbus.service.Object):
     def AddTrafficFacilityGroup(self, name, priority, tfac_group, sender=None):
         if self.param.trafficManager.has_tfac_group(name):
             raise TfacException("Traffic facility grouop \"%s\" already exists." % (name))
+        checkTrafficFacilityGroupPriority(priority)
         tfac_group = json.loads(tfac_group)
         checkTrafficFacilityGroup(tfac_group)
 
@@ -160,6 +188,15 @@ class DbusMainObject(dbus.service.Object):
         self.param.trafficManager.change_tfac_group(name, tfac_group)
         self.logger.info("Traffic facility group \"%s\" changed." % (name))
 
+    @dbus.service.method('org.fpemud.WRT', in_signature='si')
+    def ChangeTrafficFacilityGroupPriority(self, name, priority):
+        if not self.param.trafficManager.has_tfac_group(name):
+            raise TfacException("Traffic facility group \"%s\" does not exist." % (name))
+        checkTrafficFacilityGroupPriority(priority)
+
+        self.param.trafficManager.change_tfac_group_priority(name, priority)
+        self.logger.info("Traffic facility group \"%s\" priority changed to %d." % (name, priority))
+
     @dbus.service.method('org.fpemud.WRT', in_signature='s')
     def RemoveTrafficFacilityGroup(self, name):
         if not self.param.trafficManager.has_tfac_group(name):
@@ -169,6 +206,18 @@ class DbusMainObject(dbus.service.Object):
         del self.tfacGroupOwnerDict[name]
         self.logger.info("Traffic facility group \"%s\" removed." % (name))
 
+    @dbus.service.method('org.fpemud.WRT', sender_keyword='sender', in_signature='s')
+    def BatchTrafficFacilityGroup(self, operations, sender=None):
+        opList = checkTrafficFacilityGroupOperationList(json.loads(operations), set(self.param.trafficManager.tfacGroupDict.keys()))
+
+        self.param.trafficManager.batch_tfac_group(opList)
+        for op in opList:
+            if op[0] == "add":
+                self.tfacGroupOwnerDict[op[1]] = sender
+            elif op[0] == "remove":
+                del self.tfacGroupOwnerDict[op[1]]
+        self.logger.info("Traffic facility group batch of %d operations applied by %s." % (len(opList), sender))
+
 
 ################################################################################
 # DBus API Docs
@@ -207,13 +256,78 @@ class TfacException(Exception):
     pass
 
 
+def checkTrafficFacilityGroupPriority(priority):
+    # group priority is mapped to policy rule priority, which must stay in the rule priority range owned by traffic manager (20001 to 29999)
+    if priority < 0 or priority > 9998:
+        raise TfacException("Invalid priority %d, must be in range [0, 9998]." % (priority))
+
+
+def checkTrafficFacilityGroupOperationList(operations, nameSet):
+    # returns operation list for WrtTrafficManager.batch_tfac_group()
+    if not isinstance(operations, list):
+        raise TfacException("Operation list is invalid.")
+
+    ret = []
+    nameSet = set(nameSet)
+    i = 0
+    for op in operations:
+        i += 1
+
+        if not isinstance(op, dict) or "operation" not in op or "name" not in op:
+            raise TfacException("Operation No.%d is invalid." % (i))
+        name = op["name"]
+
+        if op["operation"] == "add":
+            if name in nameSet:
+                raise TfacException("Traffic facility grouop \"%s\" already exists." % (name))
+            if "priority" not in op or not isinstance(op["priority"], int):
+                raise TfacException("Invalid \"priority\" for operation No.%d." % (i))
+            checkTrafficFacilityGroupPriority(op["priority"])
+            if "tfac-group" not in op:
+                raise TfacException("Lacking \"tfac-group\" for operation No.%d." % (i))
+            checkTrafficFacilityGroup(op["tfac-group"])
+            ret.append(("add", name, op["priority"], op["tfac-group"]))
+            nameSet.add(name)
+            continue
+
+        if name not in nameSet:
+            raise TfacException("Traffic facility group \"%s\" does not exist." % (name))
+
+        if op["operation"] == "change":
+            if "tfac-group" not in op:
+                raise TfacException("Lacking \"tfac-group\" for operation No.%d." % (i))
+            checkTrafficFacilityGroup(op["tfac-group"])
+            ret.append(("change", name, op["tfac-group"]))
+            continue
+
+        if op["operation"] == "change-priority":
+            if "priority" not in op or not isinstance(op["priority"], int):
+                raise TfacException("Invalid \"priority\" for operation No.%d." % (i))
+            checkTrafficFacilityGroupPriority(op["priority"])
+            ret.append(("change-priority", name, op["priority"]))
+            continue
+
+        if op["operation"] == "remove":
+            ret.append(("remove", name))
+            nameSet.remove(name)
+            continue
+
+        raise TfacException("Invalid \"operation\" for operation No.%d." % (i))
+
+    return ret
+
+
 def checkTrafficFacilityGroup(tfac_group):
     i = 0
+    nameSet = set()
     for tfac in tfac_group:
         i += 1
 
         if "facility-name" not in tfac:
             raise TfacException("Lacking \"facility-name\" for facility No.%d." % (i))
+        if tfac["facility-name"] in nameSet:
+            raise TfacException("Duplicate \"facility-name\" for facility No.%d." % (i))
+        nameSet.add(tfac["facility-name"])
 
         if "facility-type" not in tfac:
             raise TfacException("Lacking \"facility-type\" for facility \"%s\"." % (tfac["facility-name"]))
@@ -240,20 +354,17 @@ def checkTrafficFacilityGroup(tfac_group):
                 if not isinstance(item, str):
                     raise TfacException("Some element in \"domain-list\" is invalid for facility \"%s\"." % (tfac["facility-name"]))
 
+            if "domain-blacklist" in tfac:
+                if not isinstance(tfac["domain-blacklist"], list):
+                    raise TfacException("Type of \"domain-blacklist\" is invalid for facility \"%s\"." % (tfac["facility-name"]))
+                for item in tfac["domain-blacklist"]:
+                    if not isinstance(item, str):
+                        raise TfacException("Some element in \"domain-blacklist\" is invalid for facility \"%s\"." % (tfac["facility-name"]))
+
             continue
 
         if tfac["facility-type"] == "gateway":
-            if "target" not in tfac:
-                raise TfacException("Lacking \"target\" for facility \"%s\"." % (tfac["facility-name"]))
-            msg = "Invalid \"target\" for facility \"%s\"." % (tfac["facility-name"])
-            if not isinstance(tfac["target"], list):
-                raise TfacException(msg)
-            if len(tfac["target"]) != 2:
-                raise TfacException(msg)
-            if tfac["target"][0] is not None and not isinstance(tfac["target"][0], str):
-                raise TfacException(msg)
-            if tfac["target"][1] is not None and not isinstance(tfac["target"][1], str):
-                raise TfacException(msg)
+            checkTrafficFacilityGatewayTarget(tfac, False)
 
             if "network-list" not in tfac:
                 raise TfacException("Lacking \"network-list\" for facility \"%s\"." % (tfac["facility-name"]))
@@ -276,6 +387,69 @@ def checkTrafficFacilityGroup(tfac_group):
                 except ValueError:
                     raise TfacException(msg)
 
+            if "network-blacklist" in tfac:
+                if not isinstance(tfac["network-blacklist"], list):
+                    raise TfacException("Type of \"network-blacklist\" is invalid for facility \"%s\"." % (tfac["facility-name"]))
+                for item in tfac["network-blacklist"]:
+                    msg = "Some element in \"network-blacklist\" is invalid for facility \"%s\"." % (tfac["facility-name"])
+                    if not isinstance(item, str):
+                        raise TfacException(msg)
+                    try:
+                        ipaddress.IPv4Network(item)
+                        if re.match("[0-9]+\\.[0-9]+\\.[0-9]+\\.[0-9]+", item.split("/")[0]) is None:
+                            raise TfacException(msg)
+                    except ValueError:
+                        raise TfacException(msg)
+
+            continue
+
+        if tfac["facility-type"] == "domain-gateway":
+            checkTrafficFacilityGatewayTarget(tfac, True)
+
+            if "domain-list" not in tfac:
+                raise TfacException("Lacking \"domain-list\" for facility \"%s\"." % (tfac["facility-name"]))
+            if not isinstance(tfac["domain-list"], list):
+                raise TfacException("Type of \"domain-list\" is invalid for facility \"%s\"." % (tfac["facility-name"]))
+            for item in tfac["domain-list"]:
+                if not isinstance(item, str) or item == "" or "/" in item or "#" in item:
+                    raise TfacException("Some element in \"domain-list\" is invalid for facility \"%s\"." % (tfac["facility-name"]))
+
             continue
 
         raise TfacException("Invalid \"facility-type\" for facility \"%s\"." % (tfac["facility-name"]))
+
+
+def checkTrafficFacilityGatewayTarget(tfac, bNeedPath):
+    # target is [next-hop, interface], or list<[next-hop, interface, weight]> for multipath
+    if "target" not in tfac:
+        raise TfacException("Lacking \"target\" for facility \"%s\"." % (tfac["facility-name"]))
+    msg = "Invalid \"target\" for facility \"%s\"." % (tfac["facility-name"])
+    if not isinstance(tfac["target"], list):
+        raise TfacException(msg)
+
+    if len(tfac["target"]) > 0 and isinstance(tfac["target"][0], list):
+        if len(tfac["target"]) < 2:
+            raise TfacException(msg)
+        for path in tfac["target"]:
+            if not isinstance(path, list) or len(path) != 3:
+                raise TfacException(msg)
+            if path[0] is not None and not isinstance(path[0], str):
+                raise TfacException(msg)
+            if path[1] is not None and not isinstance(path[1], str):
+                raise TfacException(msg)
+            if path[0] is None and path[1] is None:
+                raise TfacException(msg)
+            if not isinstance(path[2], int) or not (1 <= path[2] <= 256):
+                raise TfacException(msg)
+        if len(set([tuple(x[:2]) for x in tfac["target"]])) != len(tfac["target"]):
+            raise TfacException(msg)
+        return
+
+    if len(tfac["target"]) != 2:
+        raise TfacException(msg)
+    if tfac["target"][0] is not None and not isinstance(tfac["target"][0], str):
+        raise TfacException(msg)
+    if tfac["target"][1] is not None and not isinstance(tfac["target"][1], str):
+        raise TfacException(msg)
+    if bNeedPath and tfac["target"][0] is None and tfac["target"][1] is None:
+        raise TfacException(msg)
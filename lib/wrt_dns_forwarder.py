@@ -0,0 +1,443 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import time
+import heapq
+import random
+import struct
+import socket
+import asyncio
+import logging
+import threading
+import collections
+
+
+class WrtDnsForwarder:
+
+    """Split-DNS forwarder, an alternative level 2 nameserver running in wrtd process.
+       Queries are forwarded to the nameservers of the longest matching domain, or to the servers in resolv.conf.
+       Responses are cached, cache is kept when domain nameservers change.
+       All the network operations are done by an asyncio event loop in a separate thread."""
+
+    def __init__(self, port, resolvConfFile):
+        self.logger = logging.getLogger(self.__module__ + "." + self.__class__.__name__)
+        self.port = port
+        self.resolvConfFile = resolvConfFile
+        self.timeout = 2.0                      # 2 seconds for each upstream server
+        self.resolvConfCheckInterval = 1.0
+
+        self.domainDict = dict()                # dict<domain, list<(ip, port)>>, empty list means using upstream servers, replaced as a whole on change
+        self.upstreamList = []                  # list<(ip, port)>, servers in resolv.conf
+        self.resolvConfMtime = None
+        self.resolvConfCheckTime = 0
+
+        self.cache = _DnsCache(100000)
+        self.upstreamStatDict = dict()          # dict<(ip, port), _UpstreamStat>
+        self.stat = {
+            "query": 0,
+            "tcp-query": 0,
+            "cache-hit": 0,
+            "failed": 0,                        # no upstream server answered, SERVFAIL is returned
+        }
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._threadFunc, daemon=True)
+        self.udpTransport = None
+        self.tcpServer = None
+        self.upstreamProto = None
+        self.thread.start()
+        try:
+            asyncio.run_coroutine_threadsafe(self._start(), self.loop).result()
+        except BaseException:
+            self.dispose()
+            raise
+
+    def dispose(self):
+        if self.thread is not None:
+            asyncio.run_coroutine_threadsafe(self._stop(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.thread = None
+            self.loop.close()
+
+    def set_domain_dict(self, domainDict):
+        """domainDict is dict<domain, list<"ip" or "ip:port">>"""
+        newDict = dict()
+        for domain, nsList in domainDict.items():
+            newDict[domain.lower()] = [_parseServer(x) for x in nsList]
+        self.domainDict = newDict               # replaced atomically, queries being processed use the old one
+
+    def update_domain_dict(self, changeDict):
+        """changeDict is dict<domain, list<"ip" or "ip:port"> or None>, None removes the domain"""
+        newDict = dict(self.domainDict)         # copied so that it is still replaced atomically, copying is much cheaper than parsing
+        for domain, nsList in changeDict.items():
+            if nsList is None:
+                newDict.pop(domain.lower(), None)
+            else:
+                newDict[domain.lower()] = [_parseServer(x) for x in nsList]
+        self.domainDict = newDict
+
+    def get_stat(self):
+        ret = dict(self.stat)
+        ret["cache-size"] = len(self.cache)
+        ret["upstream"] = dict()
+        for server, stat in list(self.upstreamStatDict.items()):
+            ret["upstream"]["%s:%d" % server] = stat.to_dict()
+        return ret
+
+    def _threadFunc(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def _start(self):
+        self.udpTransport, dummy = await self.loop.create_datagram_endpoint(lambda: _ServerProtocol(self), local_addr=("127.0.0.1", self.port))
+        self.tcpServer = await asyncio.start_server(self._serveTcp, "127.0.0.1", self.port)
+        dummy, self.upstreamProto = await self.loop.create_datagram_endpoint(lambda: _UpstreamProtocol(), family=socket.AF_INET)
+
+    async def _stop(self):
+        if self.tcpServer is not None:
+            self.tcpServer.close()
+
+        # queries being processed and idle tcp connections
+        taskList = [x for x in asyncio.all_tasks() if x is not asyncio.current_task()]
+        for task in taskList:
+            task.cancel()
+        await asyncio.gather(*taskList, return_exceptions=True)
+
+        if self.tcpServer is not None:
+            await self.tcpServer.wait_closed()
+            self.tcpServer = None
+        if self.udpTransport is not None:
+            self.udpTransport.close()
+            self.udpTransport = None
+        if self.upstreamProto is not None:
+            self.upstreamProto.close()
+            self.upstreamProto = None
+
+    async def _serveUdp(self, data, addr):
+        resp = await self._handleQuery(data)
+        if resp is not None and self.udpTransport is not None:
+            if len(resp) > 512 and not _DnsMessage.hasEdns(data):
+                resp = _DnsMessage.truncate(resp)
+            self.udpTransport.sendto(resp, addr)
+
+    async def _serveTcp(self, reader, writer):
+        try:
+            while True:
+                length = struct.unpack("!H", await reader.readexactly(2))[0]
+                data = await reader.readexactly(length)
+                self.stat["tcp-query"] += 1
+                resp = await self._handleQuery(data)
+                if resp is None:
+                    break
+                writer.write(struct.pack("!H", len(resp)) + resp)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass                                # connection closed, or cancelled on dispose
+        finally:
+            writer.close()
+
+    async def _handleQuery(self, data):
+        question = _DnsMessage.parseQuestion(data)
+        if question is None:
+            return None
+        self.stat["query"] += 1
+
+        serverList = self._route(question[0])
+        key = (question, tuple(serverList))     # cached response is not used if the nameservers of the domain changed
+        resp = self.cache.get(key, data[:2])
+        if resp is not None:
+            self.stat["cache-hit"] += 1
+            return resp
+
+        for server in serverList:
+            stat = self.upstreamStatDict.get(server)
+            if stat is None:
+                stat = _UpstreamStat()
+                self.upstreamStatDict[server] = stat
+            t = time.monotonic()
+            try:
+                resp = await self.upstreamProto.query(server, data, self.timeout)
+                if _DnsMessage.isTruncated(resp):
+                    resp = await self._queryTcp(server, data)
+            except (asyncio.TimeoutError, OSError, asyncio.IncompleteReadError):
+                stat.add_failure()
+                continue
+            stat.add_latency(time.monotonic() - t)
+            self.cache.put(key, resp)
+            return resp
+
+        self.stat["failed"] += 1
+        return _DnsMessage.servfail(data)
+
+    async def _queryTcp(self, server, data):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(server[0], server[1]), self.timeout)
+        try:
+            writer.write(struct.pack("!H", len(data)) + data)
+            await writer.drain()
+            length = struct.unpack("!H", await asyncio.wait_for(reader.readexactly(2), self.timeout))[0]
+            return await asyncio.wait_for(reader.readexactly(length), self.timeout)
+        finally:
+            writer.close()
+
+    def _route(self, qname):
+        # longest suffix match
+        domainDict = self.domainDict
+        labels = qname.split(".")
+        for i in range(0, len(labels)):
+            serverList = domainDict.get(".".join(labels[i:]))
+            if serverList is not None:
+                if len(serverList) > 0:
+                    return serverList
+                break
+        return self._getUpstreamList()
+
+    def _getUpstreamList(self):
+        now = time.monotonic()
+        if now - self.resolvConfCheckTime >= self.resolvConfCheckInterval:
+            self.resolvConfCheckTime = now
+            try:
+                mtime = os.path.getmtime(self.resolvConfFile)
+                if mtime != self.resolvConfMtime:
+                    self.resolvConfMtime = mtime
+                    self.upstreamList = _readResolvConf(self.resolvConfFile)
+            except OSError:
+                self.resolvConfMtime = None
+                self.upstreamList = []
+        return self.upstreamList
+
+
+class _ServerProtocol(asyncio.DatagramProtocol):
+
+    def __init__(self, parent):
+        self.parent = parent
+
+    def datagram_received(self, data, addr):
+        self.parent.loop.create_task(self.parent._serveUdp(data, addr))
+
+
+class _UpstreamProtocol(asyncio.DatagramProtocol):
+
+    """All the upstream UDP queries are sent through one socket, query ID is rewritten to tell responses apart"""
+
+    def __init__(self):
+        self.transport = None
+        self.pendingDict = dict()               # dict<((ip, port), query-id), future>
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def close(self):
+        self.transport.close()
+        for future in self.pendingDict.values():
+            if not future.done():
+                future.set_exception(ConnectionError())
+        self.pendingDict = dict()
+
+    async def query(self, server, data, timeout):
+        while True:
+            qid = random.randrange(0, 65536)
+            if (server, qid) not in self.pendingDict:
+                break
+        future = asyncio.get_running_loop().create_future()
+        self.pendingDict[(server, qid)] = future
+        try:
+            self.transport.sendto(struct.pack("!H", qid) + data[2:], server)
+            resp = await asyncio.wait_for(future, timeout)
+        finally:
+            self.pendingDict.pop((server, qid), None)
+        return data[:2] + resp[2:]
+
+    def datagram_received(self, data, addr):
+        if len(data) < 12:
+            return
+        future = self.pendingDict.get((addr[:2], struct.unpack("!H", data[:2])[0]))
+        if future is not None and not future.done():
+            future.set_result(data)
+
+
+class _UpstreamStat:
+
+    def __init__(self):
+        self.queryCount = 0
+        self.failCount = 0
+        self.latencyList = collections.deque(maxlen=1000)      # latency of recent queries
+
+    def add_latency(self, latency):
+        self.queryCount += 1
+        self.latencyList.append(latency)
+
+    def add_failure(self):
+        self.queryCount += 1
+        self.failCount += 1
+
+    def to_dict(self):
+        ret = {
+            "query": self.queryCount,
+            "failed": self.failCount,
+        }
+        tlist = sorted(self.latencyList)
+        if len(tlist) > 0:
+            ret["latency-avg-ms"] = sum(tlist) * 1000 / len(tlist)
+            ret["latency-p50-ms"] = tlist[len(tlist) // 2] * 1000
+            ret["latency-p99-ms"] = tlist[min(len(tlist) * 99 // 100, len(tlist) - 1)] * 1000
+        return ret
+
+
+class _DnsCache:
+
+    """LRU cache of responses, entries expire by the minimum TTL of their records, TTLs are decreased when responses are served"""
+
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.maxTtl = 86400
+        self.dictImpl = collections.OrderedDict()       # dict<key, (expire-time, store-time, response, list<(ttl-offset, ttl)>)>
+        self.expireHeap = []                            # list<(expire-time, key)>
+
+    def __len__(self):
+        return len(self.dictImpl)
+
+    def get(self, key, qidBytes):
+        entry = self.dictImpl.get(key)
+        if entry is None:
+            return None
+        now = time.monotonic()
+        if entry[0] <= now:
+            del self.dictImpl[key]
+            return None
+        self.dictImpl.move_to_end(key)
+
+        expireTime, storeTime, resp, ttlList = entry
+        elapsed = int(now - storeTime)
+        buf = bytearray(resp)
+        buf[0:2] = qidBytes
+        for offset, ttl in ttlList:
+            struct.pack_into("!I", buf, offset, max(ttl - elapsed, 0))
+        return bytes(buf)
+
+    def put(self, key, resp):
+        ret = _DnsMessage.parseTtl(resp)
+        if ret is None:
+            return
+        cacheTtl, ttlList = ret
+        cacheTtl = min(cacheTtl, self.maxTtl)
+        if cacheTtl <= 0:
+            return
+
+        now = time.monotonic()
+        self._expire(now)
+        self.dictImpl[key] = (now + cacheTtl, now, resp, ttlList)
+        self.dictImpl.move_to_end(key)
+        heapq.heappush(self.expireHeap, (now + cacheTtl, key))
+        while len(self.dictImpl) > self.maxSize:
+            self.dictImpl.popitem(last=False)
+        if len(self.expireHeap) > self.maxSize * 2:
+            self.expireHeap = [(v[0], k) for k, v in self.dictImpl.items()]
+            heapq.heapify(self.expireHeap)
+
+    def _expire(self, now):
+        while len(self.expireHeap) > 0 and self.expireHeap[0][0] <= now:
+            expireTime, key = heapq.heappop(self.expireHeap)
+            entry = self.dictImpl.get(key)
+            if entry is not None and entry[0] == expireTime:
+                del self.dictImpl[key]
+
+
+class _DnsMessage:
+
+    @staticmethod
+    def parseQuestion(data):
+        """Returns (qname, qtype, qclass), returns None if data is not a valid query"""
+        try:
+            flags, qdcount = struct.unpack_from("!HH", data, 2)
+            if (flags & 0x8000) != 0 or qdcount != 1:
+                return None
+            labels = []
+            offset = 12
+            while data[offset] != 0:
+                if (data[offset] & 0xC0) != 0:
+                    return None
+                labels.append(data[offset + 1:offset + 1 + data[offset]].decode("ascii").lower())
+                offset += 1 + data[offset]
+            qtype, qclass = struct.unpack_from("!HH", data, offset + 1)
+            return (".".join(labels), qtype, qclass)
+        except (IndexError, struct.error, UnicodeDecodeError):
+            return None
+
+    @staticmethod
+    def parseTtl(data):
+        """Returns (cache-ttl, list<(ttl-offset, ttl)>), returns None if the response should not be cached"""
+        try:
+            flags, qdcount, ancount, nscount, arcount = struct.unpack_from("!HHHHH", data, 2)
+            rcode = flags & 0x000F
+            if (flags & 0x0200) != 0 or rcode not in [0, 3]:           # truncated, or not NOERROR / NXDOMAIN
+                return None
+            offset = 12
+            for i in range(0, qdcount):
+                offset = _DnsMessage._skipName(data, offset) + 4
+            ttlList = []
+            cacheTtl = None
+            for i in range(0, ancount + nscount + arcount):
+                offset = _DnsMessage._skipName(data, offset)
+                rtype, rclass, ttl, rdlength = struct.unpack_from("!HHIH", data, offset)
+                if rtype != 41:                                         # OPT record has no TTL
+                    ttlList.append((offset + 4, ttl))
+                    if i < ancount:
+                        cacheTtl = ttl if cacheTtl is None else min(cacheTtl, ttl)
+                    elif i < ancount + nscount and rtype == 6 and ancount == 0:
+                        minimum = struct.unpack_from("!I", data, offset + 10 + rdlength - 4)[0]     # negative answer, RFC 2308
+                        cacheTtl = min(ttl, minimum)
+                offset += 10 + rdlength
+            if cacheTtl is None:
+                return None
+            return (cacheTtl, ttlList)
+        except (IndexError, struct.error):
+            return None
+
+    @staticmethod
+    def isTruncated(data):
+        return (data[2] & 0x02) != 0
+
+    @staticmethod
+    def hasEdns(data):
+        return struct.unpack_from("!H", data, 10)[0] > 0
+
+    @staticmethod
+    def truncate(data):
+        # keep header and question only, with TC bit set, client should retry with TCP
+        offset = _DnsMessage._skipName(data, 12) + 4
+        return data[:2] + bytes([data[2] | 0x02]) + data[3:4] + struct.pack("!HHHH", 1, 0, 0, 0) + data[12:offset]
+
+    @staticmethod
+    def servfail(data):
+        # QR and RA set, AA and TC cleared, rcode is SERVFAIL
+        offset = _DnsMessage._skipName(data, 12) + 4
+        return data[:2] + bytes([(data[2] | 0x80) & 0xF9, 0x82]) + struct.pack("!HHHH", 1, 0, 0, 0) + data[12:offset]
+
+    @staticmethod
+    def _skipName(data, offset):
+        while True:
+            if (data[offset] & 0xC0) == 0xC0:
+                return offset + 2
+            if data[offset] == 0:
+                return offset + 1
+            offset += 1 + data[offset]
+
+
+def _parseServer(server):
+    if ":" in server:
+        ip, port = server.split(":")
+        return (ip, int(port))
+    else:
+        return (server, 53)
+
+
+def _readResolvConf(filename):
+    ret = []
+    with open(filename) as f:
+        for line in f.read().split("\n"):
+            tlist = line.split()
+            if len(tlist) >= 2 and tlist[0] == "nameserver":
+                ret.append((tlist[1], 53))
+    return ret
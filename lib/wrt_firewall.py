@@ -0,0 +1,497 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import iptc
+import json
+import logging
+from wrt_util import WrtUtil
+
+
+# firewall backend interface:
+#   is_empty(), set_empty()                          check / clear stale firewall state before business initialize
+#   add_gateway_interfaces(), remove_gateway_interfaces()
+#   add_wan_interface(), remove_wan_interface()
+#   support_domain_ip_set()                          whether the following methods are supported
+#   add_domain_ip_set(), remove_domain_ip_set()      traffic whose destination is in the set is marked with fwmark
+#   get_dnsmasq_domain_ip_set_option()               dnsmasq option line which makes dnsmasq fill the set
+#   support_counter()                                whether the following methods are supported
+#   add_counters(), remove_counters()                count forwarded traffic by target (next-hop, interface)
+#   get_counters()                                   returns dict<target, (packets, bytes)> for the specified targets
+#   support_flow_offload()                           whether the following methods are supported
+#   set_flow_offload_interfaces()                    established flows between these interfaces bypass the forward path, applied immediately,
+#                                                    flows to counted targets are not offloaded, so that counters see all their traffic
+#   get_flow_offload_stat()                          returns number of tracked flows and offloaded flows
+#   commit()                                         apply all the queued changes
+#   dispose()
+#
+# gateway and wan interfaces and counters are reference counted, the same interface can be added by multiple callers
+
+
+class WrtFirewallNftables:
+
+    """All the rules are in table "inet wrtd", interfaces are kept in named sets.
+       Queued changes are applied by one "nft -f" invocation, which is an atomic ruleset transaction."""
+
+    def __init__(self, param):
+        self.param = param
+        self.logger = logging.getLogger(self.__module__ + "." + self.__class__.__name__)
+        self.scriptFile = os.path.join(self.param.tmpDir, "firewall.nft")
+
+        self.tableName = "wrtd"
+        self.bTableCreated = False
+
+        self.gatewayRefDict = dict()            # dict<interface,reference-count>
+        self.wanRefDict = dict()                # dict<interface,reference-count>
+        self.domainIpSetDict = dict()           # dict<set-name,fwmark>
+        self.domainIpSetRemoveList = []         # sets must be deleted after the rules referencing them
+        self.bDomainIpSetChanged = False
+        self.counterRefDict = dict()            # dict<counter-key,reference-count>, counter-key is next-hop address, or interface if there's no next-hop
+        self.counterNameDict = dict()           # dict<counter-key,counter-name>
+        self.counterSeq = 0
+        self.flowtableName = "ft"
+        self.cmdList = []                       # queued commands
+
+    def dispose(self):
+        self.cmdList = []
+        if self.bTableCreated:
+            self._nft("delete table inet %s\n" % (self.tableName))
+            self.bTableCreated = False
+        WrtUtil.forceDelete(self.scriptFile)
+        self.logger.info("Terminated.")
+
+    def is_empty(self):
+        retcode, out = WrtUtil.shell("/sbin/nft list table inet %s" % (self.tableName), "retcode+stdout")
+        return retcode != 0
+
+    def set_empty(self):
+        if not self.is_empty():
+            self._nft("delete table inet %s\n" % (self.tableName))
+
+    def add_gateway_interfaces(self, interfaceSet):
+        tlist = self._refAdd(self.gatewayRefDict, interfaceSet)
+        if len(tlist) > 0:
+            self.cmdList.append("add element inet %s gateway_ifs { %s }" % (self.tableName, self._ifnameList(tlist)))
+
+    def remove_gateway_interfaces(self, interfaceSet):
+        tlist = self._refRemove(self.gatewayRefDict, interfaceSet)
+        if len(tlist) > 0:
+            self.cmdList.append("delete element inet %s gateway_ifs { %s }" % (self.tableName, self._ifnameList(tlist)))
+
+    def add_wan_interface(self, interface):
+        tlist = self._refAdd(self.wanRefDict, [interface])
+        if len(tlist) > 0:
+            self.cmdList.append("add element inet %s wan_ifs { %s }" % (self.tableName, self._ifnameList(tlist)))
+
+    def remove_wan_interface(self, interface):
+        tlist = self._refRemove(self.wanRefDict, [interface])
+        if len(tlist) > 0:
+            self.cmdList.append("delete element inet %s wan_ifs { %s }" % (self.tableName, self._ifnameList(tlist)))
+
+    def support_domain_ip_set(self):
+        return True
+
+    def add_domain_ip_set(self, setName, fwmark):
+        assert setName not in self.domainIpSetDict
+        self.domainIpSetDict[setName] = fwmark
+        self.cmdList.append("add set inet %s %s { type ipv4_addr; flags timeout; timeout 1h; }" % (self.tableName, setName))
+        self.bDomainIpSetChanged = True
+
+    def remove_domain_ip_set(self, setName):
+        del self.domainIpSetDict[setName]
+        self.domainIpSetRemoveList.append(setName)
+        self.bDomainIpSetChanged = True
+
+    def get_dnsmasq_domain_ip_set_option(self, domain, setName):
+        return "nftset=/%s/4#inet#%s#%s" % (domain, self.tableName, setName)
+
+    def support_counter(self):
+        return True
+
+    def add_counters(self, targetSet):
+        # traffic with next-hop is counted by next-hop address, traffic without next-hop is counted by output interface
+        for key in self._refAdd(self.counterRefDict, [self._counterKey(x) for x in targetSet]):
+            self.counterSeq += 1
+            name = "cnt_%d" % (self.counterSeq)
+            self.counterNameDict[key] = name
+            self.cmdList.append("add counter inet %s %s" % (self.tableName, name))
+            self.cmdList.append("add element inet %s %s" % (self.tableName, self._counterMapElement(key, name)))
+            self.cmdList.append("add element inet %s %s" % (self.tableName, self._counterSetElement(key)))
+
+    def remove_counters(self, targetSet):
+        for key in self._refRemove(self.counterRefDict, [self._counterKey(x) for x in targetSet]):
+            name = self.counterNameDict.pop(key)
+            self.cmdList.append("delete element inet %s %s" % (self.tableName, self._counterSetElement(key)))
+            self.cmdList.append("delete element inet %s %s" % (self.tableName, self._counterMapElement(key, name)))
+            self.cmdList.append("delete counter inet %s %s" % (self.tableName, name))
+
+    def get_counters(self, targetSet):
+        ret = dict()
+        if not self.bTableCreated or len(self.counterNameDict) == 0:
+            return ret
+
+        counterDict = dict()
+        out = WrtUtil.shell("/sbin/nft -j list counters table inet %s" % (self.tableName), "stdout")
+        for item in json.loads(out)["nftables"]:
+            if "counter" in item:
+                counterDict[item["counter"]["name"]] = (item["counter"]["packets"], item["counter"]["bytes"])
+
+        for target in targetSet:
+            name = self.counterNameDict.get(self._counterKey(target))
+            if name in counterDict:
+                ret[target] = counterDict[name]
+        return ret
+
+    def support_flow_offload(self):
+        return True
+
+    def set_flow_offload_interfaces(self, interfaceSet):
+        # returns False if failed, flowtable devices are changed out of the queued transaction, an interface may disappear at any time,
+        # kernel removes a disappeared interface from flowtable by itself, so current devices are always read back from kernel
+        assert self.bTableCreated and self.param.flowOffload
+
+        out = WrtUtil.shell("/sbin/nft -j list flowtable inet %s %s" % (self.tableName, self.flowtableName), "stdout")
+        curSet = set()
+        for item in json.loads(out)["nftables"]:
+            if "flowtable" in item:
+                dev = item["flowtable"].get("dev", [])
+                curSet = set([dev] if isinstance(dev, str) else dev)
+
+        buf = ""
+        removeSet = set([x for x in curSet - interfaceSet if os.path.exists(os.path.join("/sys/class/net", x))])
+        if len(removeSet) > 0:
+            buf += "delete flowtable inet %s %s { devices = { %s }; }\n" % (self.tableName, self.flowtableName, self._ifnameList(sorted(removeSet)))
+        addSet = interfaceSet - curSet
+        if len(addSet) > 0:
+            buf += "add flowtable inet %s %s { hook ingress priority 0; devices = { %s }; }\n" % (self.tableName, self.flowtableName, self._ifnameList(sorted(addSet)))
+        if buf == "":
+            return True
+
+        try:
+            self._nft(buf)
+            return True
+        except Exception:
+            self.logger.warning("Failed to set flow offload interfaces.", exc_info=True)
+            return False
+
+    def get_flow_offload_stat(self):
+        # conntrack marks offloaded entries with [OFFLOAD] (or [HW_OFFLOAD])
+        if os.path.exists("/proc/net/nf_conntrack"):
+            with open("/proc/net/nf_conntrack", "r") as f:
+                lines = f.read().split("\n")
+        else:
+            retcode, out = WrtUtil.shell("/usr/sbin/conntrack -L", "retcode+stdout")
+            lines = out.split("\n") if retcode == 0 else []
+        ret = {
+            "flows": 0,
+            "offloaded-flows": 0,
+        }
+        for line in lines:
+            if " src=" in line:
+                ret["flows"] += 1
+                if "OFFLOAD]" in line:
+                    ret["offloaded-flows"] += 1
+        return ret
+
+    def commit(self):
+        if len(self.cmdList) == 0 and not self.bDomainIpSetChanged and self.bTableCreated:
+            return
+
+        buf = ""
+        if not self.bTableCreated:
+            buf += self._generateTable()
+        for cmd in self.cmdList:
+            buf += cmd + "\n"
+        if self.bDomainIpSetChanged:
+            # the whole chain is regenerated in the same transaction
+            buf += "flush chain inet %s domain_ip\n" % (self.tableName)
+            for setName, fwmark in sorted(self.domainIpSetDict.items()):
+                buf += "add rule inet %s domain_ip ip daddr @%s meta mark set 0x%x\n" % (self.tableName, setName, fwmark)
+        for setName in self.domainIpSetRemoveList:
+            buf += "delete set inet %s %s\n" % (self.tableName, setName)
+
+        # the transaction is all-or-nothing, queued changes are kept if it fails, so that they are applied by the next commit
+        self._nft(buf)
+        self.bTableCreated = True
+        self.domainIpSetRemoveList = []
+        self.cmdList = []
+        self.bDomainIpSetChanged = False
+
+    def _generateTable(self):
+        buf = ""
+        buf += "table inet %s {\n" % (self.tableName)
+        buf += "    set gateway_ifs {\n"
+        buf += "        type ifname\n"
+        buf += "    }\n"
+        buf += "    set wan_ifs {\n"
+        buf += "        type ifname\n"
+        buf += "    }\n"
+        buf += "    map nexthop_counters {\n"
+        buf += "        type ipv4_addr : counter\n"
+        buf += "    }\n"
+        buf += "    map interface_counters {\n"
+        buf += "        type ifname : counter\n"
+        buf += "    }\n"
+        buf += "    set counted_nexthops {\n"
+        buf += "        type ipv4_addr\n"
+        buf += "    }\n"
+        buf += "    set counted_ifs {\n"
+        buf += "        type ifname\n"
+        buf += "    }\n"
+        if self.param.flowOffload:
+            buf += "    flowtable %s {\n" % (self.flowtableName)
+            buf += "        hook ingress priority 0;\n"
+            buf += "    }\n"
+        buf += "    chain input {\n"
+        buf += "        type filter hook input priority 0; policy accept;\n"
+        buf += "        iifname @gateway_ifs ip protocol icmp accept\n"
+        buf += "        iifname @gateway_ifs ct state established,related accept\n"
+        buf += "        iifname @gateway_ifs drop\n"
+        buf += "    }\n"
+        buf += "    chain forward {\n"
+        buf += "        type filter hook forward priority 0; policy accept;\n"
+        buf += "        counter name rt ip nexthop map @nexthop_counters\n"
+        buf += "        counter name oifname map @interface_counters\n"
+        if self.param.flowOffload:
+            # packets of offloaded flows don't traverse this chain any more, so flows to counted targets are never offloaded
+            buf += "        rt ip nexthop != @counted_nexthops oifname != @counted_ifs meta l4proto { tcp, udp } flow add @%s\n" % (self.flowtableName)
+        buf += "    }\n"
+        buf += "    chain prerouting {\n"
+        buf += "        type filter hook prerouting priority -150; policy accept;\n"
+        buf += "        jump domain_ip\n"
+        buf += "    }\n"
+        buf += "    chain domain_ip {\n"
+        buf += "    }\n"
+        buf += "    chain postrouting {\n"
+        buf += "        type nat hook postrouting priority 100; policy accept;\n"
+        buf += "        oifname @wan_ifs masquerade\n"
+        buf += "        oifname @gateway_ifs masquerade\n"
+        buf += "    }\n"
+        buf += "}\n"
+        return buf
+
+    def _nft(self, buf):
+        with open(self.scriptFile, "w") as f:
+            f.write(buf)
+        WrtUtil.shell("/sbin/nft -f %s" % (self.scriptFile), "stdout")
+
+    def _refAdd(self, refDict, interfaceSet):
+        ret = []
+        for intf in interfaceSet:
+            if intf not in refDict:
+                refDict[intf] = 0
+                ret.append(intf)
+            refDict[intf] += 1
+        return ret
+
+    def _refRemove(self, refDict, interfaceSet):
+        ret = []
+        for intf in interfaceSet:
+            refDict[intf] -= 1
+            if refDict[intf] == 0:
+                del refDict[intf]
+                ret.append(intf)
+        return ret
+
+    def _counterKey(self, target):
+        nexthop, interface = target
+        return ("nexthop", nexthop) if nexthop is not None else ("interface", interface)
+
+    def _counterMapElement(self, key, name):
+        if key[0] == "nexthop":
+            return "nexthop_counters { %s : \"%s\" }" % (key[1], name)
+        else:
+            return "interface_counters { \"%s\" : \"%s\" }" % (key[1], name)
+
+    def _counterSetElement(self, key):
+        if key[0] == "nexthop":
+            return "counted_nexthops { %s }" % (key[1])
+        else:
+            return "counted_ifs { \"%s\" }" % (key[1])
+
+    def _ifnameList(self, interfaceList):
+        return ", ".join(["\"%s\"" % (x) for x in interfaceList])
+
+
+class WrtFirewallIptables:
+
+    """Rules are appended to the builtin chains, queued changes are committed table by table."""
+
+    def __init__(self, param):
+        self.param = param
+        self.logger = logging.getLogger(self.__module__ + "." + self.__class__.__name__)
+
+        self.gatewayRefDict = dict()            # dict<interface,reference-count>
+        self.wanRefDict = dict()                # dict<interface,reference-count>
+        # changes are queued for each table, so that a table committed successfully is not changed again when another table fails
+        self.gatewayFilterAddList = []
+        self.gatewayFilterRemoveList = []
+        self.gatewayNatAddList = []
+        self.gatewayNatRemoveList = []
+        self.wanAddList = []
+        self.wanRemoveList = []
+
+    def dispose(self):
+        self.logger.info("Terminated.")
+
+    def is_empty(self):
+        # iptc.Table.ALL contains "security" table which is very rare
+        for tname in ["filter", "mangle", "raw", "nat"]:
+            table = iptc.Table(tname)
+            for chain in table.chains:
+                if not table.builtin_chain(chain):
+                    return False
+                if chain.rules != []:
+                    return False
+        return True
+
+    def set_empty(self):
+        # iptc.Table.ALL contains "security" table which is very rare
+        for tname in ["filter", "mangle", "raw", "nat"]:
+            table = iptc.Table(tname)
+            table.flush()
+            for chain in table.chains:
+                chain.flush()
+
+    def add_gateway_interfaces(self, interfaceSet):
+        for intf in interfaceSet:
+            if intf not in self.gatewayRefDict:
+                self.gatewayRefDict[intf] = 0
+                self._queue(intf, self.gatewayFilterAddList, self.gatewayFilterRemoveList)
+                self._queue(intf, self.gatewayNatAddList, self.gatewayNatRemoveList)
+            self.gatewayRefDict[intf] += 1
+
+    def remove_gateway_interfaces(self, interfaceSet):
+        for intf in interfaceSet:
+            self.gatewayRefDict[intf] -= 1
+            if self.gatewayRefDict[intf] == 0:
+                del self.gatewayRefDict[intf]
+                self._queue(intf, self.gatewayFilterRemoveList, self.gatewayFilterAddList)
+                self._queue(intf, self.gatewayNatRemoveList, self.gatewayNatAddList)
+
+    def add_wan_interface(self, interface):
+        if interface not in self.wanRefDict:
+            self.wanRefDict[interface] = 0
+            self._queue(interface, self.wanAddList, self.wanRemoveList)
+        self.wanRefDict[interface] += 1
+
+    def remove_wan_interface(self, interface):
+        self.wanRefDict[interface] -= 1
+        if self.wanRefDict[interface] == 0:
+            del self.wanRefDict[interface]
+            self._queue(interface, self.wanRemoveList, self.wanAddList)
+
+    def support_domain_ip_set(self):
+        return False
+
+    def add_domain_ip_set(self, setName, fwmark):
+        assert False
+
+    def remove_domain_ip_set(self, setName):
+        assert False
+
+    def get_dnsmasq_domain_ip_set_option(self, domain, setName):
+        assert False
+
+    def support_counter(self):
+        return False
+
+    def add_counters(self, targetSet):
+        pass
+
+    def remove_counters(self, targetSet):
+        pass
+
+    def get_counters(self, targetSet):
+        return dict()
+
+    def support_flow_offload(self):
+        return False
+
+    def set_flow_offload_interfaces(self, interfaceSet):
+        assert False
+
+    def get_flow_offload_stat(self):
+        assert False
+
+    def commit(self):
+        # each table is committed as a whole, queued changes of a table are kept if it fails, so that they are applied by the next commit
+        if len(self.gatewayFilterRemoveList) > 0 or len(self.gatewayFilterAddList) > 0:
+            filterTable = iptc.Table(iptc.Table.FILTER)
+            filterTable.autocommit = False
+            try:
+                for intf in self.gatewayFilterRemoveList:
+                    for rule in self.__generateGatewayFwRulesFilterInputChain(intf):
+                        iptc.Chain(filterTable, "INPUT").delete_rule(rule)
+                for intf in self.gatewayFilterAddList:
+                    for rule in self.__generateGatewayFwRulesFilterInputChain(intf):
+                        iptc.Chain(filterTable, "INPUT").append_rule(rule)
+                filterTable.commit()
+            except BaseException:
+                filterTable.refresh()           # drop the uncommitted changes
+                raise
+            finally:
+                filterTable.autocommit = True
+            self.gatewayFilterRemoveList = []
+            self.gatewayFilterAddList = []
+
+        if len(self.gatewayNatRemoveList) > 0 or len(self.wanRemoveList) > 0 or len(self.gatewayNatAddList) > 0 or len(self.wanAddList) > 0:
+            natTable = iptc.Table(iptc.Table.NAT)
+            natTable.autocommit = False
+            try:
+                for intf in self.gatewayNatRemoveList + self.wanRemoveList:
+                    for rule in self.__generateFwRulesNatPostChain(intf):
+                        iptc.Chain(natTable, "POSTROUTING").delete_rule(rule)
+                for intf in self.gatewayNatAddList:
+                    for rule in self.__generateFwRulesNatPostChain(intf):
+                        iptc.Chain(natTable, "POSTROUTING").append_rule(rule)
+                for intf in self.wanAddList:
+                    for rule in self.__generateFwRulesNatPostChain(intf):
+                        iptc.Chain(natTable, "POSTROUTING").insert_rule(rule)
+                natTable.commit()
+            except BaseException:
+                natTable.refresh()
+                raise
+            finally:
+                natTable.autocommit = True
+            self.gatewayNatRemoveList = []
+            self.wanRemoveList = []
+            self.gatewayNatAddList = []
+            self.wanAddList = []
+
+    def _queue(self, intf, queueList, oppositeQueueList):
+        # an interface added and removed before commit is not touched, rules can't be deleted before they are added
+        if intf in oppositeQueueList:
+            oppositeQueueList.remove(intf)
+        else:
+            queueList.append(intf)
+
+    def __generateGatewayFwRulesFilterInputChain(self, gateway):
+        ret = []
+
+        rule = iptc.Rule()
+        rule.in_interface = gateway
+        rule.protocol = "icmp"
+        rule.create_target("ACCEPT")
+        ret.append(rule)
+
+        rule = iptc.Rule()
+        rule.in_interface = gateway
+        match = iptc.Match(rule, "state")
+        match.state = "ESTABLISHED,RELATED"
+        rule.add_match(match)
+        rule.create_target("ACCEPT")
+        ret.append(rule)
+
+        rule = iptc.Rule()
+        rule.in_interface = gateway
+        rule.create_target("DROP")
+        ret.append(rule)
+
+        return ret
+
+    def __generateFwRulesNatPostChain(self, interface):
+        rule = iptc.Rule()
+        rule.out_interface = interface
+        rule.create_target("MASQUERADE")
+        return [rule]
@@ -2,6 +2,7 @@
 # -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
 
 import os
+import sys
 import glob
 import signal
 import socket
@@ -9,7 +10,7 @@ import subprocess
 import logging
 import ipaddress
 import pyroute2
-from gi.repository import Gio
+from gi.repository import GLib
 from wrt_util import WrtUtil
 
 
@@ -26,9 +27,12 @@ class WrtLanManager:
 
         self.propDict = dict()              # dict<property-source,property-dict>
 
-        self.clientDict = dict()            # dict<ip,data>
-        self.clientSourceDict = dict()      # dict<ip,source_id>
+        self.hostRegistry = _HostRegistry()
         self.clientPropDict = dict()        # dict<ip,dict<property-source,property-dict>>
+        self.clientViewDict = dict()        # dict<ip,read-only-data>, client data merged with properties, dropped when any of them changes
+
+        self.bridgeList = []                # default bridge and bridges of vpn server plugins
+        self.hostSyncIdle = None
 
         try:
             # create default bridge
@@ -38,7 +42,8 @@ class WrtLanManager:
             WrtUtil.ensureDir(vardir)
             self.defaultBridge = _DefaultBridge(self, tmpdir, vardir)
             self.defaultBridge.init2("wrtd-br",
-                                     self.param.prefixPool.usePrefix(),
+                                     self.param.prefixPool.usePrefix(self.param.defaultBridgePrefixLen),
+                                     self.param.defaultBridgeDhcpPoolSize,
                                      self.param.trafficManager.get_l2_nameserver_port(),
                                      lambda source_id, ip_data_dict: self._clientAdd(source_id, ip_data_dict),
                                      lambda source_id, ip_data_dict: self._clientChange(source_id, ip_data_dict),
@@ -68,7 +73,7 @@ class WrtLanManager:
                             cfgObj,
                             tmpdir,
                             vardir,
-                            self.param.prefixPool.usePrefix(),
+                            self.param.prefixPool.usePrefix(cfgObj.get("prefix-length", 24)),     # dhcp pool size is configured in cfgObj as well, plugin handles it
                             self.param.trafficManager.get_l2_nameserver_port(),
                             lambda source_id, ip_data_dict: self._clientAdd(source_id, ip_data_dict),
                             lambda source_id, ip_data_dict: self._clientChange(source_id, ip_data_dict),
@@ -81,12 +86,15 @@ class WrtLanManager:
                         self.param.trafficManager.add_wan_service(p.full_name, p.get_wan_service())
 
             # send other-bridge-create event
-            all_bridges = [self.defaultBridge] + [x.get_bridge() for x in self.vpnsPluginList]
-            for bridge in all_bridges:
-                for other_bridge in all_bridges:
+            self.bridgeList = [self.defaultBridge] + [x.get_bridge() for x in self.vpnsPluginList]
+            for bridge in self.bridgeList:
+                for other_bridge in self.bridgeList:
                     if bridge == other_bridge:
                         continue
                     bridge.add_source(other_bridge.get_bridge_id())
+
+            # clients added during plugin startup
+            self._scheduleHostSync()
         except BaseException:
             self._dispose()
             raise
@@ -108,30 +116,29 @@ class WrtLanManager:
         if ip not in self.clientPropDict:
             self.clientPropDict[ip] = dict()
         self.clientPropDict[ip][property_source] = property_dict
+        self.clientViewDict.pop(ip, None)
 
-        if ip in self.clientDict:
+        if ip in self.hostRegistry.dataDict:
             data = self._clientDataFromIp(ip)
-            self.param.managerCaller.call("on_client_change", self.clientSourceDict[ip], data)
+            self.param.managerCaller.call("on_client_change", self.hostRegistry.sourceDict[ip], data)
 
     def remove_client_property(self, ip, property_source):
         del self.clientPropDict[ip][property_source]
         if len(self.clientPropDict[ip]) == 0:
             del self.clientPropDict[ip]
+        self.clientViewDict.pop(ip, None)
 
-        if ip in self.clientDict:
+        if ip in self.hostRegistry.dataDict:
             data = self._clientDataFromIp(ip)
-            self.param.managerCaller.call("on_client_change", self.clientSourceDict[ip], data)
+            self.param.managerCaller.call("on_client_change", self.hostRegistry.sourceDict[ip], data)
 
     def _clientAdd(self, source_id, ip_data_dict):
         assert len(ip_data_dict) > 0
 
-        self.clientDict.update(ip_data_dict)
+        self.hostRegistry.update(source_id, ip_data_dict)
         for ip in ip_data_dict:
-            self.clientSourceDict[ip] = source_id
-
-        for bridge in [self.defaultBridge] + [x.get_bridge() for x in self.vpnsPluginList]:
-            if source_id != bridge.get_bridge_id():
-                bridge.add_host(source_id, ip_data_dict)
+            self.clientViewDict.pop(ip, None)
+        self._scheduleHostSync()
 
         data = self._clientDataFromIpDataDict(ip_data_dict)
         self.param.managerCaller.call("on_client_add", source_id, data)
@@ -139,11 +146,10 @@ class WrtLanManager:
     def _clientChange(self, source_id, ip_data_dict):
         assert len(ip_data_dict) > 0
 
-        self.clientDict.update(ip_data_dict)
-
-        for bridge in [self.defaultBridge] + [x.get_bridge() for x in self.vpnsPluginList]:
-            if source_id != bridge.get_bridge_id():
-                bridge.change_host(source_id, ip_data_dict)
+        self.hostRegistry.update(source_id, ip_data_dict)
+        for ip in ip_data_dict:
+            self.clientViewDict.pop(ip, None)
+        self._scheduleHostSync()
 
         data = self._clientDataFromIpDataDict(ip_data_dict)
         self.param.managerCaller.call("on_client_change", source_id, data)
@@ -151,35 +157,50 @@ class WrtLanManager:
     def _clientRemove(self, source_id, ip_list):
         assert len(ip_list) > 0
 
+        self.hostRegistry.remove(ip_list)
         for ip in ip_list:
-            del self.clientDict[ip]
-            del self.clientSourceDict[ip]
-
-        for bridge in [self.defaultBridge] + [x.get_bridge() for x in self.vpnsPluginList]:
-            if source_id != bridge.get_bridge_id():
-                bridge.remove_host(source_id, ip_list)
+            self.clientViewDict.pop(ip, None)
+        self._scheduleHostSync()
 
         self.param.managerCaller.call("on_client_remove", source_id, ip_list)
 
+    def _scheduleHostSync(self):
+        # bridges are synced once after a burst of client events
+        if self.hostSyncIdle is None:
+            self.hostSyncIdle = GLib.idle_add(self._hostSyncIdleCallback)
+
+    def _hostSyncIdleCallback(self):
+        self.hostSyncIdle = None
+        sourceIdList = [x.get_bridge_id() for x in self.bridgeList]
+        for bridge in self.bridgeList:
+            try:
+                self.hostRegistry.sync_bridge(bridge, sourceIdList)
+            except Exception:
+                # the bridge keeps its generation, it is synced again with the next client event
+                self.logger.error("Failed to sync hosts to bridge \"%s\"." % (bridge.get_name()), exc_info=True)
+        self.hostRegistry.trim()
+        return False
+
     def _clientDataFromIpDataDict(self, ip_data_dict):
         ret = dict()
         for ip in ip_data_dict:
-            if ip in self.clientPropDict:
-                ret[ip] = self.clientDict[ip].copy()
-                for property_dict in self.clientPropDict[ip].values():
-                    ret[ip].update(property_dict)
-            else:
-                ret[ip] = self.clientDict[ip]
+            ret[ip] = self._clientView(ip)
         return ret
 
     def _clientDataFromIp(self, ip):
-        ret = dict()
-        if ip in self.clientPropDict:
-            ret[ip] = self.clientDict[ip].copy()
-            for property_dict in self.clientPropDict[ip].values():
-                ret[ip].update(property_dict)
-        else:
-            ret[ip] = self.clientDict[ip]
+        return {ip: self._clientView(ip)}
+
+    def _clientView(self, ip):
+        # managers get read-only views which are shared until the client changes, instead of a fresh copy for each event
+        ret = self.clientViewDict.get(ip)
+        if ret is None:
+            data = self.hostRegistry.dataDict[ip]
+            if ip in self.clientPropDict:
+                data = data.copy()
+                for property_dict in self.clientPropDict[ip].values():
+                    data.update(property_dict)
+            ret = _ReadOnlyDict(data)
+            self.clientViewDict[ip] = ret
         return ret
 
     def _getInstanceAndInfoFromEtcDir(self, pluginPrefix, cfgfilePrefix, name):
@@ -219,6 +240,11 @@ class WrtLanManager:
         return ret
 
     def _dispose(self):
+        if self.hostSyncIdle is not None:
+            GLib.source_remove(self.hostSyncIdle)
+            self.hostSyncIdle = None
+        self.bridgeList = []
+
         for p in self.vpnsPluginList:
             p.stop()
             self.logger.info("VPN server plugin \"%s\" deactivated." % (p.full_name))
@@ -235,6 +261,104 @@ class WrtLanManager:
             self.logger.info("Default bridge destroyed.")
 
 
+class _ReadOnlyDict(dict):
+
+    """dict which can't be modified, it is still a real dict, so that it can be serialized by json, pickle and dbus.
+       Unpickled object is a plain dict."""
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("read-only dict")
+
+    __setitem__ = _readonly
+    __delitem__ = _readonly
+    __ior__ = _readonly
+    clear = _readonly
+    pop = _readonly
+    popitem = _readonly
+    setdefault = _readonly
+    update = _readonly
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+class _HostRegistry:
+
+    """Authoritative client table, each bridge is synced from it by the changes after its last generation"""
+
+    def __init__(self):
+        self.generation = 0
+        self.dataDict = dict()                  # dict<ip, data>
+        self.sourceDict = dict()                # dict<ip, source-id>
+        self.changeLog = []                     # list<(generation, ip, source-id-before-change)>, source-id is None for added ip
+        self.changeLogStart = 0                 # self.changeLog has all the changes after this generation
+        self.bridgeGenDict = dict()             # dict<bridge-id, generation>
+
+    def update(self, source_id, ip_data_dict):
+        self.generation += 1
+        for ip, data in ip_data_dict.items():
+            self.changeLog.append((self.generation, ip, self.sourceDict.get(ip)))
+            self.dataDict[ip] = data
+            self.sourceDict[ip] = source_id
+
+    def remove(self, ip_list):
+        self.generation += 1
+        for ip in ip_list:
+            self.changeLog.append((self.generation, ip, self.sourceDict[ip]))
+            del self.dataDict[ip]
+            del self.sourceDict[ip]
+
+    def sync_bridge(self, bridge, source_id_list):
+        bridgeId = bridge.get_bridge_id()
+        lastGen = self.bridgeGenDict.get(bridgeId)
+        if lastGen == self.generation:
+            return
+
+        if lastGen is None or lastGen < self.changeLogStart:
+            # full sync for new bridge
+            ipDataDictDict = dict([(x, dict()) for x in source_id_list if x != bridgeId])
+            for ip, source_id in self.sourceDict.items():
+                if source_id in ipDataDictDict:
+                    ipDataDictDict[source_id][ip] = self.dataDict[ip]
+            for source_id, ipDataDict in ipDataDictDict.items():
+                bridge.refresh_host(source_id, ipDataDict)
+        else:
+            # the first change of an ip after lastGen tells what the bridge has, the current state tells what it should have
+            oldSourceDict = dict()
+            for gen, ip, oldSource in self.changeLog:
+                if gen > lastGen and ip not in oldSourceDict:
+                    oldSourceDict[ip] = oldSource
+
+            addDict = dict()            # dict<source-id, ip-data-dict>
+            changeDict = dict()         # dict<source-id, ip-data-dict>
+            removeDict = dict()         # dict<source-id, ip-list>
+            for ip, oldSource in oldSourceDict.items():
+                newSource = self.sourceDict.get(ip)
+                if oldSource is not None and oldSource != newSource and oldSource != bridgeId:
+                    removeDict.setdefault(oldSource, []).append(ip)
+                if newSource is not None and newSource != bridgeId:
+                    if oldSource == newSource:
+                        changeDict.setdefault(newSource, dict())[ip] = self.dataDict[ip]
+                    else:
+                        addDict.setdefault(newSource, dict())[ip] = self.dataDict[ip]
+
+            for source_id, ipList in removeDict.items():
+                bridge.remove_host(source_id, ipList)
+            for source_id, ipDataDict in addDict.items():
+                bridge.add_host(source_id, ipDataDict)
+            for source_id, ipDataDict in changeDict.items():
+                bridge.change_host(source_id, ipDataDict)
+
+        self.bridgeGenDict[bridgeId] = self.generation
+
+    def trim(self):
+        # changes that all the bridges have got are dropped
+        minGen = min(self.bridgeGenDict.values(), default=self.generation)
+        if minGen > self.changeLogStart:
+            self.changeLog = [x for x in self.changeLog if x[0] > minGen]
+            self.changeLogStart = minGen
+
+
 class _DefaultBridge:
 
     def __init__(self, pObj, tmpDir, varDir):
@@ -254,18 +378,34 @@ class _DefaultBridge:
         self.hostsDir = os.path.join(self.tmpDir, "hosts.d")
         self.leasesFile = os.path.join(self.tmpDir, "dnsmasq.leases")
         self.pidFile = os.path.join(self.tmpDir, "dnsmasq.pid")
+        self.leaseScriptFile = os.path.join(self.tmpDir, "dnsmasq.lease-script")
+        self.leaseEventSockFile = os.path.join(self.tmpDir, "lease-event.sock")
         self.dnsmasqProc = None
-        self.leaseMonitor = None
-        self.lastScanRecord = None
-
-    def init2(self, brname, prefix, l2dns_port, client_add_func, client_change_func, client_remove_func):
-        assert prefix[1] == "255.255.255.0"
-
+        self.leaseEventSock = None              # dnsmasq runs self.leaseScriptFile for each lease event, which sends the event to this socket
+        self.leaseEventWatch = None
+        self.leaseResyncInterval = 600          # 10 minutes, leases file is only read to check the events are not lost
+        self.leaseResyncTimer = None
+        self.leaseDict = None                   # dict<ip, lease>, lease is (expiry-time, mac, ip, hostname, client-id)
+        self.leaseMacDict = None                # dict<mac, ip>
+        self.hostDict = dict()                  # dict<source-id, dict<ip, hostname>>, in-memory copy of the files in self.hostsDir
+        self.hostDirtySet = set()               # set<source-id>
+        self.hostFlushDelay = 100               # 100 milliseconds, host changes in this window are flushed with one dnsmasq reload
+        self.hostFlushTimer = None
+        self.hostEventCount = 0                 # host changes since last flush
+
+    def init2(self, brname, prefix, dhcp_pool_size, l2dns_port, client_add_func, client_change_func, client_remove_func):
         self.brname = brname
         self.brnetwork = ipaddress.IPv4Network(prefix[0] + "/" + prefix[1])
 
+        # the first address is used by bridge interface, dhcp pool follows it
+        # pool size defaults to 49, or all the addresses if the prefix is smaller than that
         self.brip = ipaddress.IPv4Address(prefix[0]) + 1
-        self.dhcpRange = (self.brip + 1, self.brip + 49)
+        maxPoolSize = self.brnetwork.num_addresses - 3
+        if dhcp_pool_size is None:
+            dhcp_pool_size = min(49, maxPoolSize)
+        if not (1 <= dhcp_pool_size <= maxPoolSize):
+            raise Exception("invalid dhcp pool size %d for prefix %s" % (dhcp_pool_size, self.brnetwork))
+        self.dhcpRange = (self.brip + 1, self.brip + dhcp_pool_size)
 
         self.l2DnsPort = l2dns_port
         self.clientAddFunc = client_add_func
@@ -304,15 +444,18 @@ class _DefaultBridge:
         return (str(self.brnetwork.network_address), str(self.brnetwork.netmask))
 
     def add_source(self, source_id):
-        with open(os.path.join(self.hostsDir, source_id), "w") as f:
-            f.write("")
+        self.hostDict[source_id] = dict()
+        WrtUtil.dictToDnsmasqHostFile(self.hostDict[source_id], os.path.join(self.hostsDir, source_id))
 
     def remove_source(self, source_id):
-        os.unlink(os.path.join(self.hostsDir, source_id))
+        if len(self.hostDict.pop(source_id)) > 0:
+            self._hostChanged(source_id)                        # host file is deleted in flush
+        else:
+            self.hostDirtySet.discard(source_id)
+            os.unlink(os.path.join(self.hostsDir, source_id))
 
     def add_host(self, source_id, ip_data_dict):
-        fn = os.path.join(self.hostsDir, source_id)
-        itemDict = WrtUtil.dnsmasqHostFileToOrderedDict(fn)
+        itemDict = self.hostDict[source_id]
         bChanged = False
 
         for ip, data in ip_data_dict.items():
@@ -330,15 +473,13 @@ class _DefaultBridge:
                     bChanged = True
 
         if bChanged:
-            WrtUtil.dictToDnsmasqHostFile(itemDict, fn)
-            self.dnsmasqProc.send_signal(signal.SIGHUP)
+            self._hostChanged(source_id)
 
     def change_host(self, source_id, ip_data_dict):
         self.add_host(source_id, ip_data_dict)
 
     def remove_host(self, source_id, ip_list):
-        fn = os.path.join(self.hostsDir, source_id)
-        itemDict = WrtUtil.dnsmasqHostFileToOrderedDict(fn)
+        itemDict = self.hostDict[source_id]
         bChanged = False
 
         for ip in ip_list:
@@ -347,21 +488,41 @@ class _DefaultBridge:
                 bChanged = True
 
         if bChanged:
-            WrtUtil.dictToDnsmasqHostFile(itemDict, fn)
-            self.dnsmasqProc.send_signal(signal.SIGHUP)
+            self._hostChanged(source_id)
 
     def refresh_host(self, source_id, ip_data_dict):
-        fn = os.path.join(self.hostsDir, source_id)
-        itemDict = WrtUtil.dnsmasqHostFileToDict(fn)
-
         itemDict2 = dict()
         for ip, data in ip_data_dict.items():
             if "hostname" in data:
                 itemDict2[ip] = data["hostname"]
 
-        if itemDict != itemDict2:
-            WrtUtil.dictToDnsmasqHostFile(itemDict2, fn)
+        if self.hostDict[source_id] != itemDict2:
+            self.hostDict[source_id] = itemDict2
+            self._hostChanged(source_id)
+
+    def _hostChanged(self, source_id):
+        self.hostDirtySet.add(source_id)
+        self.hostEventCount += 1
+        if self.hostFlushTimer is None:
+            self.hostFlushTimer = GLib.timeout_add(self.hostFlushDelay, self._hostFlushTimerCallback)
+
+    def _hostFlushTimerCallback(self):
+        try:
+            for source_id in self.hostDirtySet:
+                fn = os.path.join(self.hostsDir, source_id)
+                if source_id in self.hostDict:
+                    WrtUtil.dictToDnsmasqHostFile(self.hostDict[source_id], fn)
+                else:
+                    WrtUtil.forceDelete(fn)
             self.dnsmasqProc.send_signal(signal.SIGHUP)
+            self.pObj.logger.debug("%d host changes of %d sources coalesced into one dnsmasq reload." % (self.hostEventCount, len(self.hostDirtySet)))
+        except Exception:
+            self.pObj.logger.error("Failed to flush host files", exc_info=True)
+        finally:
+            self.hostDirtySet = set()
+            self.hostEventCount = 0
+            self.hostFlushTimer = None
+        return False
 
     def _runDnsmasq(self):
         # myhostname file
@@ -375,6 +536,23 @@ class _DefaultBridge:
         with open(self.leasesFile, "w") as f:
             f.write("")
 
+        # lease event channel, created before dnsmasq starts
+        # the script runs synchronously in dnsmasq's helper process, datagram socket blocks it when events are not consumed
+        self.leaseEventSock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.leaseEventSock.bind(self.leaseEventSockFile)
+        self.leaseEventSock.setblocking(False)
+        self.leaseEventWatch = GLib.io_add_watch(self.leaseEventSock.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, self._dnsmasqLeaseEventCallback)
+        self.leaseDict = dict()
+        self.leaseMacDict = dict()
+        with open(self.leaseScriptFile, "w") as f:
+            f.write("#!%s -S\n" % (sys.executable))
+            f.write("import os, sys, socket\n")
+            f.write("args = (sys.argv[1:] + [\"\", \"\", \"\", \"\"])[:4]\n")            # action, mac, ip, hostname
+            f.write("args += [os.environ.get(\"DNSMASQ_LEASE_EXPIRES\", \"\"), os.environ.get(\"DNSMASQ_CLIENT_ID\", \"\")]\n")
+            f.write("s = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)\n")
+            f.write("s.sendto(\"\\t\".join(args).encode(\"utf-8\"), \"%s\")\n" % (self.leaseEventSockFile))
+        os.chmod(self.leaseScriptFile, 0o755)
+
         # generate dnsmasq config file
         buf = ""
         buf += "strict-order\n"
@@ -387,6 +565,7 @@ class _DefaultBridge:
         buf += "dhcp-range=%s,%s,%s,360\n" % (self.dhcpRange[0], self.dhcpRange[1], self.brnetwork.netmask)
         buf += "dhcp-option=option:T1,180\n"                             # strange that dnsmasq's T1=165s, change to 180s which complies to RFC
         buf += "dhcp-leasefile=%s\n" % (self.leasesFile)
+        buf += "dhcp-script=%s\n" % (self.leaseScriptFile)              # "old" is only sent when mac or hostname changes, no --script-on-renewal
         buf += "\n"
         buf += "domain-needed\n"
         buf += "bogus-priv\n"
@@ -406,87 +585,146 @@ class _DefaultBridge:
         cmd += " --pid-file=%s" % (self.pidFile)
         self.dnsmasqProc = subprocess.Popen(cmd, shell=True, universal_newlines=True)
 
-        # monitor dnsmasq lease file
-        self.leaseMonitor = Gio.File.new_for_path(self.leasesFile).monitor(0, None)
-        self.leaseMonitor.connect("changed", self._dnsmasqLeaseChanged)
-        self.lastScanRecord = []
+        self.leaseResyncTimer = GLib.timeout_add_seconds(self.leaseResyncInterval, self._dnsmasqLeaseResyncTimerCallback)
 
     def _stopDnsmasq(self):
-        self.lastScanRecord = None
-        if self.leaseMonitor is not None:
-            self.leaseMonitor.cancel()
-            self.leaseMonitor = None
+        if self.hostFlushTimer is not None:
+            GLib.source_remove(self.hostFlushTimer)
+            self.hostFlushTimer = None
+        self.hostDirtySet = set()
+        self.hostEventCount = 0
+        self.hostDict = dict()
+        if self.leaseResyncTimer is not None:
+            GLib.source_remove(self.leaseResyncTimer)
+            self.leaseResyncTimer = None
         if self.dnsmasqProc is not None:
             self.dnsmasqProc.terminate()
             self.dnsmasqProc.wait()
             self.dnsmasqProc = None
+        if self.leaseEventWatch is not None:
+            GLib.source_remove(self.leaseEventWatch)
+            self.leaseEventWatch = None
+        if self.leaseEventSock is not None:
+            self.leaseEventSock.close()
+            self.leaseEventSock = None
+        self.leaseDict = None
+        self.leaseMacDict = None
+        WrtUtil.forceDelete(self.leaseEventSockFile)
+        WrtUtil.forceDelete(self.leaseScriptFile)
         WrtUtil.forceDelete(self.pidFile)
         WrtUtil.forceDelete(self.leasesFile)
         WrtUtil.forceDelete(self.hostsDir)
         WrtUtil.forceDelete(self.myhostnameFile)
 
-    def _dnsmasqLeaseChanged(self, monitor, file, other_file, event_type):
-        if event_type != Gio.FileMonitorEvent.CHANGED:
-            return
-
+    def _dnsmasqLeaseEventCallback(self, fd, condition):
+        # events are handled idempotently, so that they can be mixed with resync
         try:
-            newLeaseList = WrtUtil.readDnsmasqLeaseFile(self.leasesFile)
-
-            addList = []
-            changeList = []
-            removeList = []
-            for item in newLeaseList:
-                item2 = self.___dnsmasqLeaseChangedFind(item, self.lastScanRecord)
-                if item2 is not None:
-                    if item[1] != item2[1] or item[3] != item2[3]:      # mac or hostname change
-                        changeList.append(item)
-                else:
-                    addList.append(item)
-            for item in self.lastScanRecord:
-                if self.___dnsmasqLeaseChangedFind(item, newLeaseList) is None:
-                    removeList.append(item)
-
-            if len(addList) > 0:
-                ipDataDict = dict()
-                for expiryTime, mac, ip, hostname, clientId in addList:
-                    self.__dnsmasqLeaseChangedAddToIpDataDict(ipDataDict, ip, mac, hostname)
-                    if hostname != "":
-                        self.pObj.logger.info("Client %s(IP:%s, MAC:%s) appeared." % (hostname, ip, mac))
-                    else:
-                        self.pObj.logger.info("Client %s(%s) appeared." % (ip, mac))
-                for expiryTime, mac, ip, hostname, clientId in changeList:
-                    self.__dnsmasqLeaseChangedAddToIpDataDict(ipDataDict, ip, mac, hostname)
-                    # log is not needed for client change
-                self.clientAddFunc(self.get_bridge_id(), ipDataDict)
-
-            if len(changeList) > 0:
-                ipDataDict = dict()
-                for expiryTime, mac, ip, hostname, clientId in changeList:
-                    self.__dnsmasqLeaseChangedAddToIpDataDict(ipDataDict, ip, mac, hostname)
-                    # log is not needed for client change
-                self.clientChangeFunc(self.get_bridge_id(), ipDataDict)
-
-            if len(removeList) > 0:
-                ipList = [x[2] for x in removeList]
-                self.clientRemoveFunc(self.get_bridge_id(), ipList)
-                for expiryTime, mac, ip, hostname, clientId in removeList:
-                    if hostname != "":
-                        self.pObj.logger.info("Client %s(IP:%s, MAC:%s) disappeared." % (hostname, ip, mac))
+            while True:
+                try:
+                    buf = self.leaseEventSock.recv(4096)
+                except BlockingIOError:
+                    break
+                action, mac, ip, hostname, expiryTime, clientId = buf.decode("utf-8").split("\t")
+                hostname = "" if hostname == "*" else hostname
+                lease = (expiryTime, mac, ip, hostname, clientId)
+
+                item = self.leaseDict.get(ip)
+                if action in ["add", "old"]:
+                    if item is None:
+                        self._dnsmasqLeaseApply([lease], [], [])
+                    elif item[1] != mac or item[3] != hostname:      # mac or hostname change
+                        self._dnsmasqLeaseApply([], [lease], [])
                     else:
-                        self.pObj.logger.info("Client %s(%s) disappeared." % (ip, mac))
-
-            self.lastScanRecord = newLeaseList
+                        self.leaseDict[ip] = lease
+                elif action == "del":
+                    if item is not None:
+                        self._dnsmasqLeaseApply([], [], [item])
         except Exception:
-            self.pObj.logger.error("Lease scan failed", exc_info=True)      # fixme
+            self.pObj.logger.error("Lease event processing failed", exc_info=True)
+        return True
 
-    def ___dnsmasqLeaseChangedFind(self, item, leaseList):
-        for item2 in leaseList:
-            if item2[2] == item[2]:     # compare by ip
-                return item2
-        return None
+    def _dnsmasqLeaseResyncTimerCallback(self):
+        try:
+            newLeaseDict = WrtUtil.readDnsmasqLeaseFileToDict(self.leasesFile)
+            addList, changeList, removeList = _Helper.diffLeaseDict(self.leaseDict, newLeaseDict)
+            if len(addList) + len(changeList) + len(removeList) > 0:
+                self.pObj.logger.warning("Lease events lost, %d added, %d changed, %d removed by resync." % (len(addList), len(changeList), len(removeList)))
+                self._dnsmasqLeaseApply(addList, changeList, removeList)
+        except Exception:
+            self.pObj.logger.error("Lease resync failed", exc_info=True)
+        return True
+
+    def _dnsmasqLeaseApply(self, addList, changeList, removeList):
+        # a client got another ip
+        movedDict = dict()          # dict<mac, old-lease>
+        for item in removeList:
+            del self.leaseDict[item[2]]
+            if self.leaseMacDict.get(item[1]) == item[2]:
+                del self.leaseMacDict[item[1]]
+            movedDict[item[1]] = item
+
+        if len(addList) > 0:
+            ipDataDict = dict()
+            for lease in addList:
+                expiryTime, mac, ip, hostname, clientId = lease
+                self.__dnsmasqLeaseChangedAddToIpDataDict(ipDataDict, ip, mac, hostname)
+                self.leaseDict[ip] = lease
+                self.leaseMacDict[mac] = ip
+                if mac in movedDict and hostname != "":
+                    self.pObj.logger.info("Client %s(MAC:%s) changed IP from %s to %s." % (hostname, mac, movedDict[mac][2], ip))
+                elif mac in movedDict:
+                    self.pObj.logger.info("Client %s changed IP from %s to %s." % (mac, movedDict[mac][2], ip))
+                elif hostname != "":
+                    self.pObj.logger.info("Client %s(IP:%s, MAC:%s) appeared." % (hostname, ip, mac))
+                else:
+                    self.pObj.logger.info("Client %s(%s) appeared." % (ip, mac))
+            self.clientAddFunc(self.get_bridge_id(), ipDataDict)
+
+        if len(changeList) > 0:
+            ipDataDict = dict()
+            for lease in changeList:
+                expiryTime, mac, ip, hostname, clientId = lease
+                self.__dnsmasqLeaseChangedAddToIpDataDict(ipDataDict, ip, mac, hostname)
+                oldMac = self.leaseDict[ip][1]
+                if oldMac != mac and self.leaseMacDict.get(oldMac) == ip:
+                    del self.leaseMacDict[oldMac]
+                self.leaseDict[ip] = lease
+                self.leaseMacDict[mac] = ip
+                # log is not needed for client change
+            self.clientChangeFunc(self.get_bridge_id(), ipDataDict)
+
+        if len(removeList) > 0:
+            ipList = [x[2] for x in removeList]
+            self.clientRemoveFunc(self.get_bridge_id(), ipList)
+            for expiryTime, mac, ip, hostname, clientId in removeList:
+                if self.leaseMacDict.get(mac) is not None:
+                    continue                # logged as ip change
+                if hostname != "":
+                    self.pObj.logger.info("Client %s(IP:%s, MAC:%s) disappeared." % (hostname, ip, mac))
+                else:
+                    self.pObj.logger.info("Client %s(%s) disappeared." % (ip, mac))
 
     def __dnsmasqLeaseChangedAddToIpDataDict(self, ipDataDict, ip, mac, hostname):
         ipDataDict[ip] = dict()
         ipDataDict[ip]["mac"] = mac
         if hostname != "":
             ipDataDict[ip]["hostname"] = hostname
+
+
+class _Helper:
+
+    @staticmethod
+    def diffLeaseDict(oldLeaseDict, newLeaseDict):
+        """Leases are compared by ip, a lease is changed if its mac or hostname is changed.
+           Returns (add-list, change-list, remove-list) of leases, in O(n)."""
+
+        addList = []
+        changeList = []
+        for ip, item in newLeaseDict.items():
+            item2 = oldLeaseDict.get(ip)
+            if item2 is None:
+                addList.append(item)
+            elif item[1] != item2[1] or item[3] != item2[3]:      # mac or hostname change
+                changeList.append(item)
+        removeList = [item for ip, item in oldLeaseDict.items() if ip not in newLeaseDict]
+        return (addList, changeList, removeList)
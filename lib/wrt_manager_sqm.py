@@ -0,0 +1,224 @@
+#!/usr/bin/python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+import os
+import logging
+import pyroute2
+from gi.repository import GLib
+from wrt_util import WrtUtil
+
+
+class WrtSqmManager:
+
+    # configuration file sqm.json:
+    # {
+    #     "wan": {"qdisc": "cake", "rate": "20mbit"},
+    #     "bridge": {
+    #         "wrtd-br": {"qdisc": "htb", "rate": "100mbit", "ceil": "200mbit"},
+    #     },
+    #     "tfac-group": {
+    #         "<group-name>": {"qdisc": "cake", "rate": "10mbit"},
+    #     },
+    # }
+    #
+    # only egress traffic is shaped:
+    # 1. shaping on WAN interface limits upload
+    # 2. shaping on bridges limits download of the clients behind them
+    # 3. shaping on gateway interfaces of a traffic facility group limits upload through them
+
+    def __init__(self, param):
+        self.param = param
+        self.cfgFile = os.path.join(self.param.etcDir, "sqm.json")
+        self.logger = logging.getLogger(self.__module__ + "." + self.__class__.__name__)
+
+        self.wanCfg = None
+        self.bridgeCfgDict = dict()             # dict<bridge-name, class-cfg>
+        self.tfacGroupCfgDict = dict()          # dict<group-name, class-cfg>
+
+        self.appliedDict = dict()               # dict<ifname, (ifindex, class-cfg)>
+
+        self.ipp = None
+        self.linkMonitor = None
+        self.linkMonitorWatch = None
+        try:
+            self._loadCfg()
+            if self.wanCfg is None and len(self.bridgeCfgDict) == 0 and len(self.tfacGroupCfgDict) == 0:
+                self.logger.info("No smart queue management configured.")
+                return
+
+            # qdiscs are re-applied when interfaces are re-created
+            self.ipp = pyroute2.IPRoute()
+            self.linkMonitor = pyroute2.IPRoute()
+            self.linkMonitor.bind(groups=pyroute2.netlink.rtnl.RTMGRP_LINK)
+            self.linkMonitorWatch = GLib.io_add_watch(self.linkMonitor.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, self._linkMonitorCallback)
+
+            self._sync()
+            self.logger.info("Smart queue management started.")
+        except BaseException:
+            self._dispose()
+            raise
+
+    def dispose(self):
+        self._dispose()
+        self.logger.info("Terminated.")
+
+    def on_wan_conn_up(self):
+        self._sync()
+
+    def on_wan_conn_down(self):
+        self._sync()
+
+    def on_tfac_group_gateway_changed(self):
+        self._sync()
+
+    def get_sqm_info(self):
+        """Returns dict<ifname, class-cfg> of the interfaces being shaped"""
+        return dict([(k, v[1]) for k, v in self.appliedDict.items()])
+
+    def _dispose(self):
+        if self.linkMonitorWatch is not None:
+            GLib.source_remove(self.linkMonitorWatch)
+            self.linkMonitorWatch = None
+        if self.linkMonitor is not None:
+            self.linkMonitor.close()
+            self.linkMonitor = None
+        if self.ipp is not None:
+            for ifname in list(self.appliedDict.keys()):
+                self._removeQdisc(ifname)
+            self.ipp.close()
+            self.ipp = None
+
+    def _loadCfg(self):
+        if not os.path.exists(self.cfgFile) or os.path.getsize(self.cfgFile) == 0:
+            return
+        cfgObj = WrtUtil.loadJsonEtcCfg(self.cfgFile)
+        if "wan" in cfgObj:
+            self.wanCfg = _SqmHelper.checkClassCfg(cfgObj["wan"])
+        for name, cfg in cfgObj.get("bridge", dict()).items():
+            self.bridgeCfgDict[name] = _SqmHelper.checkClassCfg(cfg)
+        for name, cfg in cfgObj.get("tfac-group", dict()).items():
+            self.tfacGroupCfgDict[name] = _SqmHelper.checkClassCfg(cfg)
+
+    def _getInterfaceCfgDict(self):
+        ret = dict()
+
+        # one interface may belong to several traffic facility groups, group with the smallest name wins
+        for name in sorted(self.tfacGroupCfgDict.keys(), reverse=True):
+            if self.param.trafficManager.has_tfac_group(name):
+                for ifname in self.param.trafficManager.get_tfac_group_gateway_interfaces(name):
+                    ret[ifname] = self.tfacGroupCfgDict[name]
+
+        if self.param.lanManager is not None:
+            for bridge in [self.param.lanManager.defaultBridge] + [x.get_bridge() for x in self.param.lanManager.vpnsPluginList]:
+                if bridge.get_name() in self.bridgeCfgDict:
+                    ret[bridge.get_name()] = self.bridgeCfgDict[bridge.get_name()]
+
+        if self.wanCfg is not None and self.param.wanManager.is_connected():
+            ret[self.param.wanManager.get_interface()] = self.wanCfg
+
+        return ret
+
+    def _sync(self):
+        if self.ipp is None:
+            return
+
+        cfgDict = self._getInterfaceCfgDict()
+
+        for ifname in list(self.appliedDict.keys()):
+            if ifname not in cfgDict:
+                self._removeQdisc(ifname)
+
+        for ifname, cfg in cfgDict.items():
+            ret = self.ipp.link_lookup(ifname=ifname)
+            if len(ret) == 0:
+                # interface does not exist now, applied when it appears
+                self.appliedDict.pop(ifname, None)
+                continue
+            if self.appliedDict.get(ifname) == (ret[0], cfg):
+                continue
+            try:
+                _SqmHelper.applyQdisc(self.ipp, ret[0], cfg)
+                self.appliedDict[ifname] = (ret[0], cfg)
+                self.logger.info("Smart queue management applied on interface \"%s\", qdisc %s, rate %s." % (ifname, cfg["qdisc"], cfg.get("rate", "unlimited")))
+            except pyroute2.NetlinkError:
+                self.appliedDict.pop(ifname, None)
+                self.logger.error("Failed to apply smart queue management on interface \"%s\"." % (ifname), exc_info=True)
+
+    def _removeQdisc(self, ifname):
+        ifindex = self.appliedDict.pop(ifname)[0]
+        if self.ipp.link_lookup(ifname=ifname) != [ifindex]:
+            return
+        try:
+            _SqmHelper.removeQdisc(self.ipp, ifindex)
+            self.logger.info("Smart queue management removed from interface \"%s\"." % (ifname))
+        except pyroute2.NetlinkError:
+            self.logger.error("Failed to remove smart queue management from interface \"%s\"." % (ifname), exc_info=True)
+
+    def _linkMonitorCallback(self, fd, condition):
+        try:
+            bChanged = False
+            for msg in self.linkMonitor.get():
+                if msg["event"] in ["RTM_NEWLINK", "RTM_DELLINK"]:
+                    bChanged = True
+            if bChanged:
+                self._sync()
+        except Exception:
+            self.logger.error("Error occured in link monitor callback", exc_info=True)
+        return True
+
+
+class _SqmHelper:
+
+    @staticmethod
+    def checkClassCfg(cfg):
+        qdisc = cfg.get("qdisc", "cake")
+        if qdisc == "cake":
+            pass
+        elif qdisc == "htb":
+            if "rate" not in cfg:
+                raise Exception("rate is needed for qdisc htb")
+        else:
+            raise Exception("invalid qdisc \"%s\"" % (qdisc))
+
+        ret = {"qdisc": qdisc}
+        if "rate" in cfg:
+            ret["rate"] = cfg["rate"]
+        if qdisc == "htb":
+            ret["ceil"] = cfg.get("ceil", ret["rate"])
+        return ret
+
+    @staticmethod
+    def applyQdisc(ipp, ifindex, cfg):
+        # root qdisc has handle 1:0, htb leaf class 1:10 has a fq_codel qdisc with handle 10:0
+        # kernel refuses to replace a qdisc with one of another kind, so the old root qdisc is deleted first,
+        # it may also be left by a previous run
+        kind = _SqmHelper._getRootQdiscKind(ipp, ifindex)
+        if cfg["qdisc"] == "cake":
+            if kind not in [None, "cake"]:
+                ipp.tc("del", kind, ifindex, 0x10000)
+            if "rate" in cfg:
+                ipp.tc("replace", "cake", ifindex, 0x10000, bandwidth=cfg["rate"])
+            else:
+                ipp.tc("replace", "cake", ifindex, 0x10000, unlimited=True)
+        elif cfg["qdisc"] == "htb":
+            if kind is not None:
+                ipp.tc("del", kind, ifindex, 0x10000)
+            ipp.tc("add", "htb", ifindex, 0x10000, default=0x10)
+            ipp.tc("add-class", "htb", ifindex, 0x10001, parent=0x10000, rate=cfg["ceil"], ceil=cfg["ceil"])
+            ipp.tc("add-class", "htb", ifindex, 0x10010, parent=0x10001, rate=cfg["rate"], ceil=cfg["ceil"])
+            ipp.tc("add", "fq_codel", ifindex, 0x100000, parent=0x10010)
+        else:
+            assert False
+
+    @staticmethod
+    def removeQdisc(ipp, ifindex):
+        kind = _SqmHelper._getRootQdiscKind(ipp, ifindex)
+        if kind is not None:
+            ipp.tc("del", kind, ifindex, 0x10000)
+
+    @staticmethod
+    def _getRootQdiscKind(ipp, ifindex):
+        for msg in ipp.get_qdiscs(index=ifindex):
+            if msg["parent"] == 0xFFFFFFFF and msg["handle"] == 0x10000:
+                return msg.get_attr("TCA_KIND")
+        return None
@@ -2,13 +2,22 @@
 # -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
 
 import os
+import json
+import time
+import errno
+import struct
+import socket
+import bisect
+import dbus
 import logging
+import ipaddress
 import pyroute2
 import subprocess
-import iptc
+import collections
 from gi.repository import GLib
 from gi.repository import GObject
 from wrt_util import WrtUtil
+from wrt_dns_forwarder import WrtDnsForwarder
 
 
 class WrtTrafficManager:
@@ -23,23 +32,90 @@ class WrtTrafficManager:
         self.wanServDict = dict()               # dict<name,json-object>
 
         self.tfacGroupDict = dict()             # dict<name, priority>
+        self.tfacGroupFacilityListDict = dict()     # dict<name, facility-list>
+        self.bBatch = False                     # dnsmasq update and firewall commit are done once at the end of a batch
 
-        self.routeFullDict = _NamePriorityKeyValueDict()
-        self.routeDict = dict()                 # dict<prefix, data>
+        self.routeTableBase = 10000             # each tfac group has its own routing table, table id is allocated from here
+        self.rulePriorityBase = 20000           # each tfac group has a policy rule, which priority is self.rulePriorityBase + 1 + group-priority
+        self.rulePriorityRange = 10000          # all the policy rules in [self.rulePriorityBase, self.rulePriorityBase + self.rulePriorityRange) are ours
+        self.routeProto = 201                   # private rtproto id, all our routes and nexthop objects are stamped with it
+        self.tfacGroupTableDict = dict()        # dict<owner, table-id>, owner is group name, or (group name, facility-name) for domain-gateway facility
+
+        self.bNexthopObject = False             # use kernel nexthop objects if available, fallback to per-route nexthop
+        self.nexthopIdBase = 10000
+        # key of self.nexthopDict is (name, facility-name) for single path facility, (name, facility-name, "group") and (name, facility-name, path-index) for multipath facility
+        self.nexthopDict = dict()               # dict<key, [nexthop-id, installed-target]>
+        self.nexthopGarbageSet = set()          # set<key>, nexthops to be deleted when their routes are gone
+        self.bNexthopVerify = False             # kernel removes nexthop objects when their interface goes down, check them after link changes
+        self.nexthopFailedSet = set()           # set<target>, nexthop objects failed in current refresh or retry cycle, not tried again in the same cycle
+        self.multipathDegradedSet = set()       # set<(name, facility-name)>, multipath facilities with some paths left out, re-evaluated when links change
+
+        self.tfacGatewayDict = dict()           # dict<owner, dict<facility-name, tuple<(nexthop, interface, weight)>>>, more than one path for multipath facility
+        self.routeFullDict = dict()             # dict<owner, dict<prefix, facility-name>>
+        self.routeDict = dict()                 # dict<owner, dict<prefix, data>>, data is nexthop-id, target or tuple of paths, None if the installed route is stale
+        self.routeRefreshStat = None            # (added, replaced, removed) of the last refresh cycle
         self.gatewayDict = dict()               # dict<name, set<interface>>
+        self.counterTargetDict = dict()         # dict<name, set<target>>, traffic to these targets is counted by firewall
+        self.counterSampleInterval = 10         # 10 seconds
+        self.counterSampleTimer = None
+        self.counterRing = collections.deque(maxlen=360)       # samples of the last hour
+        self.wanInterface = None
 
         self.domainNameserverFullDict = _NamePriorityKeyValueDict()
-        self.domainNameserverDict = dict()
+        self.domainNameserverResolver = _DomainValueResolver(self.domainNameserverFullDict, _Helper.DOMAIN_BLACKLISTED)
+        self.dnsmasqServerDict = dict()         # dict<domain, list<server-option>>, follows the changes of the compiled nameserver dict
+        self.bDomainNameserverDirty = False     # self.dnsmasqServerDict is not set to dnsmasq yet
 
+        self.domainIpFacilityDict = dict()      # dict<name, set<facility-name>>, the table id of a domain-gateway facility is also used as its fwmark
         self.domainIpFullDict = _NamePriorityKeyValueDict()
 
-        self.routeRefreshInterval = 10               # 10 seconds
-        self.routeRefreshTimer = GObject.timeout_add_seconds(self.routeRefreshInterval, self._routeRefreshTimerCallback)
+        self.routeChannel = None
+        self.routeRefreshInterval = 60               # 60 seconds, pending routes are retried by netlink events, periodical refresh is only a consistency check
+        self.routeRefreshTimer = None
+        self.routeReconcileTime = time.monotonic()  # routes are compared with kernel once in self.routeRefreshInterval, not in every refresh
+        self.bRouteReconcile = False                 # compare routes with kernel in next refresh, set after netlink errors
+        self.routeMonitor = None
+        self.routePendingSet = set()                 # set<(owner, prefix)>, routes can't be installed currently, retried when link, address or route changes
+        self.routeRetryDelay = 100                   # 100 milliseconds, to coalesce event bursts
+        self.routeRetryTimer = None
 
         self.dnsPort = WrtUtil.getFreeSocketPort("tcp")
         self.dnsmasqProc = None
+        self.dnsForwarder = None                # used instead of dnsmasq if configured
+        self.dnsmasqBusName = "org.fpemud.WRT.L2Dnsmasq"     # domain nameservers are pushed into the running process through DBus, so that its cache is kept
+        self.dnsmasqBusWatch = None
+        self.dnsmasqBusReady = False
+        self.dnsmasqRestartDelay = 1000         # 1 second, nftset changes in this window are applied with one dnsmasq restart
+        self.dnsmasqRestartTimer = None
+        self.dnsmasqStat = {
+            "start": 0,
+            "reconfigure": 0,
+            "reconfigure-failed": 0,
+            "reconfigure-queued": 0,            # changes made when dnsmasq is not on the bus yet
+            "restart-coalesced": 0,             # nftset changes merged into a pending restart
+        }
         try:
-            self._runDnsmasq()
+            self.routeChannel = _RouteChannel(self.logger, self._routeError, self.routeProto)
+            self.routeMonitor = _RouteMonitor(self.logger, self._routeEvent)
+            self.bNexthopObject = (WrtUtil.shell("/sbin/ip nexthop list", "retcode+stdout")[0] == 0)
+            if self.bNexthopObject:
+                self.logger.info("Kernel nexthop objects are used for gateway facilities.")
+            else:
+                self.logger.info("Kernel nexthop objects are not available, fallback to per-route nexthop.")
+            self._flushOwnRoutes()          # left by a previous run which was not terminated normally
+            if self.param.multipathHashPolicy is not None:
+                with open(self.param.procMultipathHashPolicyFile, "w") as f:
+                    f.write(str(_Helper.multipathHashPolicyToValue(self.param.multipathHashPolicy)))
+                self.logger.info("Multipath hash policy set to %s." % (self.param.multipathHashPolicy))
+            self.routeChannel.rule("add", table=254, priority=self.rulePriorityBase, suppress_prefixlen=0)     # routes in main table except default route take precedence over tfac groups
+            self.routeRefreshTimer = GObject.timeout_add_seconds(self.routeRefreshInterval, self._routeRefreshTimerCallback)
+            if self.param.firewall.support_counter():
+                self.counterSampleTimer = GObject.timeout_add_seconds(self.counterSampleInterval, self._counterSampleTimerCallback)
+
+            if self.param.l2NameserverBackend == "forwarder":
+                self.dnsForwarder = WrtDnsForwarder(self.dnsPort, self.param.ownResolvConf)
+            else:
+                self._runDnsmasq()
             self.logger.info("Level 2 nameserver started.")
         except BaseException:
             self._dispose()
@@ -67,71 +143,234 @@ class WrtTrafficManager:
 
     def add_tfac_group(self, name, priority, facility_list):
         assert name not in self.tfacGroupDict
+        self._checkTrafficFacilityListSupported(facility_list)
+
+        # the rule is added before any state is changed, so that a failure leaves nothing behind
+        table = self.tfacGroupTableDict[name] if name in self.tfacGroupTableDict else self._allocRouteTable()
+        self.routeChannel.rule("add", table=table, priority=self._getRulePriority(priority))
+        self.tfacGroupTableDict[name] = table
 
         self.tfacGroupDict[name] = priority
+        self.tfacGroupFacilityListDict[name] = facility_list
 
-        ret = self._trafficFacilityListToRouteFullDict(name, priority, facility_list)
-        if len(ret) > 0:
-            GLib.source_remove(self.routeRefreshTimer)
-            self.routeRefreshTimer = GObject.timeout_add_seconds(0, self._routeRefreshTimerCallback)
+        self.tfacGatewayDict[name] = self._getGatewayTargetDictFromTrafficFacilityList(facility_list)
+        self.routeFullDict[name] = self._trafficFacilityListToRouteFullDict(facility_list)
+        if len(self.routeFullDict[name]) > 0 or name in self.routeDict:
+            self._scheduleRouteRefresh()
 
         gatewaySet = self._getGatewaySetFromTrafficFacilityList(facility_list)
-        self._addGatewayFwRules(gatewaySet)
+        self.param.firewall.add_gateway_interfaces(gatewaySet)
         self.gatewayDict[name] = gatewaySet
+        self._notifyGatewayChanged()
 
-        ret = self._trafficFacilityListToDomainNameserverFullDict(name, priority, facility_list)
-        if len(ret) > 0:
-            self._stopDnsmasq()
-            self._runDnsmasq()
+        targetSet = self._getTargetSetFromTrafficFacilityList(facility_list)
+        self.param.firewall.add_counters(targetSet)
+        self.counterTargetDict[name] = targetSet
+
+        # the sets must exist before dnsmasq references them
+        self.domainIpFacilityDict[name] = set()
+        for facility in self._getDomainIpFacilityListFromTrafficFacilityList(facility_list):
+            self._addDomainIpFacility(name, facility)
+        self._commitFirewall()
+        self._trafficFacilityListToDomainIpFullDict(name, priority, facility_list)
+
+        self._trafficFacilityListToDomainNameserverFullDict(name, priority, facility_list)
+        self._updateDnsmasq()
 
     def change_tfac_group(self, name, facility_list):
         assert name in self.tfacGroupDict
+        self._checkTrafficFacilityListSupported(facility_list)
+        self.tfacGroupFacilityListDict[name] = facility_list
 
-        ret1 = self.routeFullDict.remove_by_name(name)
-        ret2 = self._trafficFacilityListToRouteFullDict(name, self.tfacGroupDict[name], facility_list)
-        if ret1 != ret2:
-            GLib.source_remove(self.routeRefreshTimer)
-            self.routeRefreshTimer = GObject.timeout_add_seconds(0, self._routeRefreshTimerCallback)
+        # when only the target of a facility is changed, routes are not touched, only its nexthop object is replaced
+        targetDict = self._getGatewayTargetDictFromTrafficFacilityList(facility_list)
+        routeFullDict = self._trafficFacilityListToRouteFullDict(facility_list)
+        if targetDict != self.tfacGatewayDict[name] or routeFullDict != self.routeFullDict[name]:
+            self.tfacGatewayDict[name] = targetDict
+            self.routeFullDict[name] = routeFullDict
+            self._scheduleRouteRefresh()
 
         gatewaySet = self._getGatewaySetFromTrafficFacilityList(facility_list)
-        self._removeGatewayFwRules(self.gatewayDict[name] - gatewaySet)
-        self._addGatewayFwRules(gatewaySet - self.gatewayDict[name])
-        self.gatewayDict[name] = gatewaySet
+        self.param.firewall.remove_gateway_interfaces(self.gatewayDict[name] - gatewaySet)
+        self.param.firewall.add_gateway_interfaces(gatewaySet - self.gatewayDict[name])
+        if gatewaySet != self.gatewayDict[name]:
+            self.gatewayDict[name] = gatewaySet
+            self._notifyGatewayChanged()
 
-        ret1 = self.domainNameserverFullDict.remove_by_name(name)
-        ret2 = self._trafficFacilityListToDomainNameserverFullDict(name, self.tfacGroupDict[name], facility_list)
-        if ret1 != ret2:
-            self._stopDnsmasq()
-            self._runDnsmasq()
+        targetSet = self._getTargetSetFromTrafficFacilityList(facility_list)
+        self.param.firewall.remove_counters(self.counterTargetDict[name] - targetSet)
+        self.param.firewall.add_counters(targetSet - self.counterTargetDict[name])
+        self.counterTargetDict[name] = targetSet
+
+        facilityDict = dict([(x["facility-name"], x) for x in self._getDomainIpFacilityListFromTrafficFacilityList(facility_list)])
+        for facilityName in self.domainIpFacilityDict[name] - set(facilityDict.keys()):
+            self._removeDomainIpFacility(name, facilityName)
+        for facilityName, facility in facilityDict.items():
+            if facilityName in self.domainIpFacilityDict[name]:
+                self._changeDomainIpFacility(name, facility)
+            else:
+                self._addDomainIpFacility(name, facility)
+        self._commitFirewall()
+        self.domainIpFullDict.remove_by_name(name)
+        self._trafficFacilityListToDomainIpFullDict(name, self.tfacGroupDict[name], facility_list)
+
+        self.domainNameserverFullDict.remove_by_name(name)
+        self._trafficFacilityListToDomainNameserverFullDict(name, self.tfacGroupDict[name], facility_list)
+        self._updateDnsmasq()
+
+    def change_tfac_group_priority(self, name, priority):
+        assert name in self.tfacGroupDict
+
+        if priority == self.tfacGroupDict[name]:
+            return
+
+        # add the new rules before deleting the old ones, so that there's no window without the rules
+        # new rules are removed if any of them can't be added, the group is kept unchanged
+        ruleList = [{"table": self.tfacGroupTableDict[name]}]
+        for facilityName in self.domainIpFacilityDict[name]:
+            table = self.tfacGroupTableDict[(name, facilityName)]
+            ruleList.append({"table": table, "fwmark": table})
+        addedList = []
+        try:
+            for kwargs in ruleList:
+                self.routeChannel.rule("add", priority=self._getRulePriority(priority), **kwargs)
+                addedList.append(kwargs)
+        except BaseException:
+            for kwargs in addedList:
+                self.routeChannel.rule("del", priority=self._getRulePriority(priority), **kwargs)
+            raise
+        for kwargs in ruleList:
+            self.routeChannel.rule("del", priority=self._getRulePriority(self.tfacGroupDict[name]), **kwargs)
+        self.tfacGroupDict[name] = priority
+
+        self.domainIpFullDict.change_priority_by_name(name, priority)
+        self.domainNameserverFullDict.change_priority_by_name(name, priority)
+        self._updateDnsmasq()
 
     def remove_tfac_group(self, name):
-        del self.tfacGroupDict[name]
+        assert name in self.tfacGroupDict
+        self._purgeTfacGroup(name)
 
-        ret = self.routeFullDict.remove_by_name(name)
-        if len(ret) > 0:
-            GLib.source_remove(self.routeRefreshTimer)
-            self.routeRefreshTimer = GObject.timeout_add_seconds(0, self._routeRefreshTimerCallback)
+    def batch_tfac_group(self, op_list):
+        """op_list is list<("add", name, priority, facility-list) or ("change", name, facility-list) or
+                          ("change-priority", name, priority) or ("remove", name)>.
+           Operations are applied as one transaction, rollbacked if any of them fails."""
 
-        self._removeGatewayFwRules(self.gatewayDict[name])
-        del self.gatewayDict[name]
+        assert not self.bBatch
 
-        ret = self.domainNameserverFullDict.remove_by_name(name)
-        if len(ret) > 0:
-            self._stopDnsmasq()
-            self._runDnsmasq()
+        # check all the operations before applying any of them
+        nameSet = set(self.tfacGroupDict.keys())
+        for op in op_list:
+            if op[0] == "add":
+                assert op[1] not in nameSet
+                self._checkTrafficFacilityListSupported(op[3])
+                nameSet.add(op[1])
+            elif op[0] == "change":
+                assert op[1] in nameSet
+                self._checkTrafficFacilityListSupported(op[2])
+            elif op[0] == "change-priority":
+                assert op[1] in nameSet
+            elif op[0] == "remove":
+                assert op[1] in nameSet
+                nameSet.remove(op[1])
+            else:
+                assert False
+
+        # route refresh is done in mainloop, so it's naturally done once for the whole batch
+        # firewall is committed before the batch becomes final, a failed commit also causes rollback
+        self.bBatch = True
+        try:
+            undoList = []           # list<(name, (priority, facility-list) or None)>, state of the group before each operation
+            try:
+                for op in op_list:
+                    if op[1] in self.tfacGroupDict:
+                        undoList.append((op[1], (self.tfacGroupDict[op[1]], self.tfacGroupFacilityListDict[op[1]])))
+                    else:
+                        undoList.append((op[1], None))
+                    self._doTfacGroupOperation(op)
+                self.param.firewall.commit()
+            except BaseException:
+                # the failed operation may be partly applied, the group is purged and re-added from its saved state
+                self.logger.error("Failed to apply traffic facility group operation, rollback.", exc_info=True)
+                for name, state in reversed(undoList):
+                    try:
+                        self._purgeTfacGroup(name)
+                        if state is not None:
+                            self.add_tfac_group(name, state[0], state[1])
+                    except BaseException:
+                        self.logger.error("Failed to rollback traffic facility group \"%s\"." % (name), exc_info=True)
+                try:
+                    self.param.firewall.commit()
+                except BaseException:
+                    self.logger.error("Failed to commit firewall after rollback.", exc_info=True)
+                raise
+        finally:
+            self.bBatch = False
+            self._updateDnsmasq()
 
     def on_wan_conn_up(self):
-        rule = iptc.Rule()
-        rule.out_interface = self.param.wanManager.get_interface()
-        rule.create_target("MASQUERADE")
-        iptc.Chain(iptc.Table(iptc.Table.NAT), "POSTROUTING").insert_rule(rule)        # this rule would be auto deleted when WAN conection is down
+        self.wanInterface = self.param.wanManager.get_interface()
+        self.param.firewall.add_wan_interface(self.wanInterface)
+        self.param.firewall.commit()
+
+    def on_wan_conn_down(self):
+        self.param.firewall.remove_wan_interface(self.wanInterface)
+        self.param.firewall.commit()
+        self.wanInterface = None
+
+    def get_tfac_group_gateway_interfaces(self, name):
+        return self.gatewayDict[name]
+
+    def get_traffic_counters(self):
+        """Returns list<sample>, sample is {"time": timestamp, "group": {name: {"packets", "bytes", "facility": {facility-name: {"packets", "bytes"}}}}}.
+           Counters are cumulative, facilities with the same target share the same counter."""
+        return list(self.counterRing)
 
-        # WrtUtil.shell('/sbin/nft add rule wrtd fw iifname %s ct state established,related accept' % (intf))
-        # WrtUtil.shell('/sbin/nft add rule wrtd fw iifname %s ip protocol icmp accept' % (intf))
-        # WrtUtil.shell('/sbin/nft add rule wrtd fw iifname %s drop' % (intf))
+    def get_l2_nameserver_stat(self):
+        if self.dnsForwarder is not None:
+            return self.dnsForwarder.get_stat()
+
+        ret = dict(self.dnsmasqStat)
+        if self.dnsmasqBusReady:
+            try:
+                obj = dbus.SystemBus().get_object(self.dnsmasqBusName, "/uk/org/thekelleys/dnsmasq")
+                for k, v in dbus.Interface(obj, "uk.org.thekelleys.dnsmasq").GetMetrics().items():
+                    ret[str(k)] = int(v)        # includes dnsmasq's counters of forwarded and unanswered queries
+            except dbus.exceptions.DBusException:
+                pass
+        return ret
 
     def _dispose(self):
+        if self.dnsForwarder is not None:
+            self.dnsForwarder.dispose()
+            self.dnsForwarder = None
+        if self.dnsmasqRestartTimer is not None:
+            GLib.source_remove(self.dnsmasqRestartTimer)
+            self.dnsmasqRestartTimer = None
         self._stopDnsmasq()
+        if self.routeRefreshTimer is not None:
+            GLib.source_remove(self.routeRefreshTimer)
+            self.routeRefreshTimer = None
+        if self.routeRetryTimer is not None:
+            GLib.source_remove(self.routeRetryTimer)
+            self.routeRetryTimer = None
+        if self.counterSampleTimer is not None:
+            GLib.source_remove(self.counterSampleTimer)
+            self.counterSampleTimer = None
+        if self.routeMonitor is not None:
+            self.routeMonitor.dispose()
+            self.routeMonitor = None
+        if self.routeChannel is not None:
+            if not self._flushOwnRoutes():
+                for key in sorted(self.nexthopDict.keys(), key=self._nexthopKeyOrder):
+                    nexthopId, target = self.nexthopDict[key]
+                    if target is not None:
+                        self._delNexthop(nexthopId)
+            self.routeDict = dict()
+            self.nexthopDict = dict()
+            self.nexthopGarbageSet = set()
+            self.routeChannel.dispose()
+            self.routeChannel = None
 
     def _runDnsmasq(self):
         # make hosts directory
@@ -152,9 +391,9 @@ class WrtTrafficManager:
         buf += "addn-hosts=%s\n" % (self.hostsDir)                       # "hostsdir=" only adds record, no deletion, so not usable
         buf += "\n"
         buf += "resolv-file=%s\n" % (self.param.ownResolvConf)
-        for domain, nsList in self.domainNameserverFullDict.get_dict().items():
-            for ns in nsList:
-                buf += "server=/%s/%s\n" % (domain, ns.replace(":", "#"))
+        buf += "\n"                                                        # domain nameservers are set through DBus after dnsmasq is on the bus, servers in config file can't be removed that way
+        for domain, setName in self.domainIpFullDict.get_dict().items():
+            buf += self.param.firewall.get_dnsmasq_domain_ip_set_option(domain, setName) + "\n"     # dnsmasq adds resolved addresses into the set
         buf += "\n"
         with open(self.cfgFile, "w") as f:
             f.write(buf)
@@ -165,9 +404,87 @@ class WrtTrafficManager:
         cmd += " --port=%d" % (self.dnsPort)
         cmd += " --conf-file=\"%s\"" % (self.cfgFile)
         cmd += " --pid-file=%s" % (self.pidFile)
+        cmd += " --enable-dbus=%s" % (self.dnsmasqBusName)
         self.dnsmasqProc = subprocess.Popen(cmd, shell=True, universal_newlines=True)
+        self.dnsmasqStat["start"] += 1
+
+        # domain nameservers are set when dnsmasq appears on the bus
+        self.bDomainNameserverDirty = (len(self.dnsmasqServerDict) > 0)
+        self.dnsmasqBusWatch = dbus.SystemBus().watch_name_owner(self.dnsmasqBusName, self._dnsmasqBusNameOwnerChanged)
+
+    def _updateDnsmasq(self):
+        if self.bBatch:
+            return
+
+        # a change of a non-winning value can also change the result of a blacklisted domain, so all the touched keys are resolved again
+        # only the changes of the compiled dict are applied
+        keySet = self.domainNameserverFullDict.pop_changed_keys()
+        if len(keySet) > 0:
+            changeDict = self.domainNameserverResolver.update(keySet)
+            if len(changeDict) > 0:
+                if self.dnsForwarder is not None:
+                    self.dnsForwarder.update_domain_dict(changeDict)
+                else:
+                    for domain, nsList in changeDict.items():
+                        if nsList is None:
+                            del self.dnsmasqServerDict[domain]
+                        elif len(nsList) > 0:
+                            self.dnsmasqServerDict[domain] = ["/%s/%s" % (domain, ns.replace(":", "#")) for ns in nsList]
+                        else:
+                            self.dnsmasqServerDict[domain] = ["/%s/#" % (domain)]         # blacklisted sub-domain, use upstream servers
+                    self.bDomainNameserverDirty = True
+
+        if self.dnsForwarder is not None:
+            return
+
+        if len(self.domainIpFullDict.pop_changes()) > 0:
+            # nftset can only be specified in config file and is not re-read by SIGHUP, a restart is needed, which is delayed to coalesce changes
+            self._scheduleDnsmasqRestart()
+        if self.bDomainNameserverDirty:
+            self._setDnsmasqDomainServers()
+
+    def _scheduleDnsmasqRestart(self):
+        if self.dnsmasqRestartTimer is not None:
+            self.dnsmasqStat["restart-coalesced"] += 1
+            return
+        self.dnsmasqRestartTimer = GLib.timeout_add(self.dnsmasqRestartDelay, self._dnsmasqRestartTimerCallback)
+
+    def _dnsmasqRestartTimerCallback(self):
+        self.dnsmasqRestartTimer = None
+        try:
+            self._stopDnsmasq()
+            self._runDnsmasq()
+        except Exception:
+            self.logger.error("Failed to restart level 2 nameserver.", exc_info=True)
+        return False
+
+    def _dnsmasqBusNameOwnerChanged(self, owner):
+        self.dnsmasqBusReady = (owner != "")
+        if self.dnsmasqBusReady and self.bDomainNameserverDirty:
+            self._setDnsmasqDomainServers()
+
+    def _setDnsmasqDomainServers(self):
+        if not self.dnsmasqBusReady:
+            self.dnsmasqStat["reconfigure-queued"] += 1
+            return
+
+        # SetDomainServers replaces all the servers set by DBus before, dnsmasq has no method to change part of them
+        serverList = [x for optionList in self.dnsmasqServerDict.values() for x in optionList]
+        try:
+            obj = dbus.SystemBus().get_object(self.dnsmasqBusName, "/uk/org/thekelleys/dnsmasq")
+            dbus.Interface(obj, "uk.org.thekelleys.dnsmasq").SetDomainServers(dbus.Array(serverList, signature="s"))
+            self.bDomainNameserverDirty = False
+            self.dnsmasqStat["reconfigure"] += 1
+        except dbus.exceptions.DBusException:
+            # retried when dnsmasq re-appears on the bus or on next change
+            self.dnsmasqStat["reconfigure-failed"] += 1
+            self.logger.error("Failed to set domain nameservers for level 2 nameserver.", exc_info=True)
 
     def _stopDnsmasq(self):
+        if self.dnsmasqBusWatch is not None:
+            self.dnsmasqBusWatch.cancel()
+            self.dnsmasqBusWatch = None
+        self.dnsmasqBusReady = False
         if self.dnsmasqProc is not None:
             self.dnsmasqProc.terminate()
             self.dnsmasqProc.wait()
@@ -176,188 +493,1138 @@ class WrtTrafficManager:
         WrtUtil.forceDelete(self.pidFile)
         WrtUtil.forceDelete(self.cfgFile)
 
+    def _commitFirewall(self):
+        if not self.bBatch:
+            self.param.firewall.commit()
+
+    def _notifyGatewayChanged(self):
+        # shaping on gateway interfaces follows the groups
+        if self.param.sqmManager is not None:
+            self.param.sqmManager.on_tfac_group_gateway_changed()
+
+    def _doTfacGroupOperation(self, op):
+        if op[0] == "add":
+            self.add_tfac_group(op[1], op[2], op[3])
+        elif op[0] == "change":
+            self.change_tfac_group(op[1], op[2])
+        elif op[0] == "change-priority":
+            self.change_tfac_group_priority(op[1], op[2])
+        elif op[0] == "remove":
+            self.remove_tfac_group(op[1])
+        else:
+            assert False
+
+    def _purgeTfacGroup(self, name):
+        # removes whatever exists of the group, so that it also cleans up a partly applied operation
+        # domain-gateway facilities are removed first, their rules are deleted by the group priority
+        for facilityName in list(self.domainIpFacilityDict.get(name, set())):
+            self._removeDomainIpFacility(name, facilityName)
+        self.domainIpFacilityDict.pop(name, None)
+
+        # routing table is freed after all the routes in it are removed
+        if name in self.tfacGroupDict:
+            self.routeChannel.rule("del", table=self.tfacGroupTableDict[name], priority=self._getRulePriority(self.tfacGroupDict[name]))
+        self.tfacGroupDict.pop(name, None)
+        self.tfacGroupFacilityListDict.pop(name, None)
+
+        self.tfacGatewayDict.pop(name, None)
+        self.routeFullDict.pop(name, None)
+        if name in self.routeDict:
+            self._scheduleRouteRefresh()
+        else:
+            self.tfacGroupTableDict.pop(name, None)
+
+        if name in self.gatewayDict:
+            self.param.firewall.remove_gateway_interfaces(self.gatewayDict.pop(name))
+            self._notifyGatewayChanged()
+
+        if name in self.counterTargetDict:
+            self.param.firewall.remove_counters(self.counterTargetDict.pop(name))
+
+        self._commitFirewall()
+        self.domainIpFullDict.remove_by_name(name)
+
+        self.domainNameserverFullDict.remove_by_name(name)
+        self._updateDnsmasq()
+
+    def _checkTrafficFacilityListSupported(self, facility_list):
+        if len(self._getDomainIpFacilityListFromTrafficFacilityList(facility_list)) > 0:
+            if not self.param.firewall.support_domain_ip_set():
+                raise Exception("domain-gateway facility is not supported by the current firewall backend")
+            if self.param.l2NameserverBackend != "dnsmasq":
+                raise Exception("domain-gateway facility is only supported by dnsmasq level 2 nameserver")
+
     def _getGatewaySetFromTrafficFacilityList(self, facility_list):
         ret = set()
         for item in facility_list:
-            if item["facility-type"] == "gateway":
-                nexthop, interface = item["target"]
-                if interface is not None:
-                    ret.add(interface)
+            if item["facility-type"] in ["gateway", "domain-gateway"]:
+                for nexthop, interface, weight in _Helper.targetToPathTuple(item["target"]):
+                    if interface is not None:
+                        ret.add(interface)
         return ret
 
-    def _trafficFacilityListToRouteFullDict(self, name, priority, facility_list):
+    def _getTargetSetFromTrafficFacilityList(self, facility_list):
+        # each path of a multipath facility has its own counter
         ret = set()
+        for item in facility_list:
+            if item["facility-type"] in ["gateway", "domain-gateway"]:
+                ret |= set([x[:2] for x in _Helper.targetToPathTuple(item["target"])])
+        return ret
+
+    def _getGatewayTargetDictFromTrafficFacilityList(self, facility_list):
+        ret = dict()
         for item in facility_list:
             if item["facility-type"] == "gateway":
-                for prefix in item["network-list"]:
-                    self.routeFullDict.set_key_value(name, priority, prefix, item["target"])
-                    ret.add(prefix)
+                ret[item["facility-name"]] = _Helper.targetToPathTuple(item["target"])
         return ret
 
+    def _trafficFacilityListToRouteFullDict(self, facility_list):
+        networkList = []
+        for item in facility_list:
+            if item["facility-type"] == "gateway":
+                networkList.append((item["network-list"], item.get("network-blacklist", []), item["facility-name"]))
+        return _Helper.compileNetworkList(networkList)
+
     def _trafficFacilityListToDomainNameserverFullDict(self, name, priority, facility_list):
+        # blacklisted domains are set first, so that they are overrided by the same domain in other facility of this group
+        # a blacklisted domain only drops the entries of this group, see _DomainValueResolver
         ret = set()
+        for item in facility_list:
+            if item["facility-type"] == "nameserver":
+                for domain in item.get("domain-blacklist", []):
+                    domain = _Helper.domainNormalize(domain)
+                    self.domainNameserverFullDict.set_key_value(name, priority, domain, _Helper.DOMAIN_BLACKLISTED)
+                    ret.add(domain)
         for item in facility_list:
             if item["facility-type"] == "nameserver":
                 for domain in item["domain-list"]:
+                    domain = _Helper.domainNormalize(domain)
                     self.domainNameserverFullDict.set_key_value(name, priority, domain, item["target"])
                     ret.add(domain)
         return ret
 
+    def _getDomainIpFacilityListFromTrafficFacilityList(self, facility_list):
+        return [x for x in facility_list if x["facility-type"] == "domain-gateway"]
+
     def _trafficFacilityListToDomainIpFullDict(self, name, priority, facility_list):
-        assert False
-        return False
+        ret = set()
+        for item in self._getDomainIpFacilityListFromTrafficFacilityList(facility_list):
+            setName = self._getDomainIpSetName(self.tfacGroupTableDict[(name, item["facility-name"])])
+            for domain in item["domain-list"]:
+                domain = _Helper.domainNormalize(domain)
+                self.domainIpFullDict.set_key_value(name, priority, domain, setName)
+                ret.add(domain)
+        return ret
+
+    def _addDomainIpFacility(self, name, facility):
+        # traffic to the addresses in the set is marked, marked traffic is routed by a dedicated table, which has a default route to the target
+        owner = (name, facility["facility-name"])
+        table = self.tfacGroupTableDict[owner] if owner in self.tfacGroupTableDict else self._allocRouteTable()
+        self.routeChannel.rule("add", table=table, fwmark=table, priority=self._getRulePriority(self.tfacGroupDict[name]))
+        self.tfacGroupTableDict[owner] = table
+
+        self.param.firewall.add_domain_ip_set(self._getDomainIpSetName(table), table)
+        self.tfacGatewayDict[owner] = {facility["facility-name"]: _Helper.targetToPathTuple(facility["target"])}
+        self.routeFullDict[owner] = {"0.0.0.0/0.0.0.0": facility["facility-name"]}
+        self._scheduleRouteRefresh()
+        self.domainIpFacilityDict[name].add(facility["facility-name"])
+
+    def _changeDomainIpFacility(self, name, facility):
+        owner = (name, facility["facility-name"])
+        target = _Helper.targetToPathTuple(facility["target"])
+        if self.tfacGatewayDict[owner][facility["facility-name"]] != target:
+            self.tfacGatewayDict[owner] = {facility["facility-name"]: target}
+            self._scheduleRouteRefresh()
+
+    def _removeDomainIpFacility(self, name, facilityName):
+        owner = (name, facilityName)
+        table = self.tfacGroupTableDict[owner]
+
+        if name in self.tfacGroupDict:
+            self.routeChannel.rule("del", table=table, fwmark=table, priority=self._getRulePriority(self.tfacGroupDict[name]))
+        self.param.firewall.remove_domain_ip_set(self._getDomainIpSetName(table))
+        del self.tfacGatewayDict[owner]
+        del self.routeFullDict[owner]
+        if owner in self.routeDict:
+            self._scheduleRouteRefresh()
+        else:
+            del self.tfacGroupTableDict[owner]
+        self.domainIpFacilityDict[name].remove(facilityName)
+
+    def _getDomainIpSetName(self, table):
+        return "domip_%d" % (table)
 
     def _routeRefreshTimerCallback(self):
         try:
-            newRouteDict = self.routeFullDict.get_dict()
+            addCount = 0
+            replaceCount = 0
+            removeCount = 0
+
+            # delete unused nexthop objects after the routes referencing them are gone
+            if len(self.nexthopGarbageSet) > 0 and not self.routeChannel.is_busy():
+                for key in sorted(self.nexthopGarbageSet, key=self._nexthopKeyOrder):
+                    nexthopId, target = self.nexthopDict.pop(key)
+                    if target is not None:
+                        self._delNexthop(nexthopId)
+                self.nexthopGarbageSet = set()
+
+            # installed routes are compared with the kernel periodically and after netlink errors, the differences are fixed below
+            # incremental refreshes triggered by changes don't dump kernel routes, the timer may fire a bit early so there's 1 second tolerance
+            bDue = (time.monotonic() - self.routeReconcileTime >= self.routeRefreshInterval - 1)
+            if (bDue or self.bRouteReconcile) and not self.routeChannel.is_busy():
+                self._reconcileRoutes()
+                self.routeReconcileTime = time.monotonic()
+                self.bRouteReconcile = False
+
+            # all the routes are re-evaluated
+            self.routePendingSet = set()
+            self.multipathDegradedSet = set()
+            self.nexthopFailedSet = set()
+
+            nexthopKeySet = set()
+            for name in set(self.routeDict.keys()) | set(self.routeFullDict.keys()):
+                table = self.tfacGroupTableDict[name]
+                oldRouteDict = self.routeDict.get(name, dict())
+
+                # resolve route data, nexthop object is created or replaced here
+                dataDict = dict()
+                for facilityName in self.tfacGatewayDict.get(name, dict()):
+                    dataDict[facilityName] = self._getFacilityRouteData(name, facilityName, nexthopKeySet)
+                newRouteDict = dict()
+                newRouteFacilityDict = self.routeFullDict.get(name, dict())
+                for prefix, facilityName in newRouteFacilityDict.items():
+                    newRouteDict[prefix] = dataDict[facilityName]
 
-            with pyroute2.IPRoute() as ipp:
                 # remove routes
-                for prefix in self.routeDict:
+                for prefix in oldRouteDict:
                     if prefix not in newRouteDict:
-                        try:
-                            ipp.route("del", dst=_Helper.prefixConvert(prefix))
-                        except pyroute2.netlink.exceptions.NetlinkError as e:
-                            if e.code == 3:     # message: No such process
-                                pass            # route does not exist, ignore
-                            else:
-                                raise
+                        self.routeChannel.route("del", (name, prefix), dst=_Helper.prefixConvert(prefix), table=table)
+                        removeCount += 1
 
                 # add or change routes
                 for prefix, data in list(newRouteDict.items()):
-                    nexthop, interface = data
-                    if interface is not None:
-                        idx_list = ipp.link_lookup(ifname=interface)
-                        if idx_list == []:
-                            del newRouteDict[prefix]
+                    if prefix not in oldRouteDict:                                          # add
+                        kwargs = self._routeDataToKwargs(data)
+                        if kwargs is None:
+                            del newRouteDict[prefix]        # interface does not exist, retry when it appears
+                            self.routePendingSet.add((name, prefix))
                             continue
-                        assert len(idx_list) == 1
-                        idx = idx_list[0]
+                        self.routeChannel.route("add", (name, prefix), dst=_Helper.prefixConvert(prefix), table=table, **kwargs)
+                        addCount += 1
+                    elif oldRouteDict[prefix] != data or data is None:                      # change
+                        kwargs = self._routeDataToKwargs(data)
+                        if kwargs is None:
+                            newRouteDict[prefix] = None     # interface does not exist, keep the old route and retry when it appears
+                            self.routePendingSet.add((name, prefix))
+                            continue
+                        self.routeChannel.route("replace", (name, prefix), dst=_Helper.prefixConvert(prefix), table=table, **kwargs)     # nexthop is switched atomically by kernel
+                        replaceCount += 1
 
-                    try:
-                        if prefix not in self.routeDict:                                    # add
-                            if nexthop is not None and interface is not None:
-                                ipp.route("add", dst=_Helper.prefixConvert(prefix), gateway=nexthop, oif=idx)
-                            elif nexthop is not None and interface is None:
-                                ipp.route("add", dst=_Helper.prefixConvert(prefix), gateway=nexthop)
-                            elif nexthop is None and interface is not None:
-                                ipp.route("add", dst=_Helper.prefixConvert(prefix), oif=idx)
-                            else:
-                                assert False
-                        else:                                                               # change
-                            pass        # fixme
-                    except pyroute2.netlink.exceptions.NetlinkError as e:
-                        if e.code == 17:                    # message: File exists
-                            del newRouteDict[prefix]        # route already exists, retry in next cycle
-                        elif e.code == 101:                 # message: Network is unreachable
-                            del newRouteDict[prefix]        # nexthop is invalid, retry in next cycle
-                        else:
-                            raise
-            self.routeDict = newRouteDict
+                if len(newRouteDict) > 0:
+                    self.routeDict[name] = newRouteDict
+                else:
+                    self.routeDict.pop(name, None)
+                    if name not in self.routeFullDict:
+                        del self.tfacGroupTableDict[name]       # no routes left in the table of a removed group or facility
+
+            # nexthop objects no longer used
+            for key in self.nexthopDict:
+                if key not in nexthopKeySet:
+                    self.nexthopGarbageSet.add(key)
+
+            # routes are sent in batches, errors are reported to self._routeError() asynchronously
+            self.routeChannel.commit()
+            self.routeRefreshStat = (addCount, replaceCount, removeCount)
+            if addCount + replaceCount + removeCount > 0:
+                self.logger.debug("Route refresh, %d added, %d replaced, %d removed." % (addCount, replaceCount, removeCount))
         except Exception:
             self.logger.error("Error occured in route refresh timer callback", exc_info=True)
         finally:
             self.routeRefreshTimer = GObject.timeout_add_seconds(self.routeRefreshInterval, self._routeRefreshTimerCallback)
             return False
 
-    def _addGatewayFwRules(self, gatewaySet):
-        filterTable = iptc.Table(iptc.Table.FILTER)
-        natTable = iptc.Table(iptc.Table.NAT)
-        filterTable.autocommit = False
-        natTable.autocommit = False
+    def _counterSampleTimerCallback(self):
         try:
-            for gateway in gatewaySet:
-                for rule in self.__generateGatewayFwRulesFilterInputChain(gateway):
-                    iptc.Chain(filterTable, "INPUT").append_rule(rule)
-                for rule in self.__generateGatewayFwRulesNatPostChain(gateway):
-                    iptc.Chain(natTable, "POSTROUTING").append_rule(rule)
-            filterTable.commit()
-            natTable.commit()
-        finally:
-            filterTable.autocommit = True
-            natTable.autocommit = True
-
-    def _removeGatewayFwRules(self, gatewaySet):
-        filterTable = iptc.Table(iptc.Table.FILTER)
-        natTable = iptc.Table(iptc.Table.NAT)
-        filterTable.autocommit = False
-        natTable.autocommit = False
+            targetSet = set()
+            for tset in self.counterTargetDict.values():
+                targetSet |= tset
+            counterDict = self.param.firewall.get_counters(targetSet)
+
+            sample = {
+                "time": time.time(),
+                "group": dict(),
+            }
+            for name, facilityList in self.tfacGroupFacilityListDict.items():
+                data = {
+                    "packets": 0,
+                    "bytes": 0,
+                    "facility": dict(),
+                }
+                for item in facilityList:
+                    if item["facility-type"] in ["gateway", "domain-gateway"]:
+                        packets, byteCount = 0, 0
+                        for target in set([x[:2] for x in _Helper.targetToPathTuple(item["target"])]):
+                            packets += counterDict.get(target, (0, 0))[0]
+                            byteCount += counterDict.get(target, (0, 0))[1]
+                        data["facility"][item["facility-name"]] = {"packets": packets, "bytes": byteCount}
+                for target in self.counterTargetDict[name]:
+                    packets, byteCount = counterDict.get(target, (0, 0))
+                    data["packets"] += packets
+                    data["bytes"] += byteCount
+                sample["group"][name] = data
+            self.counterRing.append(sample)
+        except Exception:
+            self.logger.error("Error occured in counter sample timer callback", exc_info=True)
+        return True
+
+    def _routeEvent(self, bLinkChanged):
+        if bLinkChanged:
+            self.routeChannel.invalidate_ifindex()
+            if len(self.nexthopDict) > 0:
+                self.bNexthopVerify = True
+        if len(self.routePendingSet) > 0 or len(self.multipathDegradedSet) > 0 or self.bNexthopVerify:
+            self._scheduleRouteRetry()
+
+    def _scheduleRouteRetry(self):
+        if self.routeRetryTimer is None:
+            self.routeRetryTimer = GObject.timeout_add(self.routeRetryDelay, self._routeRetryTimerCallback)
+
+    def _routeRetryTimerCallback(self):
+        # only pending routes are processed, routes still can't be installed are kept pending
+        self.routeRetryTimer = None
         try:
-            for gateway in gatewaySet:
-                for rule in self.__generateGatewayFwRulesFilterInputChain(gateway):
-                    iptc.Chain(filterTable, "INPUT").delete_rule(rule)
-                for rule in self.__generateGatewayFwRulesNatPostChain(gateway):
-                    iptc.Chain(natTable, "POSTROUTING").delete_rule(rule)
-            filterTable.commit()
-            natTable.commit()
-        finally:
-            filterTable.autocommit = True
-            natTable.autocommit = True
+            if self.bNexthopVerify:
+                self.bNexthopVerify = False
+                self._verifyNexthops()
 
-    def __generateGatewayFwRulesFilterInputChain(self, gateway):
-        ret = []
+            # route data is resolved once for each facility, nexthop object is created or replaced here
+            self.nexthopFailedSet = set()
+            nexthopKeySet = set()
+            dataDict = dict()                       # dict<(owner, facility-name), data>
+
+            # degraded multipath facilities are re-evaluated to get the left out paths back
+            # nexthop group is updated in place, routes referencing it are not touched
+            # other routes of the facility are replaced only when its live paths change
+            count = 0
+            for name, facilityName in list(self.multipathDegradedSet):
+                if facilityName not in self.tfacGatewayDict.get(name, dict()):
+                    self.multipathDegradedSet.discard((name, facilityName))
+                    continue
+                data = self._getFacilityRouteData(name, facilityName, nexthopKeySet)
+                dataDict[(name, facilityName)] = data
+                if data is None or isinstance(data, int):
+                    continue                        # no path left, routes are pending already
+                kwargs = self._routeDataToKwargs(data)
+                if kwargs is None:
+                    continue
+                routeDict = self.routeDict.get(name, dict())
+                for prefix, fname in self.routeFullDict.get(name, dict()).items():
+                    if fname == facilityName and prefix in routeDict and routeDict[prefix] != data:
+                        self.routeChannel.route("replace", (name, prefix), dst=_Helper.prefixConvert(prefix), table=self.tfacGroupTableDict[name], **kwargs)
+                        routeDict[prefix] = data
+                        count += 1
+
+            pendingSet = self.routePendingSet
+            self.routePendingSet = set()
+            for name, prefix in pendingSet:
+                facilityName = self.routeFullDict.get(name, dict()).get(prefix)
+                if facilityName is None:
+                    continue                        # removed
+                if (name, facilityName) not in dataDict:
+                    dataDict[(name, facilityName)] = self._getFacilityRouteData(name, facilityName, nexthopKeySet)
+                data = dataDict[(name, facilityName)]
+                if data is not None and self.routeDict.get(name, dict()).get(prefix) == data:
+                    continue                        # nothing changed
+                kwargs = self._routeDataToKwargs(data)
+                if kwargs is None:
+                    self.routePendingSet.add((name, prefix))
+                    continue
+                if name not in self.routeDict:
+                    self.routeDict[name] = dict()
+                command = "replace" if prefix in self.routeDict[name] else "add"
+                self.routeChannel.route(command, (name, prefix), dst=_Helper.prefixConvert(prefix), table=self.tfacGroupTableDict[name], **kwargs)
+                self.routeDict[name][prefix] = data
+                count += 1
+            self.routeChannel.commit()
+            if count > 0:
+                self.logger.debug("Route retry, %d routes sent, %d still pending." % (count, len(self.routePendingSet)))
+        except Exception:
+            self.logger.error("Error occured in route retry timer callback", exc_info=True)
+        return False
+
+    def _scheduleRouteRefresh(self):
+        GLib.source_remove(self.routeRefreshTimer)
+        self.routeRefreshTimer = GObject.timeout_add_seconds(0, self._routeRefreshTimerCallback)
+
+    def _allocRouteTable(self):
+        tableSet = set(self.tfacGroupTableDict.values())
+        ret = self.routeTableBase
+        while ret in tableSet:
+            ret += 1
+        return ret
+
+    def _getRulePriority(self, priority):
+        return self.rulePriorityBase + 1 + priority
+
+    def _getFacilityRouteData(self, name, facilityName, nexthopKeySet):
+        # returns nexthop-id, or target / tuple of paths if nexthop object is not usable, returns None if no path can be used currently
+        # paths of a multipath facility which can't be used currently are left out, the facility is recorded in self.multipathDegradedSet
+        pathTuple = self.tfacGatewayDict[name][facilityName]
+        if len(pathTuple) == 1:
+            target = pathTuple[0][:2]
+            if not self.bNexthopObject or target[1] is None:
+                return target                   # kernel requires device for gateway nexthop objects
+            return self._getNexthopObject((name, facilityName), target, nexthopKeySet)
+
+        if not self.bNexthopObject or any([x[1] is None for x in pathTuple]):
+            # multipath route, interface of each path must exist
+            livePathList = [x for x in pathTuple if x[1] is None or self.routeChannel.get_ifindex(x[1]) is not None]
+            ret = tuple(livePathList) if len(livePathList) > 0 else None
+        else:
+            # nexthop group, one RTM_NEWNEXTHOP message changes the paths of all the routes referencing it
+            livePathList = []
+            for i in range(0, len(pathTuple)):
+                nexthopId = self._getNexthopObject((name, facilityName, i), pathTuple[i][:2], nexthopKeySet)
+                if nexthopId is not None:
+                    livePathList.append((nexthopId, pathTuple[i][2]))
+            key = (name, facilityName, "group")
+            if len(livePathList) > 0:
+                ret = self._getNexthopObject(key, tuple(livePathList), nexthopKeySet)
+            else:
+                nexthopKeySet.add(key)          # keep the group, it's updated when paths come back
+                self.nexthopGarbageSet.discard(key)
+                ret = None
+
+        if len(livePathList) < len(pathTuple):
+            if (name, facilityName) not in self.multipathDegradedSet:
+                self.logger.debug("%d of %d paths are left out for facility \"%s\" of traffic facility group \"%s\"." % (len(pathTuple) - len(livePathList), len(pathTuple), facilityName, name))
+            self.multipathDegradedSet.add((name, facilityName))
+        else:
+            self.multipathDegradedSet.discard((name, facilityName))
+        return ret
+
+    def _getNexthopObject(self, key, target, nexthopKeySet):
+        # target is (nexthop, interface), or tuple<(nexthop-id, weight)> for nexthop group
+        # returns nexthop-id, returns None if the nexthop object can't be created currently
+        nexthopKeySet.add(key)
+        self.nexthopGarbageSet.discard(key)
+        if key not in self.nexthopDict:
+            self.nexthopDict[key] = [self._allocNexthopId(), None]
+
+        nexthopId, installedTarget = self.nexthopDict[key]
+        if installedTarget != target:
+            if target in self.nexthopFailedSet:
+                return None                 # already failed in this cycle
+            # one RTM_NEWNEXTHOP message switches all the routes referencing this nexthop object
+            cmd = "/sbin/ip nexthop replace id %d proto %d" % (nexthopId, self.routeProto)
+            if key[2:] == ("group",):
+                cmd += " group %s" % ("/".join(["%d,%d" % (x[0], x[1]) for x in target]))
+            else:
+                nexthop, interface = target
+                if nexthop is not None:
+                    cmd += " via %s" % (nexthop)
+                cmd += " dev %s" % (interface)
+            retcode, out = WrtUtil.shell(cmd, "retcode+stdout")
+            if retcode != 0:
+                self.logger.debug("Failed to create nexthop object for facility \"%s\" of traffic facility group \"%s\", %s" % (key[1], key[0], out.strip()))
+                self.nexthopFailedSet.add(target)
+                return None                 # interface does not exist or nexthop is invalid, retry in next cycle
+            self.nexthopDict[key][1] = target
+        return nexthopId
+
+    def _nexthopKeyOrder(self, key):
+        # nexthop groups are deleted before their member nexthops, kernel deletes a group when its last member is deleted
+        return 1 if len(key) == 3 and key[2] != "group" else 0
+
+    def _verifyNexthops(self):
+        retcode, out = WrtUtil.shell("/sbin/ip -j nexthop list", "retcode+stdout")
+        if retcode != 0:
+            return
+        idSet = set([x["id"] for x in json.loads(out)]) if out.strip() != "" else set()
+
+        for key, value in self.nexthopDict.items():
+            nexthopId, target = value
+            if target is None or nexthopId in idSet:
+                continue
+            value[1] = None
+            if self._nexthopKeyOrder(key) == 1:
+                # member nexthop is removed from its group by kernel, the group is re-evaluated
+                self.multipathDegradedSet.add(key[:2])
+            else:
+                # routes referencing it are deleted by kernel
+                routeDict = self.routeDict.get(key[0], dict())
+                for prefix in [k for k, v in routeDict.items() if v == nexthopId]:
+                    del routeDict[prefix]
+                    self.routePendingSet.add((key[0], prefix))
+
+    def _allocNexthopId(self):
+        idSet = set([x[0] for x in self.nexthopDict.values()])
+        ret = self.nexthopIdBase
+        while ret in idSet:
+            ret += 1
+        return ret
 
-        rule = iptc.Rule()
-        rule.in_interface = gateway
-        rule.protocol = "icmp"
-        rule.create_target("ACCEPT")
-        ret.append(rule)
-
-        rule = iptc.Rule()
-        rule.in_interface = gateway
-        match = iptc.Match(rule, "state")
-        match.state = "ESTABLISHED,RELATED"
-        rule.add_match(match)
-        rule.create_target("ACCEPT")
-        ret.append(rule)
-
-        rule = iptc.Rule()
-        rule.in_interface = gateway
-        rule.create_target("DROP")
-        ret.append(rule)
+    def _flushOwnRoutes(self):
+        # policy rules are flushed by priority range, then one filtered flush for routes and one for nexthop objects, returns False if nexthop objects are not flushed
+        try:
+            self.routeChannel.flush_rules(self.rulePriorityBase, self.rulePriorityBase + self.rulePriorityRange)
+        except Exception as e:
+            self.logger.warning("Failed to flush policy rules, %s" % (e))
+        retcode, out = WrtUtil.shell("/sbin/ip -4 route flush table all proto %d" % (self.routeProto), "retcode+stdout")
+        if retcode != 0:
+            self.logger.warning("Failed to flush routes, %s" % (out.strip()))
+        if not self.bNexthopObject:
+            return True
+        retcode, out = WrtUtil.shell("/sbin/ip nexthop flush protocol %d" % (self.routeProto), "retcode+stdout")
+        if retcode != 0:
+            self.logger.warning("Failed to flush nexthop objects, %s" % (out.strip()))
+            return False
+        return True
+
+    def _reconcileRoutes(self):
+        # kernel dump only contains our routes, routes installed by others are never touched
+        kernelDict = self.routeChannel.dump_routes()
+        tableOwnerDict = dict([(v, k) for k, v in self.tfacGroupTableDict.items()])
+        missingCount = 0
+        changedCount = 0
+        unknownCount = 0
+
+        for owner, routeDict in self.routeDict.items():
+            kRouteDict = kernelDict.pop(self.tfacGroupTableDict[owner], dict())
+            for prefix, data in routeDict.items():
+                kData = kRouteDict.pop(_Helper.prefixConvert(prefix), None)
+                if kData is None:
+                    if data is not None:
+                        missingCount += 1
+                    routeDict[prefix] = None            # replaced in this cycle, which also creates the route
+                elif data is not None and not self._routeDataMatch(data, kData):
+                    routeDict[prefix] = None
+                    changedCount += 1
+            for dst in kRouteDict:
+                self.routeChannel.route("del", (owner, dst), dst=dst, table=self.tfacGroupTableDict[owner])
+                unknownCount += 1
+
+        # routes in tables we don't own any more
+        for table, kRouteDict in kernelDict.items():
+            for dst in kRouteDict:
+                self.routeChannel.route("del", (tableOwnerDict.get(table), dst), dst=dst, table=table)
+                unknownCount += 1
+
+        if missingCount + changedCount + unknownCount > 0:
+            self.logger.warning("Route reconciliation, %d missing, %d changed, %d unknown." % (missingCount, changedCount, unknownCount))
+
+    def _routeDataMatch(self, data, kData):
+        nexthopId, gateway, oif, bMultipath = kData
+        if isinstance(data, int):
+            return nexthopId == data
+        if isinstance(data[0], tuple):
+            return bMultipath
+        nexthop, interface = data
+        if gateway != nexthop:
+            return False
+        if interface is not None and oif != self.routeChannel.get_ifindex(interface):
+            return False
+        return True
 
+    def _delNexthop(self, nexthopId):
+        retcode, out = WrtUtil.shell("/sbin/ip nexthop del id %d" % (nexthopId), "retcode+stdout")
+        if retcode != 0:
+            self.logger.warning("Failed to delete nexthop object %d, %s" % (nexthopId, out.strip()))
+
+    def _routeDataToKwargs(self, data):
+        # returns None if route can not be installed currently
+        if data is None:
+            return None
+        if isinstance(data, int):
+            return {"nh_id": data}
+
+        if isinstance(data[0], tuple):
+            multipath = []
+            for nexthop, interface, weight in data:
+                path = {"hops": weight - 1}
+                if nexthop is not None:
+                    path["gateway"] = nexthop
+                if interface is not None:
+                    idx = self.routeChannel.get_ifindex(interface)
+                    if idx is None:
+                        return None
+                    path["oif"] = idx
+                multipath.append(path)
+            return {"multipath": multipath}
+
+        nexthop, interface = data
+        ret = dict()
+        if nexthop is not None:
+            ret["gateway"] = nexthop
+        if interface is not None:
+            idx = self.routeChannel.get_ifindex(interface)
+            if idx is None:
+                return None
+            ret["oif"] = idx
+        assert len(ret) > 0
         return ret
 
-    def __generateGatewayFwRulesNatPostChain(self, gateway):
-        rule = iptc.Rule()
-        rule.out_interface = gateway
-        rule.create_target("MASQUERADE")
-        return [rule]
+    def _routeError(self, command, tag, code):
+        if code == errno.ENOBUFS:
+            # ACKs of a batch are lost, command and tag are None
+            self.bRouteReconcile = True
+            self._scheduleRouteRefresh()
+            return
+
+        name, prefix = tag
+        if command == "del":
+            if code == errno.ESRCH:                 # route does not exist, ignore
+                return
+        elif command in ["add", "replace"]:
+            if code in [errno.EEXIST, errno.ENETUNREACH, errno.ENODEV]:
+                # EEXIST: route already exists, replace it
+                # ENETUNREACH: nexthop is invalid, retry when link, address or route changes
+                # ENODEV: interface index is stale, retry with the new index
+                if code == errno.ENODEV:
+                    self.routeChannel.invalidate_ifindex()
+                if name in self.routeDict:
+                    if command == "add" and code != errno.EEXIST:
+                        self.routeDict[name].pop(prefix, None)
+                    elif prefix in self.routeDict[name]:
+                        self.routeDict[name][prefix] = None     # the old route is still there, replace it
+                self.routePendingSet.add((name, prefix))
+                if code != errno.ENETUNREACH:
+                    self._scheduleRouteRetry()
+                return
+        self.logger.error("Failed to %s route %s for traffic facility group \"%s\", %s." % (command, prefix, name, os.strerror(code)))
+        self.bRouteReconcile = True
 
 
 class _NamePriorityKeyValueDict:
 
+    """Each name sets values for keys with its priority, the value of a key is resolved by (priority, name), smallest wins.
+       Winners are maintained incrementally, changes of resolved values can be fetched by pop_changes()."""
+
     def __init__(self):
-        self.dictImpl = dict()
+        self.keyDict = dict()               # dict<key, (sorted-list<(priority, name)>, dict<name, value>)>
+        self.nameDict = dict()              # dict<name, (priority, set<key>)>
+        self.resultDict = dict()            # dict<key, value>, resolved value
+        self.changeDict = dict()            # dict<key, old-value>, keys whose resolved value may have changed since last pop_changes()
 
     def set_key_value(self, name, priority, key, value):
-        if key not in self.dictImpl:
-            self.dictImpl[key] = dict()
-        if priority not in self.dictImpl[key]:
-            self.dictImpl[key][priority] = dict()
-        self.dictImpl[key][priority][name] = value
+        if name not in self.nameDict:
+            self.nameDict[name] = (priority, set())
+        assert self.nameDict[name][0] == priority
+        self.nameDict[name][1].add(key)
+
+        if key not in self.keyDict:
+            self.keyDict[key] = ([], dict())
+        orderList, valueDict = self.keyDict[key]
+        if name not in valueDict:
+            bisect.insort(orderList, (priority, name))
+        valueDict[name] = value
+        self._resolve(key)
 
     def remove_by_name(self, name):
-        ret = set()
-        for key in list(self.dictImpl.keys()):
-            for priority in list(self.dictImpl[key].keys()):
-                if name in self.dictImpl[key][priority]:
-                    del self.dictImpl[key][priority][name]
-                    ret.add(key)
-                    if len(self.dictImpl[key][priority]) == 0:
-                        del self.dictImpl[key][priority]
-                        if len(self.dictImpl[key]) == 0:
-                            del self.dictImpl[key]
-        return ret
+        if name not in self.nameDict:
+            return set()
+        priority, keySet = self.nameDict.pop(name)
+        for key in keySet:
+            self._removeEntry(key, priority, name)
+            self._resolve(key)
+        return keySet
+
+    def change_priority_by_name(self, name, priority):
+        if name not in self.nameDict or self.nameDict[name][0] == priority:
+            return set()
+        oldPriority, keySet = self.nameDict[name]
+        self.nameDict[name] = (priority, keySet)
+        for key in keySet:
+            orderList = self.keyDict[key][0]
+            del orderList[bisect.bisect_left(orderList, (oldPriority, name))]
+            bisect.insort(orderList, (priority, name))
+            self._resolve(key)
+        return keySet
 
     def get_dict(self):
+        return self.resultDict
+
+    def pop_changes(self):
+        """Returns list<(key, old-value, new-value)>, value is None if the key does not exist"""
+        ret = []
+        for key, oldValue in self.changeDict.items():
+            newValue = self.resultDict.get(key)
+            if newValue != oldValue:
+                ret.append((key, oldValue, newValue))
+        self.changeDict = dict()
+        return ret
+
+    def pop_changed_keys(self):
+        """Returns set<key>, keys touched since last call, no matter whether their resolved values are changed"""
+        ret = set(self.changeDict.keys())
+        self.changeDict = dict()
+        return ret
+
+    def has_key(self, key):
+        return key in self.keyDict
+
+    def get_value_list(self, key):
+        """Returns list<(priority, name, value)> of the key in resolving order, empty list if the key does not exist"""
+        if key not in self.keyDict:
+            return []
+        orderList, valueDict = self.keyDict[key]
+        return [(priority, name, valueDict[name]) for priority, name in orderList]
+
+    def _removeEntry(self, key, priority, name):
+        orderList, valueDict = self.keyDict[key]
+        del orderList[bisect.bisect_left(orderList, (priority, name))]
+        del valueDict[name]
+        if len(orderList) == 0:
+            del self.keyDict[key]
+
+    def _resolve(self, key):
+        if key not in self.changeDict:
+            self.changeDict[key] = self.resultDict.get(key)
+        if key in self.keyDict:
+            orderList, valueDict = self.keyDict[key]
+            self.resultDict[key] = valueDict[orderList[0][1]]
+        else:
+            self.resultDict.pop(key, None)
+
+
+class _DomainValueResolver:
+
+    """Resolves the domain values in a _NamePriorityKeyValueDict, a domain covers all its sub-domains, just like dnsmasq's server=/domain/.
+       The value of a domain is the first non-blacklisted value set for it. If all of them are blacklisted, each name uses the value
+       of its nearest parent domain unless blacklisted by itself, the first one wins, so a blacklist only drops the entries of its own name.
+       [] (use upstream servers) if nothing left.
+       The compiled dict has the same effect, a domain is left out if its nearest parent domain has the same value,
+       or if its value is [] and it has no parent domain.
+       Only the sub-trees of the changed keys are resolved again."""
+
+    _BULK_CHANGE_COUNT = 1000
+
+    def __init__(self, fullDict, blacklistValue):
+        self.fullDict = fullDict
+        self.blacklistValue = blacklistValue
+        self.labelsList = []                # sorted list<reversed-labels> of all the keys, sub-domains follow their parent domain
+        self.resultDict = dict()            # dict<domain, value>, resolved value of all the keys
+        self.compiledDict = dict()          # dict<domain, value>
+
+    def get_compiled_dict(self):
+        return self.compiledDict
+
+    def update(self, keySet):
+        """keySet is the keys changed in fullDict since last call, which can be fetched by pop_changed_keys().
+           Returns dict<domain, value>, changes of the compiled dict, value is None if the domain is removed."""
+
+        # a key is in self.labelsList if and only if it is in self.resultDict
+        addList = []
+        removeSet = set()
+        for key in keySet:
+            if self.fullDict.has_key(key):
+                if key not in self.resultDict:
+                    addList.append(tuple(reversed(key.split("."))))
+            else:
+                if key in self.resultDict:
+                    removeSet.add(tuple(reversed(key.split("."))))
+        if len(addList) + len(removeSet) < self._BULK_CHANGE_COUNT:
+            for labels in removeSet:
+                del self.labelsList[bisect.bisect_left(self.labelsList, labels)]
+            for labels in addList:
+                bisect.insort(self.labelsList, labels)
+        else:
+            # sorting a list made of two sorted runs is cheap
+            if len(removeSet) > 0:
+                self.labelsList = [x for x in self.labelsList if x not in removeSet]
+            self.labelsList += sorted(addList)
+            self.labelsList.sort()
+
+        # changed keys and their sub-domains, a sub-tree inside another changed sub-tree is not walked again
+        # removed keys are not in self.labelsList, so they are always added
+        affectedList = []
+        rootLabels = None
+        for labels in sorted(tuple(reversed(x.split("."))) for x in keySet):
+            if rootLabels is not None and labels[:len(rootLabels)] == rootLabels:
+                if not self.fullDict.has_key(".".join(reversed(labels))):
+                    affectedList.append(labels)
+                continue
+            rootLabels = labels
+            affectedList.append(labels)
+            i = bisect.bisect_right(self.labelsList, labels)
+            while i < len(self.labelsList) and self.labelsList[i][:len(labels)] == labels:
+                affectedList.append(self.labelsList[i])
+                i += 1
+
+        for labels in affectedList:
+            domain = ".".join(reversed(labels))
+            if self.fullDict.has_key(domain):
+                self.resultDict[domain] = self._resolve(labels)
+            else:
+                self.resultDict.pop(domain, None)
+
+        # the compiled value of a domain only depends on itself and its nearest parent domain, which are both resolved above
         ret = dict()
-        for key, data in self.dictImpl.items():
-            priority = sorted(list(data.keys()))[0]
-            name = sorted(list(data[priority].keys()))[0]
-            ret[key] = data[priority][name]
+        for labels in affectedList:
+            domain = ".".join(reversed(labels))
+            value = self.resultDict.get(domain)
+            if value is not None and value == self._getParentValue(labels):
+                value = None
+            if value != self.compiledDict.get(domain):
+                if value is None:
+                    del self.compiledDict[domain]
+                else:
+                    self.compiledDict[domain] = value
+                ret[domain] = value
         return ret
 
+    def _resolve(self, labels):
+        value = None
+        nameDict = dict()                   # dict<name, (priority, value)>, value of each name from the nearest domain
+        for i in range(len(labels), 0, -1):
+            for priority, name, v in self.fullDict.get_value_list(".".join(reversed(labels[:i]))):
+                if value is None and i == len(labels) and v != self.blacklistValue:
+                    value = v
+                if name not in nameDict:
+                    nameDict[name] = (priority, v)
+        if value is None:
+            candidateList = sorted((p, n, v) for n, (p, v) in nameDict.items() if v != self.blacklistValue)
+            value = candidateList[0][2] if len(candidateList) > 0 else []
+        return value
+
+    def _getParentValue(self, labels):
+        for i in range(len(labels) - 1, 0, -1):
+            value = self.resultDict.get(".".join(reversed(labels[:i])))
+            if value is not None:
+                return value
+        return []
+
+
+class _RouteChannel:
+
+    """Long-lived rtnetlink channel.
+       Route messages are encoded into multi-message batches, one batch is in flight at a time,
+       ACKs are collected asynchronously in the GLib mainloop."""
+
+    _NLMSG_ERROR = 2
+    _NLMSG_DONE = 3
+    _RTM_NEWROUTE = 24
+    _RTM_GETROUTE = 26
+    _NLM_F_REQUEST = 0x1
+    _NLM_F_DUMP = 0x300
+    _SOL_NETLINK = 270
+    _NETLINK_GET_STRICT_CHK = 12
+    _RTA_DST = 1
+    _RTA_OIF = 4
+    _RTA_GATEWAY = 5
+    _RTA_MULTIPATH = 9
+    _RTA_TABLE = 15
+    _RTA_NH_ID = 30
+
+    def __init__(self, logger, error_func, proto):
+        self.logger = logger
+        self.errorFunc = error_func             # error_func(command, tag, errno), command and tag are None for errno.ENOBUFS
+        self.proto = proto                      # rtproto id of all the routes sent through this channel
+        self.batchSize = 1000                   # maximum message number in one batch
+
+        self.ipp = None                         # for synchronous queries
+        self.ipb = None                         # for message encoding
+        self.sock = None                        # for sending batches and receiving ACKs
+        self.sockWatch = None
+
+        self.ifindexDict = dict()               # dict<ifname,ifindex>, ifindex is None if the interface does not exist, invalidated when links change
+
+        self.seqDict = dict()                   # dict<seq,(command,tag)>, messages in self.ipb
+        self.batchQueue = []                    # list<(buf,seq-dict)>
+        self.inflightSeqDict = None             # dict<seq,(command,tag)>, messages waiting for ACK
+        self.inflightCount = None
+        self.inflightErrCount = None
+        self.inflightTime = None
+        self.lastBatchStat = None               # (message-count, error-count, seconds)
+
+        try:
+            self.ipp = pyroute2.IPRoute()
+            self.ipb = pyroute2.IPBatch()
+            self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1024 * 1024)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+            self.sock.bind((0, 0))
+            self.sock.setblocking(False)
+            self.sockWatch = GLib.io_add_watch(self.sock.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, self._recvCallback)
+        except BaseException:
+            self.dispose()
+            raise
+
+    def dispose(self):
+        if self.sockWatch is not None:
+            GLib.source_remove(self.sockWatch)
+            self.sockWatch = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.ipb = None
+        if self.ipp is not None:
+            self.ipp.close()
+            self.ipp = None
+
+    def get_ifindex(self, ifname):
+        # returns None if interface does not exist
+        if ifname not in self.ifindexDict:
+            idx_list = self.ipp.link_lookup(ifname=ifname)
+            if idx_list == []:
+                self.ifindexDict[ifname] = None
+            else:
+                assert len(idx_list) == 1
+                self.ifindexDict[ifname] = idx_list[0]
+        return self.ifindexDict[ifname]
+
+    def invalidate_ifindex(self, ifname=None):
+        if ifname is None:
+            self.ifindexDict = dict()
+        else:
+            self.ifindexDict.pop(ifname, None)
+
+    def rule(self, command, **kwargs):
+        # policy rules are few, they are sent synchronously
+        # adding an existing rule or deleting a non-existing rule is not an error, so that operations can be retried
+        try:
+            self.ipp.rule(command, **kwargs)
+        except pyroute2.NetlinkError as e:
+            if command == "add" and e.code == errno.EEXIST:
+                return
+            if command == "del" and e.code == errno.ENOENT:
+                return
+            raise
+
+    def flush_rules(self, priority_start, priority_end):
+        # rules carry no protocol id on older kernels, so every IPv4 rule in the priority range is deleted
+        for msg in self.ipp.get_rules(family=socket.AF_INET):
+            priority = msg.get_attr("FRA_PRIORITY")
+            if priority is None or not (priority_start <= priority < priority_end):
+                continue
+            kwargs = {
+                "priority": priority,
+                "table": msg.get_attr("FRA_TABLE") or msg["table"],
+            }
+            if msg.get_attr("FRA_FWMARK") is not None:
+                kwargs["fwmark"] = msg.get_attr("FRA_FWMARK")
+            self.rule("del", **kwargs)
+
+    def is_busy(self):
+        return self.inflightSeqDict is not None or len(self.batchQueue) > 0 or len(self.seqDict) > 0
+
+    def route(self, command, tag, **kwargs):
+        # deleting with protocol specified never removes routes of others
+        offset = len(self.ipb.batch)
+        self.ipb.route(command, proto=self.proto, **kwargs)
+        seq = struct.unpack_from("=I", self.ipb.batch, offset + 8)[0]      # struct nlmsghdr {len, type, flags, seq, pid}
+        self.seqDict[seq] = (command, tag)
+        if len(self.seqDict) >= self.batchSize:
+            self._closeBatch()
+
+    def dump_routes(self):
+        """Returns dict<table, dict<dst, (nexthop-id, gateway, oif, is-multipath)>>, dst is in "a.b.c.d/len" format.
+           Only IPv4 routes with our protocol id are returned, they are filtered by kernel if strict checking is supported."""
+
+        ret = dict()
+        with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+            try:
+                sock.setsockopt(self._SOL_NETLINK, self._NETLINK_GET_STRICT_CHK, 1)
+            except OSError:
+                pass                            # kernel older than 4.20 dumps all the routes, filtered below
+            sock.bind((0, 0))
+
+            # struct nlmsghdr {len, type, flags, seq, pid}, struct rtmsg {family, dst_len, src_len, tos, table, protocol, scope, type, flags}
+            body = struct.pack("=BBBBBBBBI", socket.AF_INET, 0, 0, 0, 0, self.proto, 0, 0, 0)
+            sock.send(struct.pack("=IHHII", 16 + len(body), self._RTM_GETROUTE, self._NLM_F_REQUEST | self._NLM_F_DUMP, 1, 0) + body)
+
+            while True:
+                buf = sock.recv(1024 * 1024)
+                offset = 0
+                while offset + 16 <= len(buf):
+                    msgLen, msgType = struct.unpack_from("=IH", buf, offset)
+                    if msgLen < 16:
+                        break
+                    if msgType == self._NLMSG_DONE:
+                        return ret
+                    if msgType == self._NLMSG_ERROR:
+                        code = -struct.unpack_from("=i", buf, offset + 16)[0]
+                        raise OSError(code, os.strerror(code))
+                    if msgType == self._RTM_NEWROUTE:
+                        self._parseRoute(buf, offset, msgLen, ret)
+                    offset += (msgLen + 3) & ~3
+
+    def commit(self):
+        if len(self.seqDict) > 0:
+            self._closeBatch()
+        if self.inflightSeqDict is None:
+            self._sendBatch()
+
+    def _parseRoute(self, buf, offset, msgLen, ret):
+        family, dstLen, srcLen, tos, table, protocol = struct.unpack_from("=BBBBBB", buf, offset + 16)
+        if family != socket.AF_INET or protocol != self.proto:
+            return
+
+        dst = "0.0.0.0"
+        nexthopId = None
+        gateway = None
+        oif = None
+        bMultipath = False
+        attrOffset = offset + 16 + 12
+        while attrOffset + 4 <= offset + msgLen:
+            attrLen, attrType = struct.unpack_from("=HH", buf, attrOffset)
+            if attrLen < 4:
+                break
+            if attrType == self._RTA_DST:
+                dst = socket.inet_ntoa(buf[attrOffset + 4:attrOffset + 8])
+            elif attrType == self._RTA_OIF:
+                oif = struct.unpack_from("=I", buf, attrOffset + 4)[0]
+            elif attrType == self._RTA_GATEWAY:
+                gateway = socket.inet_ntoa(buf[attrOffset + 4:attrOffset + 8])
+            elif attrType == self._RTA_MULTIPATH:
+                bMultipath = True
+            elif attrType == self._RTA_TABLE:
+                table = struct.unpack_from("=I", buf, attrOffset + 4)[0]
+            elif attrType == self._RTA_NH_ID:
+                nexthopId = struct.unpack_from("=I", buf, attrOffset + 4)[0]
+            attrOffset += (attrLen + 3) & ~3
+
+        if table not in ret:
+            ret[table] = dict()
+        ret[table]["%s/%d" % (dst, dstLen)] = (nexthopId, gateway, oif, bMultipath)
+
+    def _closeBatch(self):
+        self.batchQueue.append((bytes(self.ipb.batch), self.seqDict))
+        self.ipb.reset()
+        self.seqDict = dict()
+
+    def _sendBatch(self):
+        if len(self.batchQueue) == 0:
+            return
+        buf, seqDict = self.batchQueue.pop(0)
+        self.inflightSeqDict = seqDict
+        self.inflightCount = len(seqDict)
+        self.inflightErrCount = 0
+        self.inflightTime = time.monotonic()
+        self.sock.send(buf)
+
+    def _batchComplete(self):
+        elapsed = time.monotonic() - self.inflightTime
+        self.lastBatchStat = (self.inflightCount, self.inflightErrCount, elapsed)
+        self.logger.debug("Route batch completed, %d messages (%d failed) in %.3f seconds, %.0f messages/s." %
+                          (self.inflightCount, self.inflightErrCount, elapsed, self.inflightCount / max(elapsed, 0.000001)))
+        self.inflightSeqDict = None
+        self.inflightCount = None
+        self.inflightErrCount = None
+        self.inflightTime = None
+        self._sendBatch()
+
+    def _recvCallback(self, fd, condition):
+        try:
+            while self.inflightSeqDict is not None:
+                try:
+                    buf = self.sock.recv(65536)
+                except BlockingIOError:
+                    break
+                except OSError as e:
+                    if e.errno == errno.ENOBUFS:
+                        # ACKs are lost, the remaining routes are verified in next refresh cycle
+                        self.logger.warning("Route batch ACKs overflowed, %d ACKs lost." % (len(self.inflightSeqDict)))
+                        self._batchComplete()
+                        self.errorFunc(None, None, errno.ENOBUFS)
+                        continue
+                    raise
+
+                offset = 0
+                while offset + 16 <= len(buf):
+                    msgLen, msgType, msgFlags, msgSeq, msgPid = struct.unpack_from("=IHHII", buf, offset)
+                    if msgLen < 16:
+                        break
+                    if msgType == self._NLMSG_ERROR and msgSeq in self.inflightSeqDict:
+                        code = -struct.unpack_from("=i", buf, offset + 16)[0]
+                        command, tag = self.inflightSeqDict.pop(msgSeq)
+                        if code != 0:
+                            self.inflightErrCount += 1
+                            self.errorFunc(command, tag, code)
+                        if len(self.inflightSeqDict) == 0:
+                            self._batchComplete()
+                    offset += (msgLen + 3) & ~3
+        except Exception:
+            self.logger.error("Error occured in route channel receive callback", exc_info=True)
+        return True
+
+
+class _RouteMonitor:
+
+    """Receives rtnetlink notifications of links, IPv4 addresses and IPv4 routes in main and local table.
+       Routes in other tables are ignored, they include our own routes."""
+
+    _RTMGRP_LINK = 0x1
+    _RTMGRP_IPV4_IFADDR = 0x10
+    _RTMGRP_IPV4_ROUTE = 0x40
+
+    _RTM_NEWLINK = 16
+    _RTM_DELLINK = 17
+    _RTM_NEWADDR = 20
+    _RTM_NEWROUTE = 24
+
+    def __init__(self, logger, event_func):
+        self.logger = logger
+        self.eventFunc = event_func             # event_func(bLinkChanged), called when pending routes may become installable
+        self.sock = None
+        self.sockWatch = None
+        try:
+            self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+            self.sock.bind((0, self._RTMGRP_LINK | self._RTMGRP_IPV4_IFADDR | self._RTMGRP_IPV4_ROUTE))
+            self.sock.setblocking(False)
+            self.sockWatch = GLib.io_add_watch(self.sock.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, self._recvCallback)
+        except BaseException:
+            self.dispose()
+            raise
+
+    def dispose(self):
+        if self.sockWatch is not None:
+            GLib.source_remove(self.sockWatch)
+            self.sockWatch = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def _recvCallback(self, fd, condition):
+        try:
+            bChanged = False
+            bLinkChanged = False
+            while True:
+                try:
+                    buf = self.sock.recv(65536)
+                except BlockingIOError:
+                    break
+                except OSError as e:
+                    if e.errno == errno.ENOBUFS:
+                        # notifications are lost, assume everything changed
+                        bChanged = True
+                        bLinkChanged = True
+                        continue
+                    raise
+
+                offset = 0
+                while offset + 16 <= len(buf):
+                    msgLen, msgType = struct.unpack_from("=IH", buf, offset)
+                    if msgLen < 16:
+                        break
+                    if msgType in [self._RTM_NEWLINK, self._RTM_DELLINK]:
+                        bChanged = True
+                        bLinkChanged = True
+                    elif msgType == self._RTM_NEWADDR:
+                        bChanged = True
+                    elif msgType == self._RTM_NEWROUTE and offset + 28 <= len(buf):
+                        if buf[offset + 16 + 4] in [254, 255]:        # struct rtmsg {family, dst_len, src_len, tos, table, ...}
+                            bChanged = True
+                    offset += (msgLen + 3) & ~3
+
+            if bChanged:
+                self.eventFunc(bLinkChanged)
+        except Exception:
+            self.logger.error("Error occured in route monitor receive callback", exc_info=True)
+        return True
+
 
 class _Helper:
 
@@ -365,3 +1632,146 @@ class _Helper:
     def prefixConvert(prefix):
         tl = prefix.split("/")
         return tl[0] + "/" + str(WrtUtil.ipMaskToLen(tl[1]))
+
+    @staticmethod
+    def targetToPathTuple(target):
+        """Returns tuple<(nexthop, interface, weight)>, single target [nexthop, interface] is a path with weight 1"""
+        if len(target) > 0 and isinstance(target[0], (list, tuple)):
+            return tuple([(x[0], x[1], x[2]) for x in target])
+        return ((target[0], target[1], 1),)
+
+    @staticmethod
+    def multipathHashPolicyToValue(policy):
+        # value of net.ipv4.fib_multipath_hash_policy
+        if policy == "l3":
+            return 0
+        elif policy == "l4":
+            return 1
+        elif policy == "l3-inner":
+            return 2
+        else:
+            raise Exception("invalid multipath hash policy \"%s\"" % (policy))
+
+    @staticmethod
+    def domainNormalize(domain):
+        # a domain covers all its sub-domains, so "*.example.com" is the same as "example.com"
+        domain = domain.strip().strip(".").lower()
+        if domain.startswith("*."):
+            domain = domain[2:]
+        return domain
+
+    DOMAIN_BLACKLISTED = "blacklisted"      # value of a domain blacklisted by a tfac group
+
+    @staticmethod
+    def compileNetworkList(networkList):
+        """networkList is list<(prefix-list, prefix-blacklist, value)>, prefix can be in "ip/mask" or "ip/len" format.
+           Returns dict<prefix,value> for longest-prefix-match, prefix is in "ip/mask" format.
+           Each address is mapped to the value of the most specific prefix covering it, the latter one wins for identical prefixes.
+           Blacklisted addresses are subtracted from the prefix-list they belong to.
+           Nested prefixes are kept as separate routes, only the redundant ones are removed, and sibling prefixes with the same value are merged."""
+
+        # get CIDR pieces with blacklists subtracted, dict<(start,prefix-length),(rank,value)>, highest rank wins for identical pieces
+        # a piece keeps the rank of the prefix it comes from, even if it is split by blacklist
+        pieceDict = dict()
+        for i, (prefixList, blacklist, value) in enumerate(networkList):
+            blIntervalList = _Helper._mergeIntervals([_Helper._prefixToInterval(x)[:2] for x in blacklist])
+            blStartList = [x[0] for x in blIntervalList]
+            for prefix in prefixList:
+                start, end, prefixLen = _Helper._prefixToInterval(prefix)
+                rank = (prefixLen, i)
+                for start2, end2 in _Helper._subtractIntervals(start, end, blIntervalList, blStartList):
+                    for start3, end3 in _Helper._intervalToCidrs(start2, end2):
+                        key = (start3, 33 - (end3 - start3 + 1).bit_length())
+                        if key not in pieceDict or pieceDict[key][0] < rank:
+                            pieceDict[key] = (rank, value)
+
+        # a piece is dropped if an enclosing piece has higher rank, then the kernel's longest-prefix-match gives the same result
+        # pieces are walked from outer to inner, recording the highest rank along the nesting chain
+        maxRankDict = dict()                    # dict<(start,prefix-length),rank>
+        netDict = dict()                        # dict<(start,prefix-length),value>
+        for key in sorted(pieceDict.keys(), key=lambda x: x[1]):
+            rank, value = pieceDict[key]
+            parent = _Helper._findParentCidr(maxRankDict, key)
+            if parent is None or maxRankDict[parent] < rank:
+                maxRankDict[key] = rank
+                netDict[key] = value
+            else:
+                maxRankDict[key] = maxRankDict[parent]
+        _Helper._removeRedundantCidrs(netDict)
+
+        # merge sibling prefixes with the same value, the merged prefix replaces the parent which is fully covered by them
+        for prefixLen in range(32, 0, -1):
+            for start, dummy in [x for x in netDict.keys() if x[1] == prefixLen]:
+                sibling = (start ^ (1 << (32 - prefixLen)), prefixLen)
+                if start < sibling[0] and netDict.get(sibling) == netDict[(start, prefixLen)]:
+                    netDict[(start, prefixLen - 1)] = netDict.pop(sibling)
+                    del netDict[(start, prefixLen)]
+        _Helper._removeRedundantCidrs(netDict)
+
+        ret = dict()
+        for (start, prefixLen), value in netDict.items():
+            mask = (0xFFFFFFFF << (32 - prefixLen)) & 0xFFFFFFFF
+            ret[socket.inet_ntoa(struct.pack("!I", start)) + "/" + socket.inet_ntoa(struct.pack("!I", mask))] = value
+        return ret
+
+    @staticmethod
+    def _findParentCidr(cidrDict, key):
+        # returns the nearest (start,prefix-length) in cidrDict enclosing key, None if not found
+        start, prefixLen = key
+        for prefixLen2 in range(prefixLen - 1, -1, -1):
+            key2 = (start & ((0xFFFFFFFF << (32 - prefixLen2)) & 0xFFFFFFFF), prefixLen2)
+            if key2 in cidrDict:
+                return key2
+        return None
+
+    @staticmethod
+    def _removeRedundantCidrs(netDict):
+        # a prefix is removed if its nearest enclosing prefix has the same value, outer ones are checked first
+        for key in sorted(netDict.keys(), key=lambda x: x[1]):
+            parent = _Helper._findParentCidr(netDict, key)
+            if parent is not None and netDict[parent] == netDict[key]:
+                del netDict[key]
+
+    @staticmethod
+    def _prefixToInterval(prefix):
+        # returns (start,end,prefix-length)
+        net = ipaddress.IPv4Network(prefix, strict=False)
+        return (int(net.network_address), int(net.broadcast_address), net.prefixlen)
+
+    @staticmethod
+    def _intervalToCidrs(start, end):
+        # returns list<(start,end)>, each item is a CIDR block
+        ret = []
+        while start <= end:
+            size = (start & -start) if start > 0 else 0x100000000
+            while start + size - 1 > end:
+                size >>= 1
+            ret.append((start, start + size - 1))
+            start += size
+        return ret
+
+    @staticmethod
+    def _mergeIntervals(intervalList):
+        ret = []
+        for start, end in sorted(intervalList):
+            if len(ret) > 0 and start <= ret[-1][1] + 1:
+                ret[-1][1] = max(ret[-1][1], end)
+            else:
+                ret.append([start, end])
+        return ret
+
+    @staticmethod
+    def _subtractIntervals(start, end, intervalList, startList):
+        # intervalList is sorted and merged, startList is the start points of intervalList
+        ret = []
+        i = max(bisect.bisect_right(startList, start) - 1, 0)
+        while i < len(intervalList) and intervalList[i][0] <= end:
+            start2, end2 = intervalList[i]
+            if end2 >= start:
+                if start2 > start:
+                    ret.append((start, start2 - 1))
+                start = end2 + 1
+            i += 1
+        if start <= end:
+            ret.append((start, end))
+        return ret
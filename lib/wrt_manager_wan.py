@@ -125,11 +125,13 @@ class WanConnectionPluginApi:
                     f.write("nameserver %s\n" % (ns))
 
         self.parent.ifconfigDict[ifname] = ifconfig
+        self.parent.param.daemon.update_flow_offload_interfaces()
 
         self.parent.param.managerCaller.call("on_wan_conn_up")
 
     def deactivate_interface(self, ifname):
         del self.parent.ifconfigDict[ifname]
+        self.parent.param.daemon.update_flow_offload_interfaces()
 
         with open(self.parent.param.ownResolvConf, "w") as f:
             f.write("")
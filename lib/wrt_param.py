@@ -16,6 +16,7 @@ class WrtParam:
         self.varDir = "/var/wrtd"
 
         self.procIpForwareFile = "/proc/sys/net/ipv4/ip_forward"
+        self.procMultipathHashPolicyFile = "/proc/sys/net/ipv4/fib_multipath_hash_policy"
 
         self.ownResolvConf = os.path.join(self.tmpDir, "resolv.conf")
         self.dataFile = os.path.join(self.varDir, "global.json")
@@ -35,7 +36,15 @@ class WrtParam:
         self.abortOnError = False
         self.logLevel = None
         self.config = None
+        self.firewallBackend = "nftables"      # "nftables" or "iptables"
+        self.firewall = None
+        self.l2NameserverBackend = "dnsmasq"   # "dnsmasq" or "forwarder"
+        self.flowOffload = False               # software flow offload of forwarded traffic between bridges and wan interfaces
+        self.defaultBridgePrefixLen = 24       # 17 to 30
+        self.defaultBridgeDhcpPoolSize = None  # None means 49 addresses, or all the addresses for small prefix
+        self.multipathHashPolicy = None        # "l3", "l4" or "l3-inner", None means kernel setting is not touched
 
         self.trafficManager = None
         self.wanManager = None
         self.lanManager = None
+        self.sqmManager = None
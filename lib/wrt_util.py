@@ -13,7 +13,6 @@ import errno
 import threading
 import subprocess
 import ipaddress
-import iptc
 from jsoncomment import JsonComment
 from collections import OrderedDict
 from gi.repository import GLib
@@ -21,6 +20,8 @@ from gi.repository import GLib
 
 class WrtUtil:
 
+    _dnsmasqLeasePattern = re.compile("^([0-9]+) +([0-9a-f:]+) +([0-9\\.]+) +(\\S+) +(\\S+)", re.M)
+
     @staticmethod
     def readFile(filename):
         with open(filename, "r") as f:
@@ -116,9 +117,11 @@ class WrtUtil:
 
     @staticmethod
     def dictToDnsmasqHostFile(ipHostnameDict, filename):
-        with open(filename, "w") as f:
-            for ip, hostname in ipHostnameDict.items():
-                f.write(ip + " " + hostname + "\n")
+        # write to a temporary file and rename, so that dnsmasq never reads a partial file
+        tmpFilename = filename + ".tmp"
+        with open(tmpFilename, "w") as f:
+            f.write("".join([ip + " " + hostname + "\n" for ip, hostname in ipHostnameDict.items()]))
+        os.rename(tmpFilename, filename)
 
     @staticmethod
     def recvUntilEof(sock):
@@ -256,42 +259,19 @@ class WrtUtil:
            This function returns [(expiry-time,mac,ip,hostname,client-id), (expiry-time,mac,ip,hostname,client-id)]
         """
 
-        pattern = "([0-9]+) +([0-9a-f:]+) +([0-9\\.]+) +(\\S+) +(\\S+)"
-        ret = []
-        with open(filename, "r") as f:
-            for line in f.read().split("\n"):
-                m = re.match(pattern, line)
-                if m is None:
-                    continue
-                expiryTime = m.group(1)
-                mac = m.group(2)
-                ip = m.group(3)
-                hostname = "" if m.group(4) == "*" else m.group(4)
-                clientId = "" if m.group(5) == "*" else m.group(5)
-                ret.append((expiryTime, mac, ip, hostname, clientId))
-        return ret
+        return list(WrtUtil.readDnsmasqLeaseFileToDict(filename).values())
 
     @staticmethod
-    def iptablesIsEmpty():
-        # iptc.Table.ALL contains "security" table which is very rare
-        for tname in ["filter", "mangle", "raw", "nat"]:
-            table = iptc.Table(tname)
-            for chain in table.chains:
-                if not table.builtin_chain(chain):
-                    return False
-                if chain.rules != []:
-                    return False
-        return True
+    def readDnsmasqLeaseFileToDict(filename):
+        """Returns dict<ip, (expiry-time,mac,ip,hostname,client-id)>, in the order of the leases file"""
 
-    @staticmethod
-    def iptablesSetEmpty():
-        # iptc.Table.ALL contains "security" table which is very rare
-        for tname in ["filter", "mangle", "raw", "nat"]:
-            table = iptc.Table(tname)
-            table.flush()
-            for chain in table.chains:
-                chain.flush()
-        return True
+        ret = dict()
+        with open(filename, "r") as f:
+            for expiryTime, mac, ip, hostname, clientId in WrtUtil._dnsmasqLeasePattern.findall(f.read()):
+                hostname = "" if hostname == "*" else hostname
+                clientId = "" if clientId == "*" else clientId
+                ret[ip] = (expiryTime, mac, ip, hostname, clientId)
+        return ret
 
 
 class StdoutRedirector: